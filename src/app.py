@@ -1,14 +1,31 @@
+import atexit
 import os
+import uuid
 
 import streamlit as st
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage
 
-from lib.streamlit_callback import get_streamlit_cb
-from rag.graph import invoke_graph
+from lib.api_client import get_history, stream_chat
+from lib.streamlit_callback import (
+    NODE_STATUS_MESSAGES,
+    StreamlitCallbackHandler,
+    get_streamlit_cb,
+)
+from rag.models import DEFAULT_ANSWER, WELCOME_MESSAGE
 
 load_dotenv()
 
+# When set, the app is a thin client of the InmunoBot HTTP server (server.py)
+INMUNOBOT_API_URL = os.getenv("INMUNOBOT_API_URL", "").rstrip("/")
+
+if not INMUNOBOT_API_URL:
+    # Only the in-process mode needs the RAG runtime and its settings
+    from lib.event_loop import run_sync
+    from lib.llm import aclose_chat_http_clients
+    from rag.graph import invoke_graph, warm_up
+    from rag.memory import advance_memory
+
 st.title("InmunoBot")
 st.markdown("#### Tu Asistente Inteligente de Inmunología")
 
@@ -23,7 +40,7 @@ facilita tu estudio de la inmunología de manera rápida y eficiente.
 """
 
 # Check if the API key is available as an environment variable
-if not os.getenv("AKASH_API_KEY"):
+if not INMUNOBOT_API_URL and not os.getenv("AKASH_API_KEY"):
     # If not, display a sidebar input for the user to provide the API key
     st.sidebar.header("Akash Api Key Setup")
     api_key = st.sidebar.text_input(
@@ -36,9 +53,60 @@ if not os.getenv("AKASH_API_KEY"):
         st.info("Please enter your AKASH_API_KEY in the sidebar.")
         st.stop()
 
+
+@st.cache_resource
+def warm_up_runtime():
+    # Runs once per server process, not on every script rerun
+    warm_up()
+    # The chat pools live on the shared loop, which is still running at exit
+    atexit.register(lambda: run_sync(aclose_chat_http_clients()))
+
+
+def stream_remote_answer(prompt: str) -> str:
+    """Renders the server's SSE stream with the same handler as local turns"""
+    st_callback = StreamlitCallbackHandler(st.container())
+    answer = DEFAULT_ANSWER
+
+    for event, data in stream_chat(
+        INMUNOBOT_API_URL, prompt, st.session_state["session_id"]
+    ):
+        if event == "status":
+            st_callback.show_status(
+                NODE_STATUS_MESSAGES.get(data["node"], data["node"])
+            )
+        elif event == "token":
+            st_callback.on_llm_new_token(data["text"], tags=[st_callback.stream_tag])
+        elif event == "final":
+            answer = data["answer"]
+
+    st_callback.finish(answer)
+    return answer
+
+
+if not INMUNOBOT_API_URL:
+    warm_up_runtime()
+
+if "session_id" not in st.session_state:
+    # Identifies the browser session in the request scheduler and the server
+    st.session_state["session_id"] = uuid.uuid4().hex
+
+if INMUNOBOT_API_URL:
+    # The server owns the history, the session state only mirrors it
+    st.session_state["messages"] = [
+        AIMessage(content=message["content"])
+        if message["role"] == "assistant"
+        else HumanMessage(content=message["content"])
+        for message in get_history(INMUNOBOT_API_URL, st.session_state["session_id"])
+    ] or [AIMessage(content=WELCOME_MESSAGE)]
+
 if "messages" not in st.session_state:
     # default initial message to render in message state
-    st.session_state["messages"] = [AIMessage(content="En que te puedo ayudar hoy?")]
+    st.session_state["messages"] = [AIMessage(content=WELCOME_MESSAGE)]
+    # Running summary of the older messages, returned by every turn, and the
+    # first message it doesn't cover. Only the messages from there on are
+    # sent to the graph
+    st.session_state["memory"] = {}
+    st.session_state["memory_start"] = 0
 
 # Loop through all messages in the session state and render them as a chat
 # on every st.refresh mech
@@ -57,14 +125,27 @@ if prompt := st.chat_input():
 
     # Process the AI's response and handles graph events using the callback mechanism
     with st.chat_message("assistant"):
-        # create a new container for streaming messages only, and give it context
-        st_callback = get_streamlit_cb(st.container())
-        response = invoke_graph(st.session_state.messages, [st_callback])
-        # Add that last message to the st_message_state
-        # Streamlit's refresh the message will automatically be visually rendered bc
-        # of the msg render for loop above
-        st.session_state.messages.append(
-            AIMessage(content=response["messages"][-1].content)
-        )
-
-        st.rerun()
+        if INMUNOBOT_API_URL:
+            answer = stream_remote_answer(prompt)
+        else:
+            # create a new container for streaming messages only, and give it
+            # context
+            st_callback = get_streamlit_cb(st.container())
+            memory_start = st.session_state["memory_start"]
+            response = invoke_graph(
+                st.session_state.messages[memory_start:],
+                [st_callback],
+                session_id=st.session_state["session_id"],
+                memory=st.session_state["memory"],
+            )
+            answer = response["messages"][-1].content
+            covered, st.session_state["memory"] = advance_memory(response)
+            st.session_state["memory_start"] = memory_start + covered
+
+            # The answer was already streamed, this only replaces it if
+            # validation retracted it, so the page doesn't need a rerun
+            st_callback.finish(answer)
+
+        # Add that last message to the st_message_state, it will be rendered
+        # by the msg render for loop above on the next interaction
+        st.session_state.messages.append(AIMessage(content=answer))
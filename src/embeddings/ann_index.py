@@ -0,0 +1,309 @@
+"""
+Approximate nearest neighbor index (IVF-Flat) for the chunk embeddings.
+
+Vectors are clustered with spherical k-means into `nlist` inverted lists. A
+search only scores the vectors of the `nprobe` lists whose centroids are the
+closest to the query, trading recall for latency. The lists only hold row
+positions: the vectors are gathered from the matrix the index is attached
+to, the memory-mapped matrix of the local index, so they are stored once.
+
+Build it from the exported local index and benchmark it with:
+
+    python -m embeddings.ann_index build [--nlist N]
+    python -m embeddings.ann_index benchmark [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from embeddings.local_index import (
+    ANN_FILE,
+    LOCAL_INDEX_PATH,
+    LocalVectorIndex,
+    normalize_rows,
+)
+
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+
+
+def default_nlist(size: int) -> int:
+    return max(1, min(size, int(4 * np.sqrt(size))))
+
+
+def spherical_kmeans(
+    vectors: np.ndarray, nlist: int, iterations: int = 15, seed: int = 0
+) -> np.ndarray:
+    """Returns `nlist` unit-norm centroids for the (normalized) vectors"""
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # Re-seed empty clusters with random vectors
+        empty = np.flatnonzero(~sums.any(axis=1))
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index with exact scoring inside the probed lists"""
+
+    def __init__(
+        self, centroids: np.ndarray, nprobe: int = ANN_NPROBE, version: str = ""
+    ):
+        self.centroids = normalize_rows(centroids)
+        self.nprobe = nprobe
+        # Version of the documents the ids point at, see `documents_version`
+        self.version = version
+        # Row positions of every list in the attached matrix
+        self._list_ids: List[np.ndarray] = [
+            np.empty(0, dtype=np.int64) for _ in range(len(self.centroids))
+        ]
+        # Normalized rows the ids point at, not owned by the index
+        self.vectors: Optional[np.ndarray] = None
+
+    def attach(self, vectors: np.ndarray):
+        """Sets the matrix the list ids are row positions of"""
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._list_ids)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        nlist: Optional[int] = None,
+        nprobe: int = ANN_NPROBE,
+        training_size: int = 100_000,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Index over the rows of `vectors` (normalized), attached to it"""
+        nlist = nlist or default_nlist(len(vectors))
+
+        # k-means only needs a sample of the corpus to place the centroids
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > training_size:
+            sample = vectors[rng.choice(len(vectors), training_size, replace=False)]
+
+        index = cls(
+            spherical_kmeans(normalize_rows(sample), nlist, seed=seed), nprobe=nprobe
+        )
+        # Assigned in blocks, so no normalized copy of the whole matrix is made
+        for start in range(0, len(vectors), training_size):
+            block = vectors[start : start + training_size]
+            index.add(block, np.arange(start, start + len(block)))
+        index.attach(vectors)
+        return index
+
+    def add(self, vectors: np.ndarray, ids: Optional[np.ndarray] = None):
+        """
+        Assigns new rows to their closest list, no retraining needed. `ids`
+        are their positions in the attached matrix, after the current rows
+        by default
+        """
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        ids = np.asarray(ids, dtype=np.int64)
+
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        for list_index in np.unique(assignments):
+            self._list_ids[list_index] = np.concatenate(
+                [self._list_ids[list_index], ids[assignments == list_index]]
+            )
+
+    def remap(self, positions: np.ndarray):
+        """
+        Moves every id to `positions[id]`, and drops the ids mapped to -1.
+        Keeps the index valid after rows are removed from the local index
+        """
+        for i in range(self.nlist):
+            ids = positions[self._list_ids[i]]
+            self._list_ids[i] = ids[ids >= 0]
+
+    def search(
+        self, queries: np.ndarray, k: int = 5, nprobe: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (ids, scores) arrays of shape (len(queries), k), padded with
+        -1 ids and -inf scores when fewer than k candidates were probed
+        """
+        if self.vectors is None:
+            raise ValueError("The index must be attached to its vectors first")
+        queries = normalize_rows(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        result_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            candidate_ids = np.concatenate([self._list_ids[i] for i in lists])
+            if len(candidate_ids) == 0:
+                continue
+            # Sorted positions read the memory-mapped rows in file order
+            candidate_ids.sort()
+            scores = self.vectors[candidate_ids] @ query
+            top_k = min(k, len(scores))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+
+            result_ids[row, :top_k] = candidate_ids[top]
+            result_scores[row, :top_k] = scores[top]
+
+        return result_ids, result_scores
+
+    def save(self, file_path: str):
+        sizes = np.array([len(ids) for ids in self._list_ids], dtype=np.int64)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                sizes=sizes,
+                ids=np.concatenate(self._list_ids),
+                version=np.asarray(self.version),
+            )
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str, nprobe: int = ANN_NPROBE) -> "IVFIndex":
+        data = np.load(file_path)
+        # Files written before versioning never match an export
+        version = str(data["version"]) if "version" in data.files else ""
+        index = cls(data["centroids"], nprobe=nprobe, version=version)
+        offsets = np.concatenate([[0], np.cumsum(data["sizes"])])
+        ids = data["ids"]
+        for i in range(index.nlist):
+            index._list_ids[i] = ids[offsets[i] : offsets[i + 1]]
+        return index
+
+
+def exact_search(
+    vectors: np.ndarray, queries: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    scores = normalize_rows(queries) @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(
+        top_scores, order, axis=1
+    )
+
+
+def synthetic_vectors(size: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """Clustered random vectors, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, size // 1000), dimension), dtype=np.float32)
+    assignments = rng.integers(0, len(centers), size)
+    noise = rng.standard_normal((size, dimension), dtype=np.float32)
+    return normalize_rows(centers[assignments] + 0.5 * noise)
+
+
+def benchmark(
+    sizes: List[int],
+    dimension: int,
+    nprobes: List[int],
+    queries_count: int = 200,
+    k: int = 5,
+):
+    for size in sizes:
+        vectors = synthetic_vectors(size, dimension)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(size, queries_count, replace=False)]
+        queries = normalize_rows(
+            queries + 0.1 * rng.standard_normal(queries.shape, dtype=np.float32)
+        )
+
+        started_at = time.perf_counter()
+        index = IVFIndex.build(vectors)
+        build_time = time.perf_counter() - started_at
+
+        exact_ids = []
+        exact_latencies = []
+        for query in queries:
+            started_at = time.perf_counter()
+            ids, _ = exact_search(vectors, query[None, :], k)
+            exact_latencies.append(time.perf_counter() - started_at)
+            exact_ids.append(ids[0])
+
+        print(
+            f"\nsize={size} dim={dimension} nlist={index.nlist} build={build_time:.1f}s"
+        )
+        print(
+            f"  exact          recall@{k}=1.000 "
+            f"p50={np.percentile(exact_latencies, 50) * 1e3:.3f}ms "
+            f"p99={np.percentile(exact_latencies, 99) * 1e3:.3f}ms"
+        )
+
+        for nprobe in nprobes:
+            latencies = []
+            hits = 0
+            for query, expected in zip(queries, exact_ids):
+                started_at = time.perf_counter()
+                ids, _ = index.search(query[None, :], k, nprobe=nprobe)
+                latencies.append(time.perf_counter() - started_at)
+                hits += len(set(ids[0].tolist()) & set(expected.tolist()))
+
+            print(
+                f"  ivf nprobe={nprobe:<3} recall@{k}={hits / (k * len(queries)):.3f} "
+                f"p50={np.percentile(latencies, 50) * 1e3:.3f}ms "
+                f"p99={np.percentile(latencies, 99) * 1e3:.3f}ms"
+            )
+
+
+def build_from_local_index(
+    path: str = LOCAL_INDEX_PATH, nlist: Optional[int] = None
+) -> IVFIndex:
+    local_index = LocalVectorIndex.load(path)
+    index = IVFIndex.build(np.asarray(local_index.vectors), nlist=nlist)
+    index.version = local_index.version
+    index.save(os.path.join(path, ANN_FILE))
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build from the local index")
+    build_parser.add_argument("--nlist", type=int, default=None)
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Recall vs latency")
+    benchmark_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    # Dimension of the BGE-large embeddings
+    benchmark_parser.add_argument("--dim", type=int, default=1024)
+    benchmark_parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32]
+    )
+    benchmark_parser.add_argument("--queries", type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        ann_index = build_from_local_index(nlist=args.nlist)
+        print(f"Built IVF index with {len(ann_index)} vectors, nlist={ann_index.nlist}")
+    else:
+        benchmark(args.sizes, args.dim, args.nprobe, args.queries)
@@ -0,0 +1,271 @@
+"""
+Batched SmolDocling page conversion.
+
+The model and the processor are loaded once and the chat prompt is rendered
+once. Pages are grouped by size, so a batch of tiles needs no image padding
+and only the (left padded) prompts differ, and every batch runs under
+`torch.inference_mode`. On CPU the model runs in float32 with an optional int8
+dynamic quantization of its linear layers; on GPU in bfloat16.
+
+Compare the per-page loop with the batched engine on a sample PDF with:
+
+    python -m embeddings.docling_engine benchmark \\
+        ../pdfs_not_to_process/2.03.01_VACCINES_NEW_TECH.pdf [pages]
+"""
+
+import os
+import sys
+import threading
+import time
+from functools import cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from docling_core.types.doc import DoclingDocument
+from docling_core.types.doc.document import DocTagsDocument
+from PIL import Image
+from transformers import AutoModelForVision2Seq, AutoProcessor
+
+# Refer to: https://huggingface.co/ds4sd/SmolDocling-256M-preview
+DOCLING_MODEL = os.getenv("DOCLING_MODEL", "ds4sd/SmolDocling-256M-preview")
+DOCLING_DEVICE = os.getenv(
+    "DOCLING_DEVICE", "cuda" if torch.cuda.is_available() else "cpu"
+)
+DOCLING_BATCH_SIZE = int(
+    os.getenv("DOCLING_BATCH_SIZE", "8" if DOCLING_DEVICE == "cuda" else "4")
+)
+DOCLING_THREADS = int(os.getenv("DOCLING_THREADS", str(os.cpu_count() or 1)))
+# int8 dynamic quantization of the linear layers, CPU only
+DOCLING_QUANTIZE = os.getenv("DOCLING_QUANTIZE", "false").lower() == "true"
+DOCLING_MAX_NEW_TOKENS = int(os.getenv("DOCLING_MAX_NEW_TOKENS", "8192"))
+
+DOCLING_MESSAGES = [
+    {
+        "role": "user",
+        "content": [
+            {"type": "image"},
+            {"type": "text", "text": "Convert this page to docling."},
+        ],
+    },
+]
+
+
+# PIL images or (height, width, 3) uint8 arrays, like the page rasters
+PageImage = Union[Image.Image, np.ndarray]
+
+
+def image_size(image: PageImage) -> Tuple[int, int]:
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+class ConversionStats:
+    """Pages converted and the time spent on them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pages = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def record(self, pages: int, seconds: float):
+        with self._lock:
+            self.pages += pages
+            self.batches += 1
+            self.seconds += seconds
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "pages": self.pages,
+                "batches": self.batches,
+                "seconds_per_page": self.seconds / self.pages if self.pages else 0.0,
+                "pages_per_minute": self.pages / self.seconds * 60
+                if self.seconds
+                else 0.0,
+            }
+
+
+class DoclingEngine:
+    """SmolDocling loaded once, converting pages to doctags in batches"""
+
+    def __init__(
+        self,
+        model_name: str = DOCLING_MODEL,
+        device: str = DOCLING_DEVICE,
+        batch_size: int = DOCLING_BATCH_SIZE,
+        threads: int = DOCLING_THREADS,
+        quantize: bool = DOCLING_QUANTIZE,
+        max_new_tokens: int = DOCLING_MAX_NEW_TOKENS,
+    ):
+        self.device = device
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.stats = ConversionStats()
+
+        if device == "cpu":
+            torch.set_num_threads(threads)
+
+        self.processor = AutoProcessor.from_pretrained(model_name)
+        # Generation appends to the right, so the prompts are padded on the left
+        self.processor.tokenizer.padding_side = "left"
+        self.prompt = self.processor.apply_chat_template(
+            DOCLING_MESSAGES, add_generation_prompt=True
+        )
+
+        model = AutoModelForVision2Seq.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,
+        )
+        model.eval()
+        if quantize and device == "cpu":
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.model = model.to(device)
+
+        eos_token_id = self.model.generation_config.eos_token_id
+        self.eos_token_ids = set(
+            eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        )
+
+    def batches(self, images: Sequence[PageImage]) -> List[List[int]]:
+        """Page indexes grouped by page size, at most `batch_size` per batch"""
+        by_size: Dict[tuple, List[int]] = {}
+        for i, image in enumerate(images):
+            by_size.setdefault(image_size(image), []).append(i)
+
+        return [
+            indexes[start : start + self.batch_size]
+            for indexes in by_size.values()
+            for start in range(0, len(indexes), self.batch_size)
+        ]
+
+    def _trim(self, token_ids: List[int]) -> List[int]:
+        """Drops the padding generated after the end of a shorter page"""
+        for i, token_id in enumerate(token_ids):
+            if token_id in self.eos_token_ids:
+                return token_ids[: i + 1]
+        return token_ids
+
+    def convert_batch(self, images: Sequence[PageImage]) -> List[str]:
+        inputs = self.processor(
+            text=[self.prompt] * len(images),
+            images=[[image] for image in images],
+            padding=True,
+            return_tensors="pt",
+        ).to(self.device)
+
+        with torch.inference_mode():
+            generated_ids = self.model.generate(
+                **inputs, max_new_tokens=self.max_new_tokens
+            )
+
+        prompt_length = inputs.input_ids.shape[1]
+        return [
+            doctags.lstrip()
+            for doctags in self.processor.batch_decode(
+                [self._trim(row) for row in generated_ids[:, prompt_length:].tolist()],
+                skip_special_tokens=False,
+            )
+        ]
+
+    def convert(
+        self, images: Sequence[PageImage], name: Optional[str] = None
+    ) -> List[str]:
+        """Doctags of every page, in page order"""
+        doctags: List[Optional[str]] = [None] * len(images)
+
+        for batch in self.batches(images):
+            started_at = time.perf_counter()
+            for i, page_doctags in zip(
+                batch, self.convert_batch([images[i] for i in batch])
+            ):
+                doctags[i] = page_doctags
+            elapsed = time.perf_counter() - started_at
+            self.stats.record(len(batch), elapsed)
+
+            pages = ", ".join(str(i + 1) for i in batch)
+            print(
+                f"{name or 'Document'} pages {pages}: {elapsed / len(batch):.1f} s/page"
+            )
+
+        return doctags
+
+
+def doctags_to_markdown(all_doctags: List[str], images: List[Image.Image]) -> str:
+    # Create a docling document
+    doctags_doc = DocTagsDocument.from_doctags_and_image_pairs(all_doctags, images)
+    doc = DoclingDocument(name="Document")
+
+    doc.load_from_doctags(doctags_doc)
+
+    return doc.export_to_markdown()
+
+
+@cache
+def get_docling_engine() -> DoclingEngine:
+    """The engine of this process, loaded on first use"""
+    print("Docling device: ", DOCLING_DEVICE)
+    return DoclingEngine()
+
+
+def convert_per_page(engine: DoclingEngine, images: Sequence[PageImage]):
+    """The previous loop: template and inputs rebuilt for every page"""
+    doctags = []
+    for image in images:
+        prompt = engine.processor.apply_chat_template(
+            DOCLING_MESSAGES, add_generation_prompt=True
+        )
+        inputs = engine.processor(text=prompt, images=image, return_tensors="pt")
+        inputs = inputs.to(engine.device)
+        generated_ids = engine.model.generate(
+            **inputs, max_new_tokens=engine.max_new_tokens
+        )
+        doctags.append(
+            engine.processor.batch_decode(
+                generated_ids[:, inputs.input_ids.shape[1] :],
+                skip_special_tokens=False,
+            )[0].lstrip()
+        )
+    return doctags
+
+
+def benchmark(pdf_path: str, pages: int = 8, batch_sizes: Sequence[int] = (1, 2, 4, 8)):
+    """Pages per minute of the per-page loop and of the engine per batch size"""
+    from embeddings.page_source import PageSource
+
+    source = PageSource(pdf_path, cache_path="")
+    rasters = [
+        source.page(page_number)
+        for page_number in range(1, min(pages, source.page_count) + 1)
+    ]
+    images = [raster.array for raster in rasters]
+
+    engine = get_docling_engine()
+    engine.convert_batch(images[:1])  # warm up
+
+    def report(label: str, elapsed: float):
+        print(
+            f"{label:<14} {len(images) / elapsed * 60:6.2f} pages/min "
+            f"({elapsed / len(images):.1f} s/page)"
+        )
+
+    started_at = time.perf_counter()
+    convert_per_page(engine, images)
+    report("per-page loop", time.perf_counter() - started_at)
+
+    for batch_size in batch_sizes:
+        engine.batch_size = batch_size
+        started_at = time.perf_counter()
+        engine.convert(images, name="benchmark")
+        report(f"batch size {batch_size}", time.perf_counter() - started_at)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "benchmark":
+        print("Usage: python -m embeddings.docling_engine benchmark <pdf> [pages]")
+    else:
+        benchmark(sys.argv[2], *(int(pages) for pages in sys.argv[3:4]))
@@ -0,0 +1,330 @@
+"""
+BM25 inverted index over the same chunks that are embedded.
+
+Dense BGE search tends to miss exact terms like "CD4", "IL-2" or "MHC class II",
+so the lexical ranking is fused with the dense results. Postings are kept in
+compressed sparse row form (term offsets, int32 chunk positions, uint16 term
+frequencies) and persisted next to the local vector index.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+LEXICAL_INDEX_PATH = os.getenv(
+    "LEXICAL_INDEX_PATH", os.getenv("LOCAL_INDEX_PATH", ".cache/local_index")
+)
+
+POSTINGS_FILE = "bm25_postings.npz"
+DOCUMENTS_FILE = "bm25_documents.json"
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-/][a-z0-9]+)*")
+KEYWORD_PATTERN = re.compile(r"^(?:[A-Z]{2,}\w*|\w*\d\w*|\w+-\w+)$")
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be by de del el en es for from how in is it la las los of
+    on or que the to un una what which why y with
+    """.split()
+)
+
+
+def chunk_id(document: Document) -> str:
+    """Stable id of a chunk, shared by every index that stores it"""
+    return hashlib.sha1(document.page_content.encode("utf-8")).hexdigest()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased, accent-free tokens. Hyphenated terms are kept whole and also
+    split, so "IL-2" matches both "il-2" and "il 2"
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        if token not in STOPWORDS:
+            tokens.append(token)
+        if "-" in token or "/" in token:
+            tokens.extend(part for part in re.split(r"[-/]", token) if part)
+    return tokens
+
+
+def is_keyword_query(query: str) -> bool:
+    """Short queries made of acronyms or identifiers, such as CD4 or IL-2"""
+    words = query.replace("?", " ").replace("¿", " ").split()
+    return 0 < len(words) <= 4 and any(KEYWORD_PATTERN.match(word) for word in words)
+
+
+class BM25Index:
+    """Okapi BM25 ranking over an incrementally updated inverted index"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.records: List[Dict[str, Any]] = []
+        self.documents: List[Document] = []
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self._positions: Dict[str, int] = {}
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self._positions
+
+    def _append_record(self, record: Dict[str, Any]):
+        self._positions[record["id"]] = len(self.records)
+        self.records.append(record)
+        self.documents.append(
+            Document(
+                id=record["id"],
+                page_content=record["content"],
+                metadata=record.get("metadata") or {},
+            )
+        )
+
+    def add_documents(
+        self, documents: Iterable[Document], ids: Optional[List[str]] = None
+    ) -> int:
+        """Indexes the chunks that are not indexed yet, returns how many were added"""
+        documents = list(documents)
+        ids = ids or [chunk_id(document) for document in documents]
+
+        new_postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        new_lengths = []
+
+        for id_, document in zip(ids, documents):
+            if id_ in self._positions:
+                continue
+
+            position = len(self.records)
+            self._append_record(
+                {
+                    "id": id_,
+                    "content": document.page_content,
+                    "metadata": document.metadata,
+                }
+            )
+
+            tokens = tokenize(document.page_content)
+            new_lengths.append(len(tokens))
+
+            frequencies: Dict[str, int] = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, frequency in frequencies.items():
+                positions, tfs = new_postings.setdefault(token, ([], []))
+                positions.append(position)
+                tfs.append(min(frequency, np.iinfo(np.uint16).max))
+
+        for token, (positions, tfs) in new_postings.items():
+            old_positions, old_tfs = self._postings.get(
+                token, (np.empty(0, np.int32), np.empty(0, np.uint16))
+            )
+            self._postings[token] = (
+                np.concatenate([old_positions, np.asarray(positions, np.int32)]),
+                np.concatenate([old_tfs, np.asarray(tfs, np.uint16)]),
+            )
+
+        self.doc_lengths = np.concatenate(
+            [self.doc_lengths, np.asarray(new_lengths, np.float32)]
+        )
+
+        return len(new_lengths)
+
+    def update_metadata(
+        self, documents: Iterable[Document], ids: Optional[List[str]] = None
+    ) -> int:
+        """Replaces the metadata of indexed chunks, returns how many changed"""
+        documents = list(documents)
+        ids = ids or [chunk_id(document) for document in documents]
+
+        updated = 0
+        for id_, document in zip(ids, documents):
+            position = self._positions.get(id_)
+            if position is None or self.records[position]["metadata"] == (
+                document.metadata
+            ):
+                continue
+            self.records[position]["metadata"] = document.metadata
+            self.documents[position] = Document(
+                id=id_,
+                page_content=self.records[position]["content"],
+                metadata=document.metadata,
+            )
+            updated += 1
+        return updated
+
+    def remove_documents(self, ids: Iterable[str]) -> int:
+        """Drops the given chunks, returns how many were indexed"""
+        removed = set(ids) & self._positions.keys()
+        if not removed:
+            return 0
+
+        # Positions are dense, so the postings are rebuilt from the kept chunks
+        kept = [record for record in self.records if record["id"] not in removed]
+        rebuilt = BM25Index(self.k1, self.b)
+        rebuilt.add_documents(
+            [
+                Document(
+                    page_content=record["content"],
+                    metadata=record.get("metadata") or {},
+                )
+                for record in kept
+            ],
+            ids=[record["id"] for record in kept],
+        )
+        self.__dict__.update(rebuilt.__dict__)
+        return len(removed)
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[Document, float]]:
+        if len(self) == 0:
+            return []
+
+        scores = np.zeros(len(self), dtype=np.float32)
+        average_length = float(self.doc_lengths.mean()) or 1.0
+        length_norm = self.k1 * (
+            1 - self.b + self.b * self.doc_lengths / average_length
+        )
+
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            positions, tfs = postings
+            idf = math.log(
+                1 + (len(self) - len(positions) + 0.5) / (len(positions) + 0.5)
+            )
+            tfs = tfs.astype(np.float32)
+            scores[positions] += (
+                idf * tfs * (self.k1 + 1) / (tfs + length_norm[positions])
+            )
+
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return []
+
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.documents[position], float(scores[position])) for position in top]
+
+    def save(self, path: str = LEXICAL_INDEX_PATH):
+        os.makedirs(path, exist_ok=True)
+
+        terms = sorted(self._postings)
+        sizes = [len(self._postings[term][0]) for term in terms]
+        empty = (np.empty(0, np.int32), np.empty(0, np.uint16))
+
+        postings_tmp = os.path.join(path, POSTINGS_FILE + ".tmp")
+        documents_tmp = os.path.join(path, DOCUMENTS_FILE + ".tmp")
+        with open(postings_tmp, "wb") as f:
+            np.savez_compressed(
+                f,
+                terms=np.asarray(terms, dtype=str),
+                offsets=np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+                positions=np.concatenate(
+                    [self._postings[term][0] for term in terms] or [empty[0]]
+                ),
+                tfs=np.concatenate(
+                    [self._postings[term][1] for term in terms] or [empty[1]]
+                ),
+                doc_lengths=self.doc_lengths,
+            )
+        with open(documents_tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"k1": self.k1, "b": self.b, "records": self.records},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(postings_tmp, os.path.join(path, POSTINGS_FILE))
+        os.replace(documents_tmp, os.path.join(path, DOCUMENTS_FILE))
+
+    @classmethod
+    def load(cls, path: str = LEXICAL_INDEX_PATH) -> "BM25Index":
+        with open(os.path.join(path, DOCUMENTS_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+
+        index = cls(k1=data["k1"], b=data["b"])
+        for record in data["records"]:
+            index._append_record(record)
+
+        postings = np.load(os.path.join(path, POSTINGS_FILE))
+        offsets = postings["offsets"]
+        positions, tfs = postings["positions"], postings["tfs"]
+        for i, term in enumerate(postings["terms"].tolist()):
+            index._postings[term] = (
+                positions[offsets[i] : offsets[i + 1]],
+                tfs[offsets[i] : offsets[i + 1]],
+            )
+        index.doc_lengths = postings["doc_lengths"]
+
+        return index
+
+
+def load_or_create_index(path: str = LEXICAL_INDEX_PATH) -> BM25Index:
+    if os.path.exists(os.path.join(path, DOCUMENTS_FILE)):
+        return BM25Index.load(path)
+    return BM25Index()
+
+
+def update_lexical_index(
+    documents: List[Document], path: str = LEXICAL_INDEX_PATH
+) -> int:
+    """Adds newly ingested chunks to the persisted index"""
+    index = load_or_create_index(path)
+    added = index.add_documents(documents)
+    if added:
+        index.save(path)
+    return added
+
+
+_index_lock = threading.Lock()
+_index: Optional[BM25Index] = None
+_index_mtime: Optional[float] = None
+
+
+def get_lexical_index(path: str = LEXICAL_INDEX_PATH) -> Optional[BM25Index]:
+    """Returns the process-wide index, or None if it was never built"""
+    global _index, _index_mtime
+
+    documents_path = os.path.join(path, DOCUMENTS_FILE)
+    if not os.path.exists(documents_path):
+        return None
+
+    mtime = os.path.getmtime(documents_path)
+    with _index_lock:
+        if _index is None or _index_mtime != mtime:
+            _index = BM25Index.load(path)
+            _index_mtime = mtime
+        return _index
+
+
+def lexical_search_many(queries: List[str], k: int = 5) -> List[List[Document]]:
+    index = get_lexical_index()
+    if index is None:
+        return [[] for _ in queries]
+    return [[doc for doc, _ in index.search(query, k=k)] for query in queries]
+
+
+if __name__ == "__main__":
+    # Build the index from the exported local vector index
+    from embeddings.local_index import get_local_index
+
+    local_index = get_local_index()
+    index = load_or_create_index()
+    added = index.add_documents(local_index.documents)
+    index.save()
+    print(f"Indexed {added} new chunks, {len(index)} in total")
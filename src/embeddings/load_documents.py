@@ -1,24 +1,31 @@
-import base64
-import io
 import os
-from typing import Any
+import sys
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-import fitz
-import torch
-from docling_core.types.doc import DoclingDocument
-from docling_core.types.doc.document import DocTagsDocument
 from dotenv import load_dotenv
 from langchain_community.vectorstores import SupabaseVectorStore
 from langchain_core.documents import Document
-from langchain_text_splitters import (
-    MarkdownHeaderTextSplitter,
-    RecursiveCharacterTextSplitter,
-)
-from PIL import Image
 from supabase import Client, create_client
-from transformers import AutoModelForVision2Seq, AutoProcessor
 
+from src.embeddings.docling_engine import doctags_to_markdown, get_docling_engine
+from src.embeddings.lexical_index import chunk_id, load_or_create_index
+from src.embeddings.local_index import (
+    LOCAL_INDEX_PATH,
+    index_exists,
+    update_local_index,
+)
+from src.embeddings.manifest import (
+    IngestManifest,
+    PageRecord,
+    chunk_uuid,
+    publish_version,
+)
+from src.embeddings.page_source import PageRaster, PageSource, file_hash
+from src.embeddings.sections import Carry, split_page_markdown
 from src.lib.llm import AkashModels, get_akash_embedding_model
+from src.lib.pipeline import run_pipeline
 
 load_dotenv()
 
@@ -34,135 +41,439 @@ if not SUPABASE_API_URL or not SUPABASE_API_KEY:
 
 supabase_client: Client = create_client(SUPABASE_API_URL, SUPABASE_API_KEY)
 
-# Initialize the model
-# Refer to: https://huggingface.co/ds4sd/SmolDocling-256M-preview
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-print("Device: ", DEVICE)
-
-processor = AutoProcessor.from_pretrained("ds4sd/SmolDocling-256M-preview")
-
-model = AutoModelForVision2Seq.from_pretrained(
-    "ds4sd/SmolDocling-256M-preview",
-    torch_dtype=torch.bfloat16,
-).to(DEVICE)
-
-
-def pdf_page_to_base64(pdf_document: Any, page_number: int):
-    page = pdf_document.load_page(page_number - 1)  # input is one-indexed
-    pix = page.get_pixmap()
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-
-    return base64.b64encode(buffer.getvalue())
-
-
-def get_pdf_as_image_list(pdf_path: str) -> list[bytes]:
-    pdf_document = fitz.open(pdf_path)
-
-    return [
-        pdf_page_to_base64(pdf_document, page_number)
-        for page_number in range(pdf_document.page_count)
-    ]
-
-
-def get_docling_md_from_imgs(images_list: list[bytes]) -> DoclingDocument:
-    # Prepare inputs
-    images = [
-        Image.open(io.BytesIO(base64.b64decode(image_bytes)))
-        for image_bytes in images_list
-    ]
-
-    all_doctags = []
-
-    # Process each image individually
-    for img in images:
-        # Create input messages for each image
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image"},
-                    {"type": "text", "text": "Convert this page to docling."},
-                ],
-            },
-        ]
-
-        prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
-        inputs = processor(text=prompt, images=img, return_tensors="pt")
-        inputs = inputs.to(DEVICE)
-
-        # Generate outputs
-        generated_ids = model.generate(**inputs, max_new_tokens=8192)
-        prompt_length = inputs.input_ids.shape[1]
-        trimmed_generated_ids = generated_ids[:, prompt_length:]
-
-        doctag = processor.batch_decode(
-            trimmed_generated_ids,
-            skip_special_tokens=False,
-        )[0].lstrip()
-
-        all_doctags.append(doctag)
-
-    # Create a docling document
-    doctags_doc = DocTagsDocument.from_doctags_and_image_pairs(all_doctags, images)
-    doc = DoclingDocument(name="Document")
-
-    doc.load_from_doctags(doctags_doc)
-
-    return doc.export_to_markdown()
-
-
-def split_markdown(md: str) -> list[Document]:
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-    ]
-
-    # MD splits
-    markdown_splitter = MarkdownHeaderTextSplitter(
-        headers_to_split_on=headers_to_split_on, strip_headers=False
-    )
-    md_header_splits = markdown_splitter.split_text(md)
-
-    chunk_size = 1000
-    chunk_overlap = 100
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+PDFS_PATH = os.getenv("PDFS_PATH", "./pdfs")
+# Items waiting between two ingestion stages, which bounds the memory in use
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64"))
+
+
+@dataclass
+class PdfPage:
+    source: str
+    # One-indexed
+    number: int
+    page_count: int
+    pdf_hash: str = ""
+    page_hash: str = ""
+    # Pages whose raster matches the manifest skip docling, split and embed
+    unchanged: bool = False
+    # Raster until the page is converted, then its markdown
+    image: Optional[PageRaster] = None
+    markdown: str = ""
+    # Unfinished section the page ends with, and the key of the one it
+    # continues. Recorded in the manifest for unchanged pages
+    carry: Carry = field(default_factory=Carry)
+    carry_in: str = ""
+    documents: List[Document] = field(default_factory=list)
+    # Embeddings of the chunks the vector table doesn't have yet, by chunk id
+    vectors: Dict[str, List[float]] = field(default_factory=dict)
+
+
+class ChunkStore:
+    """
+    The vector table and the BM25 index, written together, and the local
+    vector index when one was exported on this host
+    """
+
+    def __init__(self, local_index_path: str = LOCAL_INDEX_PATH):
+        self.vector_store = SupabaseVectorStore(
+            client=supabase_client,
+            embedding=embedding_function,
+            table_name=table_name,
+            query_name=query_name,
+        )
+        self.lexical_index = load_or_create_index()
+
+        self.local_index_path: Optional[str] = None
+        if index_exists(local_index_path):
+            self.local_index_path = local_index_path
+        # Local index changes by row id, written by `flush`
+        self._local_added: Dict[str, Tuple[Document, List[float]]] = {}
+        self._local_removed: Set[str] = set()
+        self._local_metadatas: Dict[str, Dict[str, Any]] = {}
+
+    def upsert(self, documents: List[Document], vectors: List[List[float]]):
+        """Inserts or overwrites the chunks under their deterministic ids"""
+        if not documents:
+            return
+        ids = [document.metadata["chunk_id"] for document in documents]
+        self.vector_store.add_vectors(
+            vectors, documents, ids=[chunk_uuid(id_) for id_ in ids]
+        )
+        # Keep the BM25 index in sync with the embedded chunks
+        if self.lexical_index.add_documents(documents, ids=ids):
+            self.lexical_index.save()
+        if self.local_index_path:
+            for id_, document, vector in zip(ids, documents, vectors):
+                self._local_removed.discard(chunk_uuid(id_))
+                self._local_added[chunk_uuid(id_)] = (document, vector)
+
+    def update_metadata(self, documents: List[Document]):
+        """
+        Rewrites the metadata of stored chunks in place, for chunks whose
+        page or section changed while their text (and vector) didn't
+        """
+        if not documents:
+            return
+        ids = [document.metadata["chunk_id"] for document in documents]
+        for batch in batched(list(zip(ids, documents)), 500):
+            # Upserting without the embedding column leaves the vectors alone
+            supabase_client.table(table_name).upsert(
+                [
+                    {
+                        "id": chunk_uuid(id_),
+                        "content": document.page_content,
+                        "metadata": document.metadata,
+                    }
+                    for id_, document in batch
+                ]
+            ).execute()
+        if self.lexical_index.update_metadata(documents, ids=ids):
+            self.lexical_index.save()
+        if self.local_index_path:
+            for id_, document in zip(ids, documents):
+                if chunk_uuid(id_) in self._local_added:
+                    self._local_added[chunk_uuid(id_)] = (
+                        document,
+                        self._local_added[chunk_uuid(id_)][1],
+                    )
+                else:
+                    self._local_metadatas[chunk_uuid(id_)] = document.metadata
+
+    def delete(self, chunk_ids: List[str]):
+        if not chunk_ids:
+            return
+        for batch in batched(chunk_ids, 500):
+            supabase_client.table(table_name).delete().in_(
+                "id", [chunk_uuid(id_) for id_ in batch]
+            ).execute()
+        if self.lexical_index.remove_documents(chunk_ids):
+            self.lexical_index.save()
+        if self.local_index_path:
+            for id_ in chunk_ids:
+                self._local_added.pop(chunk_uuid(id_), None)
+                self._local_metadatas.pop(chunk_uuid(id_), None)
+                self._local_removed.add(chunk_uuid(id_))
+
+    def flush(self):
+        """
+        Writes the pending changes to the local index. New rows are added to
+        its ANN index incrementally instead of rebuilding it
+        """
+        if not (self._local_added or self._local_removed or self._local_metadatas):
+            return
+        added = list(self._local_added.items())
+        update_local_index(
+            self.local_index_path,
+            ids=[id_ for id_, _ in added],
+            contents=[document.page_content for _, (document, _) in added],
+            metadatas=[document.metadata for _, (document, _) in added],
+            embeddings=[vector for _, (_, vector) in added],
+            removed_ids=self._local_removed,
+            updated_metadatas=self._local_metadatas,
+        )
+        self._local_added.clear()
+        self._local_removed.clear()
+        self._local_metadatas.clear()
+
+    def delete_legacy_rows(self) -> int:
+        """Rows inserted before chunks had deterministic ids"""
+        res = (
+            supabase_client.table(table_name)
+            .delete()
+            .is_("metadata->>chunk_id", "null")
+            .execute()
+        )
+        return len(res.data)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def render_pages(
+    pdf_paths: Iterable[str], manifest: IngestManifest
+) -> Iterator[PdfPage]:
+    """Pages of every changed PDF, rendered one at a time"""
+    for pdf_path in pdf_paths:
+        source = os.path.basename(pdf_path)
+        pdf_hash = file_hash(pdf_path)
+        if manifest.document_hash(source) == pdf_hash:
+            print(f"Skipping {source}, unchanged since the last ingestion")
+            continue
+
+        pages = PageSource(pdf_path)
+        for page_number, raster in pages:
+            page_hash = raster.content_hash()
+            recorded = manifest.page(source, page_number)
+            unchanged = is_unchanged(recorded, page_hash)
+            page = PdfPage(
+                source=source,
+                number=page_number,
+                page_count=pages.page_count,
+                pdf_hash=pdf_hash,
+                page_hash=page_hash,
+                image=None if unchanged else raster,
+            )
+            if unchanged:
+                restore_page(page, recorded)
+            yield page
+        pages.close()
+
+
+def is_unchanged(recorded: Optional[PageRecord], page_hash: str) -> bool:
+    """
+    Whether the page can skip docling. Pages recorded without their markdown
+    are converted again, since they can't be split again without it
+    """
+    return (
+        recorded is not None
+        and recorded.page_hash == page_hash
+        and recorded.markdown is not None
     )
 
-    # Split
-    splits = text_splitter.split_documents(md_header_splits)
 
-    # Avoid splits with less than 100 characters
-    return [doc for doc in splits if len(doc.page_content.strip()) >= 100]
+def restore_page(page: PdfPage, recorded: PageRecord):
+    """Marks the page unchanged, with the markdown and carry of the manifest"""
+    page.unchanged = True
+    page.markdown = recorded.markdown or ""
+    page.carry = Carry(headers=recorded.headers, **recorded.carry)
+    page.carry_in = recorded.carry_in
 
 
-def embed_pdfs(documents: list[Document]):
-    vector_db = SupabaseVectorStore.from_documents(
-        client=supabase_client,
-        table_name=table_name,
-        query_name=query_name,
-        documents=documents,
-        embedding=embedding_function,
+def page_record(page: PdfPage) -> PageRecord:
+    return PageRecord(
+        page_hash=page.page_hash,
+        headers=page.carry.headers,
+        markdown=page.markdown,
+        carry={"text": page.carry.text, "page": page.carry.page},
+        carry_in=page.carry_in,
     )
 
-    return vector_db
 
+def convert_batch(engine: Any, pages: List[PdfPage]) -> List[PdfPage]:
+    changed = [page for page in pages if not page.unchanged]
+    if changed:
+        # The processor reads the rasters in place
+        all_doctags = engine.convert(
+            [page.image.array for page in changed], name=changed[0].source
+        )
+        for page, doctags in zip(changed, all_doctags):
+            # Docling crops the pictures of the page from a PIL copy
+            page.markdown = doctags_to_markdown([doctags], [page.image.to_image()])
+            page.image = None
+    return pages
+
+
+def convert_pages(pages: Iterator[PdfPage]) -> Iterator[PdfPage]:
+    """Pages with their markdown, converted in batches of the docling engine"""
+    engine = get_docling_engine()
+    pending: List[PdfPage] = []
+    for page in pages:
+        pending.append(page)
+        if sum(not page.unchanged for page in pending) == engine.batch_size:
+            yield from convert_batch(engine, pending)
+            pending = []
+    yield from convert_batch(engine, pending)
+
+
+def split_pages(pages: Iterator[PdfPage]) -> Iterator[PdfPage]:
+    """
+    Pages with their chunks, tagged with section, source, page and chunk id.
+    An unchanged page is split again from its recorded markdown when the
+    section it continues changed
+    """
+    carry = Carry()
+    for page in pages:
+        if page.number == 1:
+            carry = Carry()
+
+        carry_in = carry.key()
+        if page.unchanged and page.carry_in == carry_in:
+            carry = page.carry
+        else:
+            page.unchanged = False
+            page.carry_in = carry_in
+            page.documents, carry = split_page_markdown(
+                page.markdown, carry, page.number, page.number == page.page_count
+            )
+            page.carry = carry
+            for document in page.documents:
+                document.metadata["source"] = page.source
+                document.metadata["chunk_id"] = chunk_id(document)
+        yield page
+
+
+def embed_batch(pages: List[PdfPage], manifest: IngestManifest) -> List[PdfPage]:
+    documents = {
+        document.metadata["chunk_id"]: document
+        for page in pages
+        for document in page.documents
+    }
+    stored = manifest.stored_chunks(documents)
+    missing = [id_ for id_ in documents if id_ not in stored]
+    if missing:
+        vectors = dict(
+            zip(
+                missing,
+                embedding_function.embed_documents(
+                    [documents[id_].page_content for id_ in missing]
+                ),
+            )
+        )
+        for page in pages:
+            page.vectors = {
+                document.metadata["chunk_id"]: vectors[document.metadata["chunk_id"]]
+                for document in page.documents
+                if document.metadata["chunk_id"] in vectors
+            }
+    return pages
+
+
+def embed_pages(
+    pages: Iterator[PdfPage], manifest: IngestManifest
+) -> Iterator[PdfPage]:
+    """Pages with the embeddings of the chunks the vector table doesn't have"""
+    pending: List[PdfPage] = []
+    for page in pages:
+        pending.append(page)
+        if sum(len(page.documents) for page in pending) >= INGEST_EMBED_BATCH_SIZE:
+            yield from embed_batch(pending, manifest)
+            pending = []
+    yield from embed_batch(pending, manifest)
+
+
+def upsert_pages(
+    pages: Iterator[PdfPage], manifest: IngestManifest, store: ChunkStore
+) -> Iterator[int]:
+    """
+    Stores the new chunks of every page, deletes the ones it no longer has
+    and records it in the manifest. Returns the number of chunks stored
+    """
+    stored = deleted = unchanged = 0
+    for page in pages:
+        if page.number == 1:
+            stored = deleted = unchanged = 0
+
+        upserted = 0
+        if page.unchanged:
+            unchanged += 1
+        else:
+            documents = {
+                document.metadata["chunk_id"]: document for document in page.documents
+            }
+            # Chunks another page had when this one was embedded may be gone
+            available = manifest.stored_chunks(documents)
+            missing = [
+                id_
+                for id_ in documents
+                if id_ not in page.vectors and id_ not in available
+            ]
+            if missing:
+                page.vectors.update(
+                    zip(
+                        missing,
+                        embedding_function.embed_documents(
+                            [documents[id_].page_content for id_ in missing]
+                        ),
+                    )
+                )
+
+            store.upsert(
+                [documents[id_] for id_ in page.vectors], list(page.vectors.values())
+            )
+            # Stored chunks may now be on another page or in another section
+            store.update_metadata(
+                [documents[id_] for id_ in documents if id_ not in page.vectors]
+            )
+            stale = manifest.stale_page_chunks(page.source, page.number, documents)
+            store.delete(stale)
+            manifest.replace_page(
+                page.source, page.number, page_record(page), documents
+            )
+            upserted = len(page.vectors)
+            stored += upserted
+            deleted += len(stale)
+
+        if page.number == page.page_count:
+            # Pages the previous version of the PDF had after its last one
+            stale = manifest.stale_document_chunks(page.source, page.page_count)
+            store.delete(stale)
+            manifest.finish_document(page.source, page.pdf_hash, page.page_count)
+            store.flush()
+            deleted += len(stale)
+            print(
+                f"{page.source}: {stored} chunks stored, {deleted} deleted, "
+                f"{unchanged} of {page.page_count} pages unchanged"
+            )
+
+        yield upserted
+
+
+def prune_removed_pdfs(
+    pdf_paths: List[str], manifest: IngestManifest, store: ChunkStore
+):
+    """Deletes the chunks of the ingested PDFs that are not in `pdf_paths`"""
+    current = {os.path.basename(pdf_path) for pdf_path in pdf_paths}
+    for source in manifest.sources():
+        if source not in current:
+            stale = manifest.stale_document_chunks(source)
+            store.delete(stale)
+            manifest.remove_document(source)
+            print(f"{source}: removed, {len(stale)} chunks deleted")
+    store.flush()
+
+
+def ingest_pdfs(pdf_paths: Iterable[str], prune: bool = False) -> int:
+    """
+    Streams the PDFs through render -> docling -> split -> embed -> upsert.
+    Only the items in the stage queues are held in memory, and every page is
+    recorded in the manifest once its chunks are stored, so unchanged PDFs and
+    pages are skipped on the next run. With `prune`, the chunks of PDFs that
+    are not in `pdf_paths` anymore are deleted
+    """
+    pdf_paths = list(pdf_paths)
+    manifest = IngestManifest()
+    store = ChunkStore()
+
+    if prune:
+        prune_removed_pdfs(pdf_paths, manifest, store)
+
+    total = 0
+    for count in run_pipeline(
+        render_pages(pdf_paths, manifest),
+        [
+            convert_pages,
+            split_pages,
+            partial(embed_pages, manifest=manifest),
+            partial(upsert_pages, manifest=manifest, store=store),
+        ],
+        queue_sizes=INGEST_QUEUE_SIZE,
+    ):
+        total += count
+
+    publish_version(supabase_client, manifest.version())
+    manifest.close()
+    return total
 
-if __name__ == "__main__":
-    pdfs_files_paths = os.listdir("./pdfs")
 
-    documents = []
+if __name__ == "__main__":
+    pdfs_paths = [
+        os.path.join(PDFS_PATH, pdf_file_path)
+        for pdf_file_path in sorted(os.listdir(PDFS_PATH))
+    ]
 
-    for pdf_file_path in pdfs_files_paths:
-        pdf_path = os.path.join("./pdfs", pdf_file_path)
-        markdown_text = get_docling_md_from_imgs(get_pdf_as_image_list(pdf_path))
-        splitted_documents = split_markdown(markdown_text)
-        documents.extend(splitted_documents)
-        print(f"Loaded {len(splitted_documents)} documents from {pdf_file_path}")
+    total = ingest_pdfs(pdfs_paths, prune=True)
+    print(f"Stored {total} new chunks in total")
 
-    # Embed documents
-    embed_pdfs(documents)
-    print(f"Loaded {len(documents)} documents in total")
+    if "--delete-legacy" in sys.argv[1:]:
+        # Rows of the ingestions that predate the manifest duplicate the
+        # chunks stored above
+        print(f"Deleted {ChunkStore().delete_legacy_rows()} legacy rows")
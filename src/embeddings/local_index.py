@@ -0,0 +1,484 @@
+"""
+In-process vector index over the chunk embeddings.
+
+The vectors live in a memory-mapped float32 `.npy` matrix with L2-normalized
+rows, so cosine similarity for a batch of queries is a single matrix multiply.
+The chunk contents and metadata are stored next to it in a documents JSON.
+Every write creates a new generation of both files and then atomically
+replaces `index.json`, which names the current pair, so readers never mix
+the vectors of one generation with the documents of another. The optional
+ANN file records the version (content hash) of the documents it was built
+for, and is ignored when they differ.
+
+Export the Supabase `documents` table with the command below. Once an index
+exists, only the rows added since are downloaded with their vectors, the
+rows deleted since are dropped and the rest only refresh their metadata:
+
+    python -m embeddings.local_index export
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", ".cache/local_index")
+
+# Names the current generation of the two files below
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.json"
+ANN_FILE = "ann_ivf.npz"
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def documents_version(data: bytes) -> str:
+    """Version of a `documents.json`, the hash of its content"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def index_files(path: str) -> Optional[Tuple[str, str]]:
+    """
+    Vectors and documents files of the current generation of the index at
+    `path`, None when there is no index. Indexes written before generations
+    were introduced are read from their fixed file names
+    """
+    try:
+        with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as f:
+            current = json.load(f)
+        return (
+            os.path.join(path, current["vectors"]),
+            os.path.join(path, current["documents"]),
+        )
+    except FileNotFoundError:
+        legacy = (
+            os.path.join(path, VECTORS_FILE),
+            os.path.join(path, DOCUMENTS_FILE),
+        )
+        return legacy if all(os.path.exists(file) for file in legacy) else None
+
+
+def index_exists(path: str) -> bool:
+    return index_files(path) is not None
+
+
+def parse_embedding(embedding: Any) -> List[float]:
+    """Supabase returns pgvector columns as their string representation"""
+    if isinstance(embedding, str):
+        return json.loads(embedding)
+    return embedding
+
+
+class LocalVectorIndex:
+    """Exact cosine top-k search over a memory-mapped embedding matrix"""
+
+    def __init__(
+        self, vectors: np.ndarray, records: List[Dict[str, Any]], ann: Any = None
+    ):
+        if len(vectors) != len(records):
+            raise ValueError("Every vector must have a matching document record")
+
+        self.vectors = vectors
+        self.records = records
+        # Optional `IVFIndex` over the row positions, used for unfiltered searches
+        self.ann = ann
+        if ann is not None:
+            ann.attach(vectors)
+        self.documents = [
+            Document(
+                id=str(record["id"]),
+                page_content=record["content"],
+                metadata=record.get("metadata") or {},
+            )
+            for record in records
+        ]
+        self._positions: Optional[Dict[str, int]] = None
+        # Content hash of the documents file, set by `load`
+        self.version = ""
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def vectors_by_id(self, ids: Iterable[str]) -> Dict[str, List[float]]:
+        """Stored (normalized) vectors of the given record ids that exist"""
+        if self._positions is None:
+            self._positions = {
+                str(record["id"]): position
+                for position, record in enumerate(self.records)
+            }
+        positions = {id_: self._positions.get(id_) for id_ in ids}
+        return {
+            id_: self.vectors[position].tolist()
+            for id_, position in positions.items()
+            if position is not None
+        }
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1] if self.vectors.ndim == 2 else 0
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        ids: List[str],
+        contents: List[str],
+        metadatas: List[Dict[str, Any]],
+        embeddings: List[List[float]],
+    ) -> "LocalVectorIndex":
+        """Writes a new index to `path` and returns it memory-mapped"""
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        records = [
+            {"id": str(id_), "content": content, "metadata": metadata or {}}
+            for id_, content, metadata in zip(ids, contents, metadatas)
+        ]
+        write_index_files(path, vectors, records)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str, retries: int = 3) -> "LocalVectorIndex":
+        for attempt in range(retries + 1):
+            files = index_files(path)
+            if files is None:
+                raise FileNotFoundError(f"No local index at {path}")
+            try:
+                vectors = np.load(files[0], mmap_mode="r")
+                with open(files[1], "rb") as f:
+                    data = f.read()
+                break
+            except FileNotFoundError:
+                # A writer removed the generation named by the pointer we
+                # read, the pointer now names a newer one
+                if attempt == retries:
+                    raise
+        records = json.loads(data)
+        version = documents_version(data)
+
+        ann = None
+        ann_path = os.path.join(path, ANN_FILE)
+        if os.path.exists(ann_path):
+            from embeddings.ann_index import IVFIndex
+
+            ann = IVFIndex.load(ann_path)
+            # An index built from another export would point at the wrong rows
+            if ann.version != version or len(ann) != len(records):
+                ann = None
+
+        index = cls(vectors, records, ann)
+        index.version = version
+        return index
+
+    def _filter_mask(self, filter: Dict[str, Any]) -> np.ndarray:
+        """Rows whose metadata matches every key of the filter"""
+
+        def matches(metadata: Dict[str, Any]) -> bool:
+            for key, value in filter.items():
+                if isinstance(value, dict) and "$in" in value:
+                    if metadata.get(key) not in value["$in"]:
+                        return False
+                elif metadata.get(key) != value:
+                    return False
+            return True
+
+        return np.fromiter(
+            (matches(document.metadata) for document in self.documents),
+            dtype=bool,
+            count=len(self.documents),
+        )
+
+    def search_many(
+        self,
+        query_vectors: List[List[float]],
+        k: int = 5,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Top-k documents and cosine similarities for every query vector"""
+        if len(self) == 0 or len(query_vectors) == 0:
+            return [[] for _ in query_vectors]
+
+        if self.ann is not None and not filter:
+            ids, scores = self.ann.search(np.asarray(query_vectors), k=k)
+            return [
+                [
+                    (self.documents[index], float(score))
+                    for index, score in zip(row_ids, row_scores)
+                    if index >= 0
+                ]
+                for row_ids, row_scores in zip(ids.tolist(), scores.tolist())
+            ]
+
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        scores = queries @ self.vectors.T
+
+        if filter:
+            mask = self._filter_mask(filter)
+            scores[:, ~mask] = -np.inf
+            k = min(k, int(mask.sum()))
+
+        k = min(k, len(self))
+        if k <= 0:
+            return [[] for _ in query_vectors]
+
+        # argpartition finds the k best in O(n), only those k are sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [
+            [
+                (self.documents[index], float(score))
+                for index, score in zip(row_indexes, row_scores)
+            ]
+            for row_indexes, row_scores in zip(top.tolist(), top_scores.tolist())
+        ]
+
+
+def write_index_files(
+    path: str, vectors: np.ndarray, records: List[Dict[str, Any]]
+) -> str:
+    """
+    Replaces the vectors and documents of the index at `path` with a new
+    generation of both, and returns the version of the documents
+    """
+    os.makedirs(path, exist_ok=True)
+    previous = index_files(path)
+
+    # Nothing reads the new files until the pointer names them
+    generation = uuid.uuid4().hex
+    vectors_name = f"vectors-{generation}.npy"
+    documents_name = f"documents-{generation}.json"
+    with open(os.path.join(path, vectors_name), "wb") as f:
+        np.save(f, np.asarray(vectors, dtype=np.float32))
+    data = json.dumps(records, ensure_ascii=False).encode("utf-8")
+    with open(os.path.join(path, documents_name), "wb") as f:
+        f.write(data)
+
+    pointer_tmp = os.path.join(path, INDEX_FILE + ".tmp")
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        json.dump({"vectors": vectors_name, "documents": documents_name}, f)
+    os.replace(pointer_tmp, os.path.join(path, INDEX_FILE))
+
+    # The previous generation stays for readers that already hold its
+    # pointer, older ones are removed
+    keep = {vectors_name, documents_name}
+    keep.update(os.path.basename(file) for file in previous or ())
+    for pattern in ("vectors-*.npy", "documents-*.json", VECTORS_FILE, DOCUMENTS_FILE):
+        for file in glob.glob(os.path.join(path, pattern)):
+            if os.path.basename(file) not in keep:
+                os.remove(file)
+
+    return documents_version(data)
+
+
+def update_local_index(
+    path: str = LOCAL_INDEX_PATH,
+    ids: Iterable[str] = (),
+    contents: Iterable[str] = (),
+    metadatas: Iterable[Dict[str, Any]] = (),
+    embeddings: Iterable[List[float]] = (),
+    removed_ids: Iterable[str] = (),
+    updated_metadatas: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> LocalVectorIndex:
+    """
+    Adds and removes rows of the index at `path`. Rows with an id the index
+    already has replace it, and `updated_metadatas` replaces the metadata of
+    rows by id, keeping their vectors. The ANN index is updated in place with
+    `IVFIndex.add`, without retraining its centroids
+    """
+    index = None
+    if index_exists(path):
+        index = LocalVectorIndex.load(path)
+    if index is None or len(index) == 0:
+        return LocalVectorIndex.build(
+            path, list(ids), list(contents), list(metadatas), list(embeddings)
+        )
+
+    new_records = [
+        {"id": str(id_), "content": content, "metadata": metadata or {}}
+        for id_, content, metadata in zip(ids, contents, metadatas)
+    ]
+    new_vectors = normalize_rows(
+        np.asarray(list(embeddings), dtype=np.float32).reshape(
+            len(new_records), index.dimension
+        )
+    )
+
+    dropped = {str(id_) for id_ in removed_ids}
+    dropped.update(record["id"] for record in new_records)
+    keep = np.fromiter(
+        (record["id"] not in dropped for record in index.records),
+        dtype=bool,
+        count=len(index),
+    )
+    updated_metadatas = {
+        id_: metadata
+        for id_, metadata in (updated_metadatas or {}).items()
+        if id_ not in dropped
+    }
+    if not new_records and keep.all() and not updated_metadatas:
+        return index
+
+    records = [
+        {**record, "metadata": updated_metadatas[record["id"]]}
+        if record["id"] in updated_metadatas
+        else record
+        for record, kept in zip(index.records, keep)
+        if kept
+    ] + new_records
+    vectors = np.concatenate([index.vectors[keep], new_vectors])
+
+    ann = index.ann
+    if ann is not None:
+        # Row positions shift when rows are removed
+        positions = np.full(len(index), -1, dtype=np.int64)
+        positions[keep] = np.arange(int(keep.sum()))
+        ann.remap(positions)
+        ann.add(new_vectors, np.arange(int(keep.sum()), len(records)))
+
+    version = write_index_files(path, vectors, records)
+    if ann is not None:
+        ann.version = version
+        ann.save(os.path.join(path, ANN_FILE))
+
+    return LocalVectorIndex.load(path)
+
+
+def _mtime(path: str) -> Optional[float]:
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+_index_lock = threading.Lock()
+_index: Optional[LocalVectorIndex] = None
+_index_mtimes: Optional[Tuple[Optional[float], Optional[float]]] = None
+
+
+def get_local_index(path: str = LOCAL_INDEX_PATH) -> LocalVectorIndex:
+    """Returns the process-wide index, reloading it when the files change"""
+    global _index, _index_mtimes
+
+    mtimes = (
+        # Replaced on every write
+        _mtime(os.path.join(path, INDEX_FILE))
+        or os.path.getmtime(os.path.join(path, DOCUMENTS_FILE)),
+        # A rebuilt ANN index is picked up too
+        _mtime(os.path.join(path, ANN_FILE)),
+    )
+    with _index_lock:
+        if _index is None or _index_mtimes != mtimes:
+            _index = LocalVectorIndex.load(path)
+            _index_mtimes = mtimes
+        return _index
+
+
+def fetch_rows(
+    client: Any,
+    table_name: str,
+    columns: str,
+    ids: Optional[List[str]] = None,
+    page_size: int = 1000,
+) -> Iterable[Dict[str, Any]]:
+    """Every row of the table, or the rows with the given ids, page by page"""
+    start = 0
+    while True:
+        query = client.table(table_name).select(columns)
+        if ids is not None:
+            query = query.in_("id", ids)
+        res = query.order("id").range(start, start + page_size - 1).execute()
+        yield from res.data
+
+        if len(res.data) < page_size:
+            break
+        start += page_size
+
+
+def export_from_supabase(
+    client: Any,
+    table_name: str = "documents",
+    path: str = LOCAL_INDEX_PATH,
+    page_size: int = 1000,
+) -> LocalVectorIndex:
+    """
+    Downloads the Supabase table into a local index. When the index already
+    exists, only the rows it is missing are downloaded, the rows deleted from
+    the table are removed from it and the rows whose metadata was rewritten
+    in place (a re-ingested page or section) get the new metadata
+    """
+    existing: Dict[str, Dict[str, Any]] = {}
+    if index_exists(path):
+        existing = {
+            record["id"]: record["metadata"]
+            for record in LocalVectorIndex.load(path).records
+        }
+
+    columns = "id, content, metadata, embedding"
+    updated_metadatas: Dict[str, Dict[str, Any]] = {}
+    if existing:
+        # The metadata is small next to the vectors, so it is compared for
+        # every row instead of tracking when each one changed
+        table_metadatas = {
+            str(row["id"]): row.get("metadata") or {}
+            for row in fetch_rows(
+                client, table_name, "id, metadata", page_size=page_size
+            )
+        }
+        table_ids = set(table_metadatas)
+        updated_metadatas = {
+            id_: metadata
+            for id_, metadata in table_metadatas.items()
+            if id_ in existing and existing[id_] != metadata
+        }
+        new_ids = sorted(table_ids - set(existing))
+        rows = [
+            row
+            for start in range(0, len(new_ids), page_size)
+            for row in fetch_rows(
+                client,
+                table_name,
+                columns,
+                ids=new_ids[start : start + page_size],
+                page_size=page_size,
+            )
+        ]
+        removed_ids = set(existing) - table_ids
+    else:
+        rows = list(fetch_rows(client, table_name, columns, page_size=page_size))
+        removed_ids = set()
+
+    rows = [
+        row for row in rows if row.get("content") and row.get("embedding") is not None
+    ]
+    return update_local_index(
+        path,
+        ids=[row["id"] for row in rows],
+        contents=[row["content"] for row in rows],
+        metadatas=[row.get("metadata") or {} for row in rows],
+        embeddings=[parse_embedding(row["embedding"]) for row in rows],
+        removed_ids=removed_ids,
+        updated_metadatas=updated_metadatas,
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["export"]:
+        print("Usage: python -m embeddings.local_index export")
+        sys.exit(1)
+
+    from embeddings.main import vector_store_registry
+
+    index = export_from_supabase(vector_store_registry.get_client())
+    print(f"Exported {len(index)} documents to {LOCAL_INDEX_PATH}")
@@ -1,41 +1,243 @@
+import asyncio
 import os
 import re
+import threading
+import time
+from dataclasses import dataclass
 
+import numpy as np
 from dotenv import load_dotenv
 from langchain_community.vectorstores import SupabaseVectorStore
-from supabase import Client, create_client
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from supabase import AsyncClient, Client, acreate_client, create_client
 
+from embeddings.local_index import get_local_index, parse_embedding
+from embeddings.manifest import chunk_uuid
+from lib.event_loop import close_on_loop
 from lib.llm import AkashModels, get_akash_embedding_model
+from lib.scheduler import SchedulerError
 
 load_dotenv()
 
 table_name = "documents"
 query_name = "match_documents"
-embedding_function = get_akash_embedding_model(AkashModels.BAAI_BGE_LARGE)
+embedding_model = AkashModels.BAAI_BGE_LARGE
 
 SUPABASE_API_URL = os.getenv("SUPABASE_API_URL")
 SUPABASE_API_KEY = os.getenv("SUPABASE_API_KEY")
+# "supabase" runs match_documents remotely, "local" searches the exported index
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase")
+HEALTH_CHECK_INTERVAL = float(os.getenv("VECTOR_STORE_HEALTH_CHECK_INTERVAL", "300"))
 
 if not SUPABASE_API_URL or not SUPABASE_API_KEY:
     raise ValueError("Supabase URL and API Key must be provided in the .env file")
 
-supabase_client: Client = create_client(SUPABASE_API_URL, SUPABASE_API_KEY)
+
+@dataclass
+class AsyncVectorStore:
+    """Async Supabase client of one event loop, with the table and query it serves"""
+
+    client: AsyncClient
+    table_name: str
+    query_name: str
+    embedding: Embeddings
+
+
+class VectorStoreRegistry:
+    """
+    Process-wide, thread-safe registry of vector stores.
+
+    Keeps one `SupabaseVectorStore` (with its own pooled Supabase client) per
+    (table, query function, embedding model), created lazily on first use.
+    Stores are health checked at most every `health_check_interval` seconds
+    and rebuilt when the check fails. `aget` does the same for the async
+    clients used by the retrieval hot path.
+    """
+
+    def __init__(self, health_check_interval: float = HEALTH_CHECK_INTERVAL):
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._stores: dict[tuple, SupabaseVectorStore] = {}
+        # Supabase client of every store, for the table queries around it
+        self._clients: dict[tuple, Client] = {}
+        self._last_checked: dict[tuple, float] = {}
+        self._async_stores: dict[tuple, AsyncVectorStore] = {}
+
+    @staticmethod
+    def _key(table: str, query: str, model: AkashModels) -> tuple:
+        return (table, query, model.value)
+
+    def _create(
+        self, table: str, query: str, model: AkashModels
+    ) -> tuple[SupabaseVectorStore, Client]:
+        client: Client = create_client(SUPABASE_API_URL, SUPABASE_API_KEY)
+        store = SupabaseVectorStore(
+            client=client,
+            table_name=table,
+            query_name=query,
+            embedding=get_akash_embedding_model(model),
+        )
+        return store, client
+
+    def get(
+        self,
+        table: str = table_name,
+        query: str = query_name,
+        model: AkashModels = embedding_model,
+    ) -> SupabaseVectorStore:
+        key = self._key(table, query, model)
+
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store, client = self._create(table, query, model)
+                self._stores[key] = store
+                self._clients[key] = client
+                self._last_checked[key] = time.monotonic()
+                return store
+
+            if time.monotonic() - self._last_checked[key] < self.health_check_interval:
+                return store
+
+            # Mark it as checked so concurrent callers don't check it too
+            self._last_checked[key] = time.monotonic()
+            client = self._clients[key]
+
+        if not self.is_healthy(client, table):
+            store = self.reconnect(table, query, model)
+
+        return store
+
+    def get_client(
+        self,
+        table: str = table_name,
+        query: str = query_name,
+        model: AkashModels = embedding_model,
+    ) -> Client:
+        """Supabase client of the store `get` returns, health checked with it"""
+        self.get(table, query, model)
+        with self._lock:
+            return self._clients[self._key(table, query, model)]
+
+    @staticmethod
+    def is_healthy(client: Client, table: str) -> bool:
+        try:
+            client.table(table).select("id").limit(1).execute()
+            return True
+        except Exception as e:
+            print(f"Vector store health check failed: {e}")
+            return False
+
+    def reconnect(
+        self,
+        table: str = table_name,
+        query: str = query_name,
+        model: AkashModels = embedding_model,
+    ) -> SupabaseVectorStore:
+        key = self._key(table, query, model)
+        store, client = self._create(table, query, model)
+
+        with self._lock:
+            self._stores[key] = store
+            self._clients[key] = client
+            self._last_checked[key] = time.monotonic()
+
+        return store
+
+    async def _acreate(
+        self, table: str, query: str, model: AkashModels
+    ) -> AsyncVectorStore:
+        client = await acreate_client(SUPABASE_API_URL, SUPABASE_API_KEY)
+        return AsyncVectorStore(
+            client=client,
+            table_name=table,
+            query_name=query,
+            embedding=get_akash_embedding_model(model),
+        )
+
+    async def aget(
+        self,
+        table: str = table_name,
+        query: str = query_name,
+        model: AkashModels = embedding_model,
+    ) -> AsyncVectorStore:
+        """
+        Async counterpart of `get`. Async clients are bound to the event loop
+        that created them, so there is one store per key and running loop
+        """
+        key = (*self._key(table, query, model), asyncio.get_running_loop())
+
+        with self._lock:
+            store = self._async_stores.get(key)
+            if store is not None:
+                elapsed = time.monotonic() - self._last_checked[key]
+                if elapsed < self.health_check_interval:
+                    return store
+                self._last_checked[key] = time.monotonic()
+
+        if store is None:
+            self.close_stale_async_stores()
+            return await self.areconnect(table, query, model)
+
+        if not await self.ais_healthy(store):
+            store = await self.areconnect(table, query, model)
+
+        return store
+
+    @staticmethod
+    async def ais_healthy(store: AsyncVectorStore) -> bool:
+        try:
+            await store.client.table(store.table_name).select("id").limit(1).execute()
+            return True
+        except Exception as e:
+            print(f"Vector store health check failed: {e}")
+            return False
+
+    async def areconnect(
+        self,
+        table: str = table_name,
+        query: str = query_name,
+        model: AkashModels = embedding_model,
+    ) -> AsyncVectorStore:
+        loop = asyncio.get_running_loop()
+        key = (*self._key(table, query, model), loop)
+        store = await self._acreate(table, query, model)
+
+        with self._lock:
+            replaced = self._async_stores.get(key)
+            self._async_stores[key] = store
+            self._last_checked[key] = time.monotonic()
+
+        if replaced is not None:
+            close_on_loop(replaced.client.postgrest.aclose(), loop)
+
+        return store
+
+    def close_stale_async_stores(self):
+        """Closes the clients of the event loops that stopped running"""
+        with self._lock:
+            stale = [key for key in self._async_stores if not key[-1].is_running()]
+            stores = [(key[-1], self._async_stores.pop(key)) for key in stale]
+            for key in stale:
+                self._last_checked.pop(key, None)
+
+        for loop, store in stores:
+            close_on_loop(store.client.postgrest.aclose(), loop)
+
+
+vector_store_registry = VectorStoreRegistry()
 
 
 def load_vector_db():
-    return SupabaseVectorStore(
-        client=supabase_client,
-        table_name=table_name,
-        query_name=query_name,
-        embedding=embedding_function,
-    )
+    return vector_store_registry.get()
 
 
 def get_knowledge_db():
     return load_vector_db()
 
 
-def get_passages(query: str):
+def clean_query(query: str) -> str:
     # Ensure query is a string and clean it
     if not isinstance(query, str):
         query = str(query)
@@ -44,24 +246,169 @@ def get_passages(query: str):
     query = query.strip()
 
     # Remove any non-printable or problematic characters that might cause tokenization issues
-    query = re.sub(r"[^\x20-\x7E]", "", query)
+    return re.sub(r"[^\x20-\x7E]", "", query)
+
+
+def clean_text_query(query: str) -> str:
+    """`clean_query` that keeps accented letters and only drops control characters"""
+    if not isinstance(query, str):
+        query = str(query)
+    return re.sub(r"[\x00-\x1F\x7F-\x9F]", " ", query).strip()
+
 
-    # Ensure it's not empty after cleaning
-    if not query:
-        return []
+async def asimilarity_search_with_score_by_vector(
+    embedding: list[float],
+    k: int = 5,
+    table: str = table_name,
+    query: str = query_name,
+    model: AkashModels = embedding_model,
+) -> list[tuple[Document, float]]:
+    """Documents and cosine similarities returned by the store's query function"""
+    store = await vector_store_registry.aget(table, query, model)
+
+    res = (
+        await store.client.rpc(store.query_name, {"query_embedding": embedding})
+        .limit(k)
+        .execute()
+    )
+
+    return [
+        (
+            Document(
+                id=str(search["id"]) if search.get("id") is not None else None,
+                metadata=search.get("metadata", {}),
+                page_content=search.get("content", ""),
+            ),
+            search.get("similarity", 0.0),
+        )
+        for search in res.data
+        if search.get("content")
+    ]
+
+
+def stored_row_ids(document: Document) -> list[str]:
+    """Row ids of the stored chunks a retrieved passage is made of"""
+    chunk_ids = document.metadata.get("chunk_ids") or [
+        document.metadata.get("chunk_id")
+    ]
+    row_ids = [chunk_uuid(chunk_id) for chunk_id in chunk_ids if chunk_id]
+    if not row_ids and document.id:
+        row_ids = [document.id]
+    return row_ids
+
+
+async def afetch_vectors(documents: list[Document]) -> list[list[float] | None]:
+    """
+    Stored embeddings of the retrieved passages, read by row id instead of
+    embedding the passages again. Merged passages get the mean vector of their
+    chunks, passages without a stored row get None
+    """
+    row_ids = [stored_row_ids(document) for document in documents]
+    wanted = list(dict.fromkeys(id_ for ids in row_ids for id_ in ids))
+    found: dict[str, list[float]] = {}
 
     try:
-        knowledge_db = get_knowledge_db()
+        if wanted and RETRIEVAL_BACKEND == "local":
+            found = get_local_index().vectors_by_id(wanted)
+        elif wanted:
+            store = await vector_store_registry.aget()
+            res = (
+                await store.client.table(store.table_name)
+                .select("id, embedding")
+                .in_("id", wanted)
+                .execute()
+            )
+            found = {
+                str(row["id"]): parse_embedding(row["embedding"])
+                for row in res.data
+                if row.get("embedding") is not None
+            }
+    except Exception as e:
+        print(f"Error in afetch_vectors: {e}")
+        print(f"Error type: {type(e).__name__}")
+
+    vectors: list[list[float] | None] = []
+    for ids in row_ids:
+        rows = [found[id_] for id_ in ids if id_ in found]
+        if not ids or len(rows) != len(ids):
+            vectors.append(None)
+        else:
+            vectors.append(np.mean(np.asarray(rows, dtype=np.float32), axis=0).tolist())
+    return vectors
+
+
+async def aembed_queries(
+    queries: list[str], keep_accents: bool = False
+) -> list[list[float] | None]:
+    """
+    Embeds the cleaned queries in a single call. Queries that are empty after
+    cleaning get None. With `keep_accents`, text written by the student (not
+    the planner's English queries) keeps its non-ASCII letters
+    """
+    clean = clean_text_query if keep_accents else clean_query
+    cleaned_queries = [clean(query) for query in queries]
+    valid_indexes = [i for i, query in enumerate(cleaned_queries) if query]
+    embeddings: list[list[float] | None] = [None for _ in queries]
 
-        # Use the similarity search
-        results = knowledge_db.similarity_search(query, k=5)
+    if valid_indexes:
+        vectors = await get_akash_embedding_model(embedding_model).aembed_documents(
+            [cleaned_queries[i] for i in valid_indexes]
+        )
+        for i, vector in zip(valid_indexes, vectors):
+            embeddings[i] = vector
 
-        return results
+    return embeddings
+
+
+async def asearch_by_vectors(
+    embeddings: list[list[float]], k: int = 5
+) -> list[list[tuple[Document, float]]]:
+    """Scored similarity search of every embedding on the configured backend"""
+    if RETRIEVAL_BACKEND == "local":
+        return get_local_index().search_many(embeddings, k=k)
+
+    return list(
+        await asyncio.gather(
+            *(
+                asimilarity_search_with_score_by_vector(embedding, k=k)
+                for embedding in embeddings
+            )
+        )
+    )
 
+
+async def aget_scored_passages_many(
+    queries: list[str], k: int = 5, keep_accents: bool = False
+) -> list[list[tuple[Document, float]]]:
+    """
+    Scored passages of every query, embedding all of them in a single
+    embedding call before running the similarity searches
+    """
+    results: list[list[tuple[Document, float]]] = [[] for _ in queries]
+
+    try:
+        embeddings = await aembed_queries(queries, keep_accents=keep_accents)
+        valid_indexes = [i for i, vector in enumerate(embeddings) if vector]
+        if not valid_indexes:
+            return results
+
+        passages = await asearch_by_vectors([embeddings[i] for i in valid_indexes], k=k)
+        for i, query_passages in zip(valid_indexes, passages):
+            results[i] = query_passages
+
+    except SchedulerError:
+        # Backpressure is reported to the caller instead of an empty context
+        raise
     except Exception as e:
-        print(f"Error in get_passages: {e}")
+        print(f"Error in aget_scored_passages_many: {e}")
         print(f"Error type: {type(e).__name__}")
 
-        # For now, return empty list to prevent crashes
-        # The application should handle this gracefully
-        return []
+    return results
+
+
+async def aget_passages_many(queries: list[str], k: int = 5) -> list[list[Document]]:
+    """`aget_scored_passages_many` without the scores"""
+    return [
+        [doc for doc, _ in query_passages]
+        for query_passages in await aget_scored_passages_many(queries, k=k)
+    ]
@@ -0,0 +1,268 @@
+"""
+Ingestion manifest: what is already in the vector table and where it came from.
+
+Every ingested PDF is recorded with its content hash, every page with the hash
+of its raster, its markdown and the unfinished section it ends with, and every
+chunk with its content hash by page. A re-run skips unchanged PDFs and pages,
+embeds only the chunks the table doesn't have yet and deletes the chunks no
+page references anymore. Chunks are stored under a UUID derived from their
+content hash, so the same chunk is never inserted twice.
+
+After every ingestion the manifest version is published to a one-row
+Supabase table, read by the servers to invalidate their answer caches:
+
+    create table corpus_version (
+        id int primary key, version text not null, updated_at timestamptz
+    );
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+INGEST_MANIFEST_PATH = os.getenv(
+    "INGEST_MANIFEST_PATH", ".cache/ingest_manifest.sqlite3"
+)
+CORPUS_VERSION_TABLE = os.getenv("CORPUS_VERSION_TABLE", "corpus_version")
+
+
+def chunk_uuid(chunk_id: str) -> str:
+    """Row id of a chunk in the vector table, from its sha1 content hash"""
+    return str(uuid.UUID(chunk_id[:32]))
+
+
+@dataclass
+class PageRecord:
+    page_hash: str
+    # Section headers in force where the unfinished section starts
+    headers: Dict[str, str] = field(default_factory=dict)
+    # None for pages ingested before the markdown was recorded
+    markdown: Optional[str] = None
+    # Unfinished section the page ends with, {"text", "page"}
+    carry: Dict[str, Any] = field(default_factory=dict)
+    # Key of the section the page was split with, see `sections.Carry`
+    carry_in: str = ""
+
+
+class IngestManifest:
+    """Ingested PDFs, pages and chunks, in a SQLite file"""
+
+    def __init__(self, path: str = INGEST_MANIFEST_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                source TEXT PRIMARY KEY,
+                pdf_hash TEXT NOT NULL,
+                page_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                source TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                page_hash TEXT NOT NULL,
+                headers TEXT NOT NULL DEFAULT '{}',
+                PRIMARY KEY (source, page)
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                source TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL,
+                PRIMARY KEY (source, page, chunk_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_chunk_id ON chunks (chunk_id);
+            """
+        )
+        self._migrate()
+        self._connection.commit()
+
+    def _migrate(self):
+        """Adds the page columns that manifests of older versions lack"""
+        columns = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(pages)")
+        }
+        for column, definition in (
+            ("markdown", "TEXT"),
+            ("carry", "TEXT NOT NULL DEFAULT '{}'"),
+            ("carry_in", "TEXT NOT NULL DEFAULT ''"),
+        ):
+            if column not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE pages ADD COLUMN {column} {definition}"
+                )
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            # Pages of a PDF whose ingestion was interrupted count too
+            rows = self._connection.execute(
+                "SELECT source FROM documents UNION SELECT source FROM pages"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def document_hash(self, source: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT pdf_hash FROM documents WHERE source = ?", (source,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def page(self, source: str, page: int) -> Optional[PageRecord]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT page_hash, headers, markdown, carry, carry_in FROM pages "
+                "WHERE source = ? AND page = ?",
+                (source, page),
+            ).fetchone()
+        if row is None:
+            return None
+        return PageRecord(
+            page_hash=row[0],
+            headers=json.loads(row[1]),
+            markdown=row[2],
+            carry=json.loads(row[3]),
+            carry_in=row[4],
+        )
+
+    def stored_chunks(self, chunk_ids: Iterable[str]) -> Set[str]:
+        """The given chunks that are already in the vector table"""
+        chunk_ids = list(chunk_ids)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT chunk_id FROM chunks WHERE chunk_id IN "
+                f"({', '.join('?' * len(chunk_ids))})",
+                chunk_ids,
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def _orphans(self, condition: str, parameters: tuple, keep: Set[str]) -> List[str]:
+        """Chunks matched by `condition` that nothing else references"""
+        rows = self._connection.execute(
+            f"SELECT DISTINCT chunk_id FROM chunks WHERE {condition}", parameters
+        ).fetchall()
+        orphans = []
+        for (chunk_id,) in rows:
+            if chunk_id in keep:
+                continue
+            references = self._connection.execute(
+                f"SELECT COUNT(*) FROM chunks WHERE chunk_id = ? AND NOT ({condition})",
+                (chunk_id, *parameters),
+            ).fetchone()[0]
+            if not references:
+                orphans.append(chunk_id)
+        return orphans
+
+    def stale_page_chunks(
+        self, source: str, page: int, chunk_ids: Iterable[str]
+    ) -> List[str]:
+        """Chunks that leave the table when the page is replaced by `chunk_ids`"""
+        with self._lock:
+            return self._orphans(
+                "source = ? AND page = ?", (source, page), set(chunk_ids)
+            )
+
+    def replace_page(
+        self,
+        source: str,
+        page: int,
+        record: PageRecord,
+        chunk_ids: Iterable[str],
+    ):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM chunks WHERE source = ? AND page = ?", (source, page)
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO chunks (source, page, chunk_id) "
+                "VALUES (?, ?, ?)",
+                [(source, page, chunk_id) for chunk_id in chunk_ids],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages "
+                "(source, page, page_hash, headers, markdown, carry, carry_in) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    source,
+                    page,
+                    record.page_hash,
+                    json.dumps(record.headers),
+                    record.markdown,
+                    json.dumps(record.carry),
+                    record.carry_in,
+                ),
+            )
+
+    def stale_document_chunks(self, source: str, page_count: int = 0) -> List[str]:
+        """Chunks that leave the table when pages after `page_count` are dropped"""
+        with self._lock:
+            return self._orphans("source = ? AND page > ?", (source, page_count), set())
+
+    def finish_document(self, source: str, pdf_hash: str, page_count: int):
+        """Records a fully ingested PDF and forgets the pages it no longer has"""
+        with self._lock, self._connection:
+            for table in ("chunks", "pages"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE source = ? AND page > ?",
+                    (source, page_count),
+                )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents "
+                "(source, pdf_hash, page_count, updated_at) VALUES (?, ?, ?, ?)",
+                (source, pdf_hash, page_count, time.time()),
+            )
+
+    def remove_document(self, source: str):
+        with self._lock, self._connection:
+            for table in ("chunks", "pages", "documents"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE source = ?", (source,)
+                )
+
+    def version(self) -> str:
+        """Changes whenever a PDF is ingested, re-ingested or removed"""
+        digest = hashlib.sha1()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT source, pdf_hash, page_count FROM documents ORDER BY source"
+            ).fetchall()
+            pages = self._connection.execute(
+                "SELECT source, page, page_hash FROM pages ORDER BY source, page"
+            ).fetchall()
+        for row in (*rows, *pages):
+            digest.update(json.dumps(row).encode("utf-8"))
+        return digest.hexdigest()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def publish_version(client: Any, version: str):
+    """Records the corpus version in Supabase, for the servers on other hosts"""
+    try:
+        client.table(CORPUS_VERSION_TABLE).upsert(
+            {
+                "id": 1,
+                "version": version,
+                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            }
+        ).execute()
+    except Exception as e:
+        print(f"Error publishing the corpus version: {e}")
+
+
+def fetch_published_version(client: Any) -> Optional[str]:
+    """The corpus version published by the last ingestion, if any"""
+    res = client.table(CORPUS_VERSION_TABLE).select("version").eq("id", 1).execute()
+    return res.data[0]["version"] if res.data else None
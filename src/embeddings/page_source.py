@@ -0,0 +1,227 @@
+"""
+PDF page rasters without intermediate copies.
+
+PyMuPDF renders a page straight into an RGB pixmap and the docling processor
+gets a numpy view over its samples, instead of a PIL image encoded to PNG,
+base64-encoded and decoded twice again. The DPI fits the longest side of the
+page to the model input size (PAGE_LONGEST_EDGE), so the processor doesn't
+resample it, unless PAGE_RENDER_DPI fixes it.
+
+With PAGE_CACHE_PATH set, rasters are kept as raw .npy files keyed by the PDF
+content hash and memory mapped when read again.
+
+The benchmark below compares the paths by CPU time and by the peak resident
+memory of a process running each one, which includes the MuPDF and PIL
+buffers that Python allocation tracing doesn't see:
+
+    python -m embeddings.page_source benchmark \\
+        ../pdfs_not_to_process/2.03.01_VACCINES_NEW_TECH.pdf [pages]
+"""
+
+import hashlib
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional, Tuple
+
+import fitz
+import numpy as np
+from PIL import Image
+
+# 0 fits the longest side of every page to PAGE_LONGEST_EDGE pixels
+PAGE_RENDER_DPI = float(os.getenv("PAGE_RENDER_DPI", "0"))
+# SmolDocling resizes the longest side of its input to 2048 pixels
+PAGE_LONGEST_EDGE = int(os.getenv("PAGE_LONGEST_EDGE", "2048"))
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "")
+
+
+@dataclass
+class PageRaster:
+    # (height, width, 3) uint8, over the pixmap samples or a memory mapped file
+    array: np.ndarray
+    # Keeps the buffer behind `array` alive
+    owner: Any = field(default=None, repr=False)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.array.shape[1], self.array.shape[0]
+
+    def content_hash(self) -> str:
+        return hashlib.sha1(np.ascontiguousarray(self.array)).hexdigest()
+
+    def to_image(self) -> Image.Image:
+        """PIL copy of the raster, for the consumers that need one"""
+        return Image.fromarray(np.asarray(self.array), "RGB")
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def render_zoom(page: Any) -> float:
+    if PAGE_RENDER_DPI:
+        return PAGE_RENDER_DPI / 72
+    return PAGE_LONGEST_EDGE / max(page.rect.width, page.rect.height)
+
+
+def render_page(pdf_document: Any, page_number: int) -> PageRaster:
+    """Raster of a (one-indexed) page, sharing the pixmap memory"""
+    page = pdf_document.load_page(page_number - 1)
+    zoom = render_zoom(page)
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False
+    )
+    rows = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+    array = rows[:, : pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    return PageRaster(array=array, owner=pix)
+
+
+class PageSource:
+    """Pages of a PDF as rasters, read from the disk cache when enabled"""
+
+    def __init__(self, pdf_path: str, cache_path: str = PAGE_CACHE_PATH):
+        self.pdf_path = pdf_path
+        self.cache_path = cache_path
+        self.document = fitz.open(pdf_path)
+        self.pdf_hash: Optional[str] = None
+        if cache_path:
+            os.makedirs(cache_path, exist_ok=True)
+            self.pdf_hash = file_hash(pdf_path)
+
+    @property
+    def page_count(self) -> int:
+        return self.document.page_count
+
+    def cache_file(self, page_number: int) -> str:
+        resolution = (
+            f"{PAGE_RENDER_DPI:g}dpi" if PAGE_RENDER_DPI else f"{PAGE_LONGEST_EDGE}px"
+        )
+        return os.path.join(
+            self.cache_path, f"{self.pdf_hash}-{page_number}-{resolution}.npy"
+        )
+
+    def page(self, page_number: int) -> PageRaster:
+        if not self.cache_path:
+            return render_page(self.document, page_number)
+
+        path = self.cache_file(page_number)
+        if os.path.exists(path):
+            return PageRaster(array=np.load(path, mmap_mode="r"))
+
+        raster = render_page(self.document, page_number)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, raster.array)
+        os.replace(tmp_path, path)
+        return raster
+
+    def __iter__(self) -> Iterator[Tuple[int, PageRaster]]:
+        for page_number in range(1, self.page_count + 1):
+            yield page_number, self.page(page_number)
+
+    def close(self):
+        self.document.close()
+
+
+def png_round_trip(pdf_document: Any, page_number: int) -> PageRaster:
+    """The previous path: PIL image, PNG, base64 and back"""
+    import base64
+    import io
+
+    page = pdf_document.load_page(page_number - 1)
+    zoom = render_zoom(page)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    encoded = base64.b64encode(buffer.getvalue())
+    decoded = Image.open(io.BytesIO(base64.b64decode(encoded)))
+    return PageRaster(array=np.asarray(decoded))
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure_method(
+    pdf_path: str, method: str, count: int, cache_path: str
+) -> Tuple[float, int, int]:
+    """
+    CPU seconds, peak RSS growth and largest raster (bytes) of reading
+    `count` pages with `method`. Runs in a fresh process, so the peak RSS
+    covers the MuPDF and PIL buffers of this method only
+    """
+    source = PageSource(pdf_path, cache_path=cache_path)
+    if method == "png + base64":
+
+        def read_page(page_number: int) -> PageRaster:
+            return png_round_trip(source.document, page_number)
+
+    else:
+        read_page = source.page
+
+    baseline = peak_rss()
+    cpu_seconds = 0.0
+    raster_bytes = 0
+    for page_number in range(1, count + 1):
+        started_at = time.process_time()
+        raster = read_page(page_number)
+        # Read the pixels, as the processor does
+        int(raster.array[::8, ::8].sum())
+        raster_bytes = max(raster_bytes, raster.array.nbytes)
+        del raster
+        cpu_seconds += time.process_time() - started_at
+
+    growth = peak_rss() - baseline
+    source.close()
+    return cpu_seconds, growth, raster_bytes
+
+
+def benchmark(pdf_path: str, pages: int = 10):
+    """
+    CPU time per page and peak RSS growth of the PNG/base64 round trip, the
+    pixmap view and the memory mapped cache, each in its own process
+    """
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        cached_source = PageSource(pdf_path, cache_path=cache_path)
+        count = min(pages, cached_source.page_count)
+        for page_number in range(1, count + 1):
+            cached_source.page(page_number)  # fill the cache
+        cached_source.close()
+
+        print(f"{count} pages of {os.path.basename(pdf_path)}")
+        for method, method_cache_path in (
+            ("png + base64", ""),
+            ("pixmap view", ""),
+            ("mmap cache", cache_path),
+        ):
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                cpu_seconds, growth, raster_bytes = pool.submit(
+                    measure_method, pdf_path, method, count, method_cache_path
+                ).result()
+            print(
+                f"{method:<16} {cpu_seconds / count * 1e3:8.1f} ms CPU/page, "
+                f"peak RSS growth {growth / 2**20:6.1f} MiB, "
+                f"raster {raster_bytes / 2**20:5.1f} MiB/page"
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "benchmark":
+        print("Usage: python -m embeddings.page_source benchmark <pdf> [pages]")
+    else:
+        benchmark(sys.argv[2], *(int(pages) for pages in sys.argv[3:4]))
@@ -0,0 +1,329 @@
+"""
+Multiprocess ingestion with resumable per-page checkpoints.
+
+The PDFs are sharded into page ranges and converted by a pool of processes.
+Each worker loads SmolDocling once and gets an equal share of the cores:
+intra-op threads are capped per worker and inter-op parallelism is disabled,
+so the workers don't oversubscribe the machine. The docling output of every
+page is checkpointed to disk as soon as it is produced, and a rerun after an
+interruption only converts the pages without a checkpoint.
+
+Once every shard of a PDF is done, its pages go through the split, embed and
+upsert stages of `load_documents` in the parent process, which keeps the
+ingestion manifest up to date. Checkpoints of fully stored PDFs are removed.
+Run it from the repository root with:
+
+    python -m src.embeddings.parallel_ingest [--workers N]
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import get_context
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.embeddings.manifest import IngestManifest, publish_version
+from src.embeddings.page_source import PageSource, file_hash
+from src.lib.pipeline import run_pipeline
+
+CPU_COUNT = os.cpu_count() or 1
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, CPU_COUNT // 4))))
+# Pages per shard, the unit of work of a worker
+INGEST_SHARD_PAGES = int(os.getenv("INGEST_SHARD_PAGES", "8"))
+INGEST_CHECKPOINT_PATH = os.getenv(
+    "INGEST_CHECKPOINT_PATH", ".cache/ingest_checkpoints"
+)
+
+
+class CheckpointStore:
+    """Docling output per page, one JSON file per page under the PDF hash"""
+
+    def __init__(self, path: str = INGEST_CHECKPOINT_PATH):
+        self.path = path
+
+    def _file(self, pdf_hash: str, page_number: int) -> str:
+        return os.path.join(self.path, pdf_hash, f"{page_number:05d}.json")
+
+    def has(self, pdf_hash: str, page_number: int) -> bool:
+        return os.path.exists(self._file(pdf_hash, page_number))
+
+    def get(self, pdf_hash: str, page_number: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._file(pdf_hash, page_number), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, pdf_hash: str, page_number: int, checkpoint: Dict[str, Any]):
+        path = self._file(pdf_hash, page_number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so an interruption never leaves half a file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def remove(self, pdf_hash: str):
+        shutil.rmtree(os.path.join(self.path, pdf_hash), ignore_errors=True)
+
+
+@dataclass
+class PdfJob:
+    path: str
+    source: str
+    pdf_hash: str
+    page_count: int
+    # Page hashes of the previous ingestion, from the manifest
+    recorded: Dict[int, str]
+
+    def shards(self, size: int = INGEST_SHARD_PAGES) -> List[List[int]]:
+        pages = list(range(1, self.page_count + 1))
+        return [pages[start : start + size] for start in range(0, len(pages), size)]
+
+
+def init_worker(threads: int):
+    """Runs once per worker process, before its first shard"""
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "DOCLING_THREADS"):
+        os.environ[variable] = str(threads)
+
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from src.embeddings.docling_engine import get_docling_engine
+
+    # The model is loaded once and reused by every shard of the worker
+    get_docling_engine()
+
+
+def convert_shard(job: PdfJob, page_numbers: List[int]) -> Dict[str, Any]:
+    """
+    Converts the pages of a shard that have no checkpoint yet, checkpointing
+    every batch. Returns the throughput report of the shard
+    """
+    from src.embeddings.docling_engine import doctags_to_markdown, get_docling_engine
+
+    engine = get_docling_engine()
+    checkpoints = CheckpointStore()
+    started_at = time.perf_counter()
+    report = {"worker": os.getpid(), "converted": 0, "resumed": 0, "unchanged": 0}
+
+    pages = PageSource(job.path)
+    pending = []
+
+    def flush():
+        all_doctags = engine.convert(
+            [raster.array for _, raster, _ in pending], name=job.source
+        )
+        for (page_number, raster, page_hash), doctags in zip(pending, all_doctags):
+            checkpoints.put(
+                job.pdf_hash,
+                page_number,
+                {
+                    "page_hash": page_hash,
+                    "unchanged": False,
+                    "doctags": doctags,
+                    "markdown": doctags_to_markdown([doctags], [raster.to_image()]),
+                },
+            )
+        report["converted"] += len(pending)
+        pending.clear()
+
+    for page_number in page_numbers:
+        if checkpoints.has(job.pdf_hash, page_number):
+            report["resumed"] += 1
+            continue
+
+        raster = pages.page(page_number)
+        page_hash = raster.content_hash()
+        if job.recorded.get(page_number) == page_hash:
+            checkpoints.put(
+                job.pdf_hash, page_number, {"page_hash": page_hash, "unchanged": True}
+            )
+            report["unchanged"] += 1
+            continue
+
+        pending.append((page_number, raster, page_hash))
+        if len(pending) == engine.batch_size:
+            flush()
+
+    if pending:
+        flush()
+    pages.close()
+
+    report["seconds"] = time.perf_counter() - started_at
+    return report
+
+
+def print_report(reports: List[Dict[str, Any]], elapsed: float):
+    """Pages and pages/min of every worker and of the whole run"""
+    workers: Dict[int, Dict[str, float]] = {}
+    for report in reports:
+        totals = workers.setdefault(
+            report["worker"],
+            {"shards": 0, "converted": 0, "resumed": 0, "unchanged": 0, "seconds": 0},
+        )
+        totals["shards"] += 1
+        for key in ("converted", "resumed", "unchanged", "seconds"):
+            totals[key] += report[key]
+
+    for worker, totals in sorted(workers.items()):
+        rate = totals["converted"] / totals["seconds"] * 60 if totals["seconds"] else 0
+        print(
+            f"worker {worker}: {totals['shards']} shards, "
+            f"{totals['converted']} pages converted, {totals['resumed']} resumed, "
+            f"{totals['unchanged']} unchanged, {rate:.2f} pages/min"
+        )
+
+    converted = sum(totals["converted"] for totals in workers.values())
+    print(
+        f"{len(workers)} workers: {converted} pages converted in {elapsed:.0f} s, "
+        f"{converted / elapsed * 60 if elapsed else 0:.2f} pages/min"
+    )
+
+
+def checkpointed_pages(
+    jobs: List[PdfJob],
+    manifest: IngestManifest,
+    workers: int,
+    reports: List[Dict[str, Any]],
+) -> Iterator[Any]:
+    """Converts the jobs on the pool and yields the pages of every finished PDF"""
+    from src.embeddings.load_documents import PdfPage, restore_page
+
+    checkpoints = CheckpointStore()
+    threads = max(1, CPU_COUNT // workers)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        # Fresh interpreters: torch state and threads are not safe to fork
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads,),
+    )
+
+    try:
+        futures = {
+            pool.submit(convert_shard, job, shard): job
+            for job in jobs
+            for shard in job.shards()
+        }
+        remaining = {job.source: len(job.shards()) for job in jobs}
+
+        for future in as_completed(futures):
+            job = futures[future]
+            report = future.result()
+            reports.append(report)
+            print(
+                f"{job.source}: shard done by worker {report['worker']}, "
+                f"{report['converted']} pages in {report['seconds']:.0f} s"
+            )
+
+            remaining[job.source] -= 1
+            if remaining[job.source]:
+                continue
+
+            for page_number in range(1, job.page_count + 1):
+                checkpoint = checkpoints.get(job.pdf_hash, page_number)
+                page = PdfPage(
+                    source=job.source,
+                    number=page_number,
+                    page_count=job.page_count,
+                    pdf_hash=job.pdf_hash,
+                    page_hash=checkpoint["page_hash"],
+                    markdown=checkpoint.get("markdown", ""),
+                )
+                if checkpoint["unchanged"]:
+                    restore_page(page, manifest.page(job.source, page_number))
+                yield page
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def ingest_pdfs_parallel(
+    pdf_paths: List[str], workers: int = INGEST_WORKERS, prune: bool = False
+) -> int:
+    """
+    `load_documents.ingest_pdfs` with the docling conversion spread over
+    `workers` processes. Returns the number of chunks stored
+    """
+    from src.embeddings.load_documents import (
+        INGEST_QUEUE_SIZE,
+        ChunkStore,
+        embed_pages,
+        prune_removed_pdfs,
+        split_pages,
+        supabase_client,
+        upsert_pages,
+    )
+
+    manifest = IngestManifest()
+    store = ChunkStore()
+    if prune:
+        prune_removed_pdfs(pdf_paths, manifest, store)
+
+    jobs = []
+    for pdf_path in pdf_paths:
+        source = os.path.basename(pdf_path)
+        pdf_hash = file_hash(pdf_path)
+        if manifest.document_hash(source) == pdf_hash:
+            print(f"Skipping {source}, unchanged since the last ingestion")
+            continue
+
+        pages = PageSource(pdf_path, cache_path="")
+        page_count = pages.page_count
+        pages.close()
+
+        recorded = {}
+        for page_number in range(1, page_count + 1):
+            page = manifest.page(source, page_number)
+            # Pages recorded without their markdown are converted again
+            if page is not None and page.markdown is not None:
+                recorded[page_number] = page.page_hash
+        jobs.append(PdfJob(pdf_path, source, pdf_hash, page_count, recorded))
+
+    started_at = time.perf_counter()
+    reports: List[Dict[str, Any]] = []
+    total = 0
+    if jobs:
+        for count in run_pipeline(
+            checkpointed_pages(jobs, manifest, workers, reports),
+            [
+                split_pages,
+                partial(embed_pages, manifest=manifest),
+                partial(upsert_pages, manifest=manifest, store=store),
+            ],
+            queue_sizes=INGEST_QUEUE_SIZE,
+        ):
+            total += count
+
+    checkpoints = CheckpointStore()
+    for job in jobs:
+        if manifest.document_hash(job.source) == job.pdf_hash:
+            checkpoints.remove(job.pdf_hash)
+
+    print_report(reports, time.perf_counter() - started_at)
+    publish_version(supabase_client, manifest.version())
+    manifest.close()
+    return total
+
+
+if __name__ == "__main__":
+    from src.embeddings.load_documents import PDFS_PATH
+
+    workers = INGEST_WORKERS
+    if "--workers" in sys.argv:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
+
+    pdfs_paths = [
+        os.path.join(PDFS_PATH, pdf_file_path)
+        for pdf_file_path in sorted(os.listdir(PDFS_PATH))
+    ]
+
+    total = ingest_pdfs_parallel(pdfs_paths, workers=workers, prune=True)
+    print(f"Stored {total} new chunks in total")
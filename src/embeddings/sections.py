@@ -0,0 +1,157 @@
+"""
+Markdown sections of the ingested pages.
+
+A section runs from one heading of HEADERS_TO_SPLIT_ON to the next, and may
+span several pages. Each page is split as it arrives: the sections it
+finishes are chunked, and the one it ends with is carried into the next page.
+Carries longer than a chunk are chunked up to their last CHUNK_SIZE
+characters, so long sections without headings are not carried whole.
+"""
+
+import hashlib
+import json
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Tuple
+
+from langchain_core.documents import Document
+from langchain_text_splitters import (
+    MarkdownHeaderTextSplitter,
+    RecursiveCharacterTextSplitter,
+)
+
+HEADERS_TO_SPLIT_ON = [
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+]
+# Lines that start a section, the headings of HEADERS_TO_SPLIT_ON
+HEADING_PATTERN = re.compile(r"^[ \t]*##?[ \t]", re.MULTILINE)
+HEADING_LINE_PATTERN = re.compile(r"^[ \t]*(##?)[ \t]+(.*)$", re.MULTILINE)
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+
+
+@dataclass
+class Carry:
+    """
+    Unfinished section a page ends with. It continues at the top of the next
+    page and is chunked with the page that closes it
+    """
+
+    text: str = ""
+    # Page the section starts on
+    page: int = 1
+    # Section headers in force where it starts
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    def key(self) -> str:
+        """Changes when the section carried into a page changes"""
+        return hashlib.sha1(
+            json.dumps(asdict(self), sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+
+def split_markdown(md: str) -> list[Document]:
+    # MD splits
+    markdown_splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=HEADERS_TO_SPLIT_ON, strip_headers=False
+    )
+    md_header_splits = markdown_splitter.split_text(md)
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+    )
+
+    # Split
+    splits = text_splitter.split_documents(md_header_splits)
+
+    # Avoid splits with less than 100 characters
+    return [doc for doc in splits if len(doc.page_content.strip()) >= 100]
+
+
+def split_section_text(
+    text: str, headers: Dict[str, str], page: int
+) -> Tuple[list[Document], Dict[str, str]]:
+    """
+    Chunks of finished sections. Text before their first heading belongs to
+    the section `headers` describe, and the headers in force at the end of
+    the text are returned
+    """
+    documents = split_markdown(text) if text.strip() else []
+    for document in documents:
+        if "Header 1" not in document.metadata:
+            inherited = (
+                {"Header 1": headers["Header 1"]} if "Header 1" in headers else {}
+            )
+            if "Header 2" not in document.metadata:
+                inherited = headers
+            document.metadata.update(inherited)
+        document.metadata["page"] = page
+
+    # From the heading lines, since short sections have no chunk
+    for level, title in HEADING_LINE_PATTERN.findall(text):
+        if level == "#":
+            headers = {"Header 1": title.strip()}
+        else:
+            headers = {**headers, "Header 2": title.strip()}
+    return documents, headers
+
+
+def bounded_carry(
+    text: str, headers: Dict[str, str], start_page: int, page: int, page_text: str
+) -> Tuple[list[Document], Carry]:
+    """
+    Carry of a section that continues past `page`. When it's longer than a
+    chunk, all but its last CHUNK_SIZE characters (cut at a paragraph or line
+    break when there is one) are chunked now
+    """
+    if len(text) <= CHUNK_SIZE:
+        return [], Carry(text=text, page=start_page, headers=headers)
+
+    window = len(text) - CHUNK_SIZE
+    cut = text.find("\n\n", window)
+    if cut == -1:
+        cut = text.find("\n", window)
+    if cut == -1:
+        cut = window
+
+    documents, headers = split_section_text(text[:cut], headers, start_page)
+    # `text` ends with `page_text`, the part of the section on this page. A
+    # tail that starts before it is given the start page of the section
+    tail_page = page if cut >= len(text) - len(page_text) else start_page
+    return documents, Carry(
+        text=text[cut:].lstrip("\n"), page=tail_page, headers=headers
+    )
+
+
+def split_page_markdown(
+    markdown: str, carry: Carry, page: int, closes: bool
+) -> Tuple[list[Document], Carry]:
+    """
+    Chunks of the sections one page finishes. The page continues the section
+    the previous one ended with (`carry`), and the section it ends with is
+    returned to be continued by the next page, unless the page `closes` the
+    document. A section is only chunked once a heading or the end of the
+    document closes it, so paragraphs that run over a page break stay whole
+    """
+    headings = [match.start() for match in HEADING_PATTERN.finditer(markdown)]
+    first = headings[0] if headings else len(markdown)
+    last = headings[-1] if headings else len(markdown)
+
+    carried = "\n".join(part for part in (carry.text, markdown[:first]) if part)
+    start_page = carry.page if carry.text.strip() else page
+    if not headings and not closes:
+        return bounded_carry(carried, carry.headers, start_page, page, markdown[:first])
+
+    documents, headers = split_section_text(carried, carry.headers, start_page)
+    finished, headers = split_section_text(markdown[first:last], headers, page)
+    documents.extend(finished)
+    if not closes:
+        section = markdown[last:]
+        flushed, carry = bounded_carry(section, headers, page, page, section)
+        return [*documents, *flushed], carry
+
+    last_section, _ = split_section_text(markdown[last:], headers, page)
+    documents.extend(last_section)
+    return documents, Carry(page=page + 1)
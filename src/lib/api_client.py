@@ -0,0 +1,41 @@
+"""Client of the InmunoBot HTTP service, used by the Streamlit thin client"""
+
+import json
+from functools import cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+
+@cache
+def get_session() -> requests.Session:
+    return requests.Session()
+
+
+def stream_chat(
+    api_url: str, message: str, session_id: Optional[str] = None
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yields the (event, data) pairs of the /chat SSE stream"""
+    response = get_session().post(
+        f"{api_url}/chat",
+        json={"message": message, "session_id": session_id},
+        stream=True,
+        timeout=(10, 300),
+    )
+    response.raise_for_status()
+    # text/event-stream is always UTF-8
+    response.encoding = "utf-8"
+
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:") :].strip()
+        elif line.startswith("data:") and event is not None:
+            yield event, json.loads(line[len("data:") :])
+            event = None
+
+
+def get_history(api_url: str, session_id: str) -> List[Dict[str, str]]:
+    response = get_session().get(f"{api_url}/sessions/{session_id}", timeout=10)
+    response.raise_for_status()
+    return response.json()["messages"]
@@ -1,33 +1,196 @@
 """Custom embedding implementation to work around tokenization issues"""
 
-import json
+import asyncio
+import logging
 import os
-from typing import List
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
+import httpx
 import requests
 from langchain_core.embeddings import Embeddings
+from requests.adapters import HTTPAdapter
+
+from lib.embedding_cache import EmbeddingCache
+from lib.event_loop import close_on_loop
+from lib.scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
 
 
 class CustomAkashEmbeddings(Embeddings):
     """Custom Akash embedding implementation that ensures raw text is sent to the API"""
 
-    def __init__(self, model: str = "BAAI-bge-large-en-v1-5"):
+    def __init__(
+        self,
+        model: str = "BAAI-bge-large-en-v1-5",
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: int = 64,
+        max_concurrency: int = 4,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        timeout: float = 30,
+    ):
         self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
         self.api_key = os.environ.get("AKASH_API_KEY", "")
         self.base_url = "https://chatapi.akash.network/api/v1"
 
         if not self.api_key:
             raise ValueError("AKASH_API_KEY environment variable is required")
 
-    def _make_embedding_request(self, texts: List[str]) -> List[List[float]]:
-        """Make direct API request to Akash embeddings endpoint"""
+        self._session_lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+
+        # httpx async clients and semaphores are bound to the event loop that
+        # created them, so they are rebuilt when a different loop is running
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def session(self) -> requests.Session:
+        """Keep-alive session shared by every batch, created lazily"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=max(self.max_concurrency, 1),
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update(
+                        {
+                            "Authorization": f"Bearer {self.api_key}",
+                            "Content-Type": "application/json",
+                        }
+                    )
+                    self._session = session
+        return self._session
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Async client with a bounded pool shared by every coroutine of the loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            if self._async_client is not None:
+                # Otherwise its connections stay open until it is collected
+                close_on_loop(self._async_client.aclose(), self._async_loop)
+            self._async_loop = loop
+            self._async_client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                limits=httpx.Limits(
+                    max_connections=max(self.max_concurrency, 1),
+                    max_keepalive_connections=max(self.max_concurrency, 1),
+                ),
+                timeout=self.timeout,
+            )
+            self._async_semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+        return self._async_client
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _payload(self, texts: List[str]) -> dict:
+        return {
+            "model": self.model,
+            "input": texts,
+            "encoding_format": "float",
         }
 
-        # Ensure all texts are clean strings
+    def _parse_response(
+        self, status_code: int, body: str, json_data, attempt: int
+    ) -> Optional[List[List[float]]]:
+        """
+        Returns the embeddings of a successful response, None if the request
+        should be retried, or raises if it failed for good
+        """
+        if status_code == 200:
+            data = json_data()["data"]
+            # The API may not preserve the input order
+            data = sorted(data, key=lambda item: item.get("index", 0))
+            return [item["embedding"] for item in data]
+
+        if status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+            logger.error("Embedding API request failed: %s %s", status_code, body[:500])
+            raise Exception(f"Embedding API request failed: {status_code}")
+
+        logger.warning(
+            "Embedding API returned %s (attempt %d)", status_code, attempt + 1
+        )
+        return None
+
+    def _on_network_error(self, error: Exception, attempt: int):
+        """Raises once the retries are exhausted, else logs the retry"""
+        if attempt == self.max_retries:
+            raise Exception(f"Network error during embedding request: {error}")
+        logger.warning("Embedding request error (attempt %d): %s", attempt + 1, error)
+
+    def _request_batch(self, texts: List[str]) -> List[List[float]]:
+        """Send a single micro-batch, retrying transient failures"""
+        payload = self._payload(texts)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    f"{self.base_url}/embeddings", json=payload, timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                self._on_network_error(e, attempt)
+            else:
+                embeddings = self._parse_response(
+                    response.status_code, response.text, response.json, attempt
+                )
+                if embeddings is not None:
+                    return embeddings
+
+            time.sleep(self._backoff_delay(attempt))
+
+        raise Exception("Embedding API request failed after retries")
+
+    async def _arequest_batch(self, texts: List[str]) -> List[List[float]]:
+        """Async version of `_request_batch`, bounded by the loop semaphore"""
+        client = self._get_async_client()
+        payload = self._payload(texts)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._async_semaphore:
+                    response = await client.post("/embeddings", json=payload)
+            except httpx.HTTPError as e:
+                self._on_network_error(e, attempt)
+            else:
+                embeddings = self._parse_response(
+                    response.status_code, response.text, response.json, attempt
+                )
+                if embeddings is not None:
+                    return embeddings
+
+            await asyncio.sleep(self._backoff_delay(attempt))
+
+        raise Exception("Embedding API request failed after retries")
+
+    @staticmethod
+    def _clean_texts(texts: List[str]) -> List[str]:
+        """Ensure all texts are clean strings"""
         clean_texts = []
         for text in texts:
             if not isinstance(text, str):
@@ -35,40 +198,123 @@ class CustomAkashEmbeddings(Embeddings):
             # Clean the text of any problematic characters
             clean_text = text.strip()
             clean_texts.append(clean_text)
+        return clean_texts
 
-        payload = {
-            "model": self.model,
-            "input": clean_texts,
-            "encoding_format": "float",
-        }
+    def _split_batches(self, texts: List[str]) -> List[List[str]]:
+        return [
+            texts[start : start + self.batch_size]
+            for start in range(0, len(texts), self.batch_size)
+        ]
 
-        print(f"Making embedding request for {len(clean_texts)} texts")
-        print(f"First text sample: {repr(clean_texts[0][:100])}")
+    @staticmethod
+    def _join_batches(
+        results: List[List[List[float]]], started_at: float
+    ) -> List[List[float]]:
+        """Vectors of the batches in input order, logging the throughput"""
+        embeddings = [vector for batch_result in results for vector in batch_result]
+        elapsed = time.perf_counter() - started_at
+        logger.info(
+            "Embedded %d texts in %d batches in %.2fs (%.1f texts/s)",
+            len(embeddings),
+            len(results),
+            elapsed,
+            len(embeddings) / elapsed if elapsed > 0 else float("inf"),
+        )
+        return embeddings
 
-        try:
-            response = requests.post(
-                f"{self.base_url}/embeddings", headers=headers, json=payload, timeout=30
-            )
+    def _make_embedding_request(self, texts: List[str]) -> List[List[float]]:
+        """Make direct API requests to Akash embeddings endpoint in micro-batches"""
+        batches = self._split_batches(self._clean_texts(texts))
+        started_at = time.perf_counter()
 
-            if response.status_code == 200:
-                result = response.json()
-                embeddings = [item["embedding"] for item in result["data"]]
-                print(f"Successfully generated {len(embeddings)} embeddings")
-                return embeddings
+        # One embedding call takes one upstream slot of the process scheduler
+        with scheduler.slot_sync("embedding"):
+            if len(batches) == 1 or self.max_concurrency <= 1:
+                results = [self._request_batch(batch) for batch in batches]
             else:
-                print(f"API request failed: {response.status_code}")
-                print(f"Response: {response.text}")
-                raise Exception(f"Embedding API request failed: {response.status_code}")
+                workers = min(self.max_concurrency, len(batches))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    # map keeps the batches in input order
+                    results = list(executor.map(self._request_batch, batches))
 
-        except requests.RequestException as e:
-            print(f"Request error: {e}")
-            raise Exception(f"Network error during embedding request: {e}")
+        return self._join_batches(results, started_at)
+
+    async def _amake_embedding_request(self, texts: List[str]) -> List[List[float]]:
+        """Async version of `_make_embedding_request`"""
+        batches = self._split_batches(self._clean_texts(texts))
+        started_at = time.perf_counter()
+
+        async with scheduler.slot("embedding"):
+            # gather keeps the batches in input order
+            results = await asyncio.gather(
+                *(self._arequest_batch(batch) for batch in batches)
+            )
+
+        return self._join_batches(results, started_at)
+
+    def _partition_cached(
+        self, texts: List[str]
+    ) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """Cached vectors in input order (None for misses) and the miss indexes"""
+        if self.cache is None:
+            return [None] * len(texts), list(range(len(texts)))
+        embeddings = self.cache.get_many(self.model, texts)
+        return embeddings, [i for i, vector in enumerate(embeddings) if vector is None]
+
+    def _merge_missing(
+        self,
+        texts: List[str],
+        embeddings: List[Optional[List[float]]],
+        missing_indexes: List[int],
+        new_embeddings: List[List[float]],
+    ) -> List[List[float]]:
+        """Fills the misses with the new vectors and caches them"""
+        if self.cache is not None:
+            self.cache.set_many(
+                self.model, [texts[i] for i in missing_indexes], new_embeddings
+            )
+        for i, vector in zip(missing_indexes, new_embeddings):
+            embeddings[i] = vector
+        return embeddings
+
+    def _embed_with_cache(self, texts: List[str]) -> List[List[float]]:
+        """Serve cached vectors and only send the misses to the API"""
+        embeddings, missing_indexes = self._partition_cached(texts)
+        if not missing_indexes:
+            return embeddings
+        new_embeddings = self._make_embedding_request(
+            [texts[i] for i in missing_indexes]
+        )
+        return self._merge_missing(texts, embeddings, missing_indexes, new_embeddings)
+
+    async def _aembed_with_cache(self, texts: List[str]) -> List[List[float]]:
+        """Async version of `_embed_with_cache`"""
+        embeddings, missing_indexes = self._partition_cached(texts)
+        if not missing_indexes:
+            return embeddings
+        new_embeddings = await self._amake_embedding_request(
+            [texts[i] for i in missing_indexes]
+        )
+        return self._merge_missing(texts, embeddings, missing_indexes, new_embeddings)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Embed multiple documents"""
-        return self._make_embedding_request(texts)
+        if not texts:
+            return []
+        return self._embed_with_cache(texts)
 
     def embed_query(self, text: str) -> List[float]:
         """Embed a single query"""
-        embeddings = self._make_embedding_request([text])
+        embeddings = self._embed_with_cache([text])
+        return embeddings[0] if embeddings else []
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed multiple documents without blocking the event loop"""
+        if not texts:
+            return []
+        return await self._aembed_with_cache(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Embed a single query without blocking the event loop"""
+        embeddings = await self._aembed_with_cache([text])
         return embeddings[0] if embeddings else []
@@ -0,0 +1,147 @@
+"""Persistent, content-addressed cache for embedding vectors"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Dict, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text so equivalent inputs share the same cache key"""
+    if not isinstance(text, str):
+        text = str(text)
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def make_cache_key(model: str, text: str) -> str:
+    """Hash of (model name, normalized text)"""
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite backed embedding cache.
+
+    Vectors are stored as packed float32 blobs keyed by a hash of the model name
+    and the normalized text. When the number of entries goes over `max_entries`
+    the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access "
+            "ON embeddings (last_access)"
+        )
+        self._connection.commit()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Returns the cached vector for each text, or None on a miss"""
+        keys = [make_cache_key(model, text) for text in texts]
+        found: Dict[str, List[float]] = {}
+
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._connection.commit()
+
+            results = [found.get(key) for key in keys]
+            hits = sum(1 for result in results if result is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def set_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """Stores the vectors for the given texts and evicts old entries if needed"""
+        now = time.time()
+        rows = [
+            (make_cache_key(model, text), model, array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def stats(self) -> Dict[str, float]:
+        """Returns hit/miss counters and the current number of entries"""
+        with self._lock:
+            (size,) = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
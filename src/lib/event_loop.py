@@ -0,0 +1,46 @@
+"""Long-lived event loop shared by the synchronous callers of async code"""
+
+import asyncio
+import threading
+from functools import cache
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+
+@cache
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop running forever in a daemon thread. Async HTTP clients are bound
+    to the loop that created them, so reusing one loop keeps their connection
+    pools alive across turns, unlike a new `asyncio.run` per call
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(
+        target=loop.run_forever, name="background-event-loop", daemon=True
+    ).start()
+    return loop
+
+
+def run_sync(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Blocks the calling thread until the coroutine finishes on the shared loop"""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_background_loop()).result()
+
+
+def close_on_loop(
+    close: Coroutine[Any, Any, Any], loop: asyncio.AbstractEventLoop
+) -> None:
+    """
+    Runs the `aclose()` coroutine of an async client on the loop that created
+    it, which is the only loop its connections can be closed from
+    """
+    if loop.is_closed():
+        # Nothing runs on it anymore, its transports close their sockets once
+        # the client is collected
+        close.close()
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(close, loop)
+    else:
+        threading.Thread(
+            target=loop.run_until_complete, args=(close,), daemon=True
+        ).start()
@@ -1,9 +1,32 @@
+import logging
 import os
+import random
+import threading
+import time
 from enum import Enum
+from functools import cache
 
+import httpx
+from langchain_core.runnables import Runnable
 from langchain_openai import ChatOpenAI
 
 from lib.custom_embeddings import CustomAkashEmbeddings
+from lib.embedding_cache import EmbeddingCache
+from lib.scheduler import SchedulerError, scheduler
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+CHAT_MAX_CONNECTIONS = int(os.getenv("CHAT_MAX_CONNECTIONS", "20"))
+# Max seconds of the jittered wait before retrying a failed structured output
+STRUCTURED_OUTPUT_RETRY_BACKOFF = float(
+    os.getenv("STRUCTURED_OUTPUT_RETRY_BACKOFF", "1.0")
+)
+
+AKASH_BASE_URL = "https://chatapi.akash.network/api/v1"
+
+logger = logging.getLogger(__name__)
 
 
 class AkashModels(Enum):
@@ -13,55 +36,131 @@ class AkashModels(Enum):
     BAAI_BGE_LARGE = "BAAI-bge-large-en-v1-5"
 
 
-def get_akash_chat_model(model: AkashModels, temperature: float):
+_chat_models_lock = threading.Lock()
+_chat_models: dict[tuple, Runnable] = {}
+
+
+CHAT_HTTP_LIMITS = httpx.Limits(
+    max_connections=CHAT_MAX_CONNECTIONS,
+    max_keepalive_connections=CHAT_MAX_CONNECTIONS,
+)
+CHAT_HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+
+@cache
+def get_chat_http_client() -> httpx.Client:
+    """Keep-alive connection pool shared by every sync chat call"""
+    return httpx.Client(limits=CHAT_HTTP_LIMITS, timeout=CHAT_HTTP_TIMEOUT)
+
+
+@cache
+def get_chat_async_http_client() -> httpx.AsyncClient:
     """
-    Returns the Akash Chat instance
+    Keep-alive connection pool shared by every `ainvoke`/`astream` of the chat
+    models. The process runs its turns on a single loop (the server's, or the
+    shared background loop of `lib.event_loop`), which the pool is bound to
     """
-    return ChatOpenAI(
-        model=model.value,
-        temperature=temperature,
-        base_url="https://chatapi.akash.network/api/v1",
-        api_key=os.environ.get("AKASH_API_KEY", ""),
-    )
+    return httpx.AsyncClient(limits=CHAT_HTTP_LIMITS, timeout=CHAT_HTTP_TIMEOUT)
+
+
+async def aclose_chat_http_clients():
+    """Closes both chat connection pools, on shutdown"""
+    with _chat_models_lock:
+        _chat_models.clear()
+    if get_chat_async_http_client.cache_info().currsize:
+        await get_chat_async_http_client().aclose()
+        get_chat_async_http_client.cache_clear()
+    if get_chat_http_client.cache_info().currsize:
+        get_chat_http_client().close()
+        get_chat_http_client.cache_clear()
+
+
+def get_akash_chat_model(
+    model: AkashModels, temperature: float, structured_schema: type | None = None
+):
+    """
+    Returns the Akash Chat instance, optionally bound to a structured output
+    schema. Instances are created once per (model, temperature, schema) and
+    share the same HTTP connection pools
+    """
+    api_key = os.environ.get("AKASH_API_KEY", "")
+    key = (model.value, temperature, structured_schema, api_key)
+
+    with _chat_models_lock:
+        chat_model = _chat_models.get(key)
+        if chat_model is None:
+            chat_model = ChatOpenAI(
+                model=model.value,
+                temperature=temperature,
+                base_url=AKASH_BASE_URL,
+                api_key=api_key,
+                http_client=get_chat_http_client(),
+                http_async_client=get_chat_async_http_client(),
+            )
+            if structured_schema is not None:
+                chat_model = chat_model.with_structured_output(structured_schema)
+            _chat_models[key] = chat_model
+
+    return chat_model
 
 
 def get_structured_output_with_retry(
-    structured_schema: type, value: str
+    structured_schema: type, value: str, upstream: str = "judge"
 ) -> type | None:
     """
-    Returns the structured output response with retry, or None if validation fails
+    Returns the structured output response, retried once after a backoff, or
+    None if both attempts fail. Every attempt takes a slot of the `upstream`
+    scheduler class, which is released while waiting to retry
     """
-    result = None
-    models_to_try = [
-        AkashModels.DEEPSEEK_R1_14B,
-        AkashModels.DEEPSEEK_R1_32B,
-    ]
+    model = AkashModels.DEEPSEEK_R1_14B
+    structured_akash = get_akash_chat_model(model, 0, structured_schema)
 
-    for model in models_to_try:
+    for attempt in range(2):
+        if attempt:
+            time.sleep(random.uniform(0, STRUCTURED_OUTPUT_RETRY_BACKOFF))
         try:
-            print(f"Getting structured output from Akash model {model.name}")
-
-            akash_chat = get_akash_chat_model(model, 0)
-            structured_akash = akash_chat.with_structured_output(structured_schema)
-            result = structured_akash.invoke(value)
-
-            return result
+            with scheduler.slot_sync(upstream):
+                return structured_akash.invoke(value)
+        except SchedulerError as e:
+            # The upstream is saturated, a retry would only queue again
+            logger.warning("Akash model %s not admitted: %s", model.name, e)
+            return None
         except Exception as e:
-            print(f"Unexpected error with Akash model {model.name}: {e}")
+            logger.warning(
+                "Structured output from Akash model %s failed (attempt %d): %s",
+                model.name,
+                attempt + 1,
+                e,
+            )
 
-    return result
+    return None
 
 
+@cache
 def get_akash_embedding_model(model: AkashModels):
     """
     Returns the Akash Embedding instance using custom implementation
-    to avoid tokenization issues
+    to avoid tokenization issues. The instance is shared per model so its
+    HTTP session and cache are reused across callers
     """
     print(f"Initializing custom embedding model: {model.value}")
 
     try:
+        # Cache vectors on disk so repeated texts skip the API round trip.
+        # Set EMBEDDING_CACHE_PATH to an empty string to disable it
+        embedding_cache = None
+        if EMBEDDING_CACHE_PATH:
+            embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+            )
+
         # Use custom embedding implementation to avoid tokenization issues
-        embedding_model = CustomAkashEmbeddings(model=model.value)
+        embedding_model = CustomAkashEmbeddings(
+            model=model.value,
+            cache=embedding_cache,
+            batch_size=EMBEDDING_BATCH_SIZE,
+            max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+        )
 
         return embedding_model
 
@@ -0,0 +1,88 @@
+"""
+Generator stages connected by bounded queues.
+
+Every stage is a generator function over the items of the previous stage and
+runs in its own thread, so rendering, model inference and network calls
+overlap. A full queue blocks its producer, which bounds the items in flight
+by the queue sizes instead of by the input. An error in any stage stops the
+others and is raised to the consumer.
+"""
+
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, Sequence, Union
+
+Stage = Callable[[Iterator], Iterable]
+
+_END = object()
+POLL_SECONDS = 0.1
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(output: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iterate(input: queue.Queue, stop: threading.Event) -> Iterator:
+    while not stop.is_set():
+        try:
+            item = input.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def _run(items: Callable[[], Iterable], output: queue.Queue, stop: threading.Event):
+    try:
+        for item in items():
+            if not _put(output, item, stop):
+                return
+        _put(output, _END, stop)
+    except BaseException as e:
+        _put(output, _Failure(e), stop)
+
+
+def run_pipeline(
+    source: Iterable,
+    stages: Sequence[Stage],
+    queue_sizes: Union[int, Sequence[int]] = 4,
+) -> Iterator:
+    """
+    Yields the items of the last stage. `queue_sizes` bounds the queue in
+    front of every stage and the one after the last
+    """
+    if isinstance(queue_sizes, int):
+        queue_sizes = [queue_sizes] * (len(stages) + 1)
+    queues = [queue.Queue(maxsize=size) for size in queue_sizes]
+    stop = threading.Event()
+
+    producers = [lambda: source] + [
+        (lambda stage=stage, input=input: stage(_iterate(input, stop)))
+        for stage, input in zip(stages, queues)
+    ]
+    threads = [
+        threading.Thread(target=_run, args=(items, output, stop), daemon=True)
+        for items, output in zip(producers, queues)
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        yield from _iterate(queues[-1], stop)
+    finally:
+        # Also reached when the consumer stops early
+        stop.set()
@@ -0,0 +1,241 @@
+"""
+Process-wide scheduler of requests to the remote upstreams.
+
+Every upstream (the chat LLM, the embedding API) has a cap of in-flight
+requests. The verification judge calls have their own class ("judge"), so
+answers streaming under "llm" slots can't starve the checks of those answers.
+Requests over the cap wait in per-session queues that are served round robin,
+so a session firing many calls can't starve the others. Queues are bounded
+(backpressure) and waiting is limited by a timeout.
+
+The scheduler is shared by every thread and event loop of the process, so
+it works for Streamlit script threads, the verifier thread pool and async
+code alike:
+
+    async with scheduler.slot("llm"):
+        await chat_model.ainvoke(prompt)
+
+    with scheduler.slot_sync("llm"):
+        chat_model.invoke(prompt)
+
+The session is read from `current_session`, set once per turn.
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Deque, Dict, Optional
+
+SCHEDULER_LLM_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_LLM_MAX_IN_FLIGHT", "16"))
+SCHEDULER_EMBEDDING_MAX_IN_FLIGHT = int(
+    os.getenv("SCHEDULER_EMBEDDING_MAX_IN_FLIGHT", "8")
+)
+SCHEDULER_JUDGE_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_JUDGE_MAX_IN_FLIGHT", "8"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "60"))
+
+DEFAULT_SESSION = "default"
+
+current_session: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_session", default=DEFAULT_SESSION
+)
+
+
+class SchedulerError(Exception):
+    """The request was not admitted to the upstream"""
+
+
+class SchedulerOverloaded(SchedulerError):
+    """The upstream queue is full"""
+
+
+class SchedulerTimeout(SchedulerError):
+    """The request waited longer than the queue timeout"""
+
+
+class _Waiter:
+    def __init__(self, session: str, wake: Callable[[], None]):
+        self.session = session
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class UpstreamLimiter:
+    """In-flight cap and fair per-session queue of a single upstream"""
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        self.in_flight = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _record_wait(self, waiter: Optional[_Waiter]):
+        wait = time.monotonic() - waiter.enqueued_at if waiter else 0.0
+        self.admitted += 1
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def _try_acquire(self, session: str, wake: Callable[[], None]):
+        """Returns None when the slot was taken right away, else the waiter"""
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queued:
+                self.in_flight += 1
+                self._record_wait(None)
+                return None
+
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerOverloaded(f"{self.name} queue is full")
+
+            waiter = _Waiter(session, wake)
+            self._queues.setdefault(session, deque()).append(waiter)
+            self._queued += 1
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Removes a waiter that timed out. False if it got the slot meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            queue = self._queues[waiter.session]
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.session]
+            self._queued -= 1
+            self.timed_out += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            if not self._queued:
+                return
+
+            # Serve sessions round robin: take the oldest session's first
+            # request and move the session to the back of the line
+            session, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            self._queued -= 1
+
+            self.in_flight += 1
+            waiter.granted = True
+            self._record_wait(waiter)
+
+        try:
+            waiter.wake()
+        except RuntimeError:
+            # The event loop of the waiter is closed, hand the slot on
+            self.release()
+
+    async def acquire(self, session: str, timeout: float):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._try_acquire(session, wake)
+        if waiter is None:
+            return
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(waiter):
+                raise SchedulerTimeout(
+                    f"{self.name} request waited more than {timeout}s"
+                ) from None
+        except asyncio.CancelledError:
+            if not self._abandon(waiter):
+                self.release()
+            raise
+
+    def acquire_sync(self, session: str, timeout: float):
+        event = threading.Event()
+        waiter = self._try_acquire(session, event.set)
+        if waiter is None:
+            return
+
+        if not event.wait(timeout) and self._abandon(waiter):
+            raise SchedulerTimeout(f"{self.name} request waited more than {timeout}s")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queue_depth": self._queued,
+                "waiting_sessions": len(self._queues),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "avg_wait_ms": self.wait_seconds / self.admitted * 1e3
+                if self.admitted
+                else 0.0,
+                "max_wait_ms": self.max_wait_seconds * 1e3,
+            }
+
+
+class RequestScheduler:
+    """One `UpstreamLimiter` per upstream name"""
+
+    def __init__(
+        self,
+        limits: Dict[str, int],
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        timeout: float = SCHEDULER_QUEUE_TIMEOUT,
+    ):
+        self.timeout = timeout
+        self.limiters = {
+            name: UpstreamLimiter(name, max_in_flight, max_queue)
+            for name, max_in_flight in limits.items()
+        }
+
+    @asynccontextmanager
+    async def slot(self, upstream: str, timeout: Optional[float] = None):
+        limiter = self.limiters[upstream]
+        await limiter.acquire(current_session.get(), timeout or self.timeout)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    @contextmanager
+    def slot_sync(self, upstream: str, timeout: Optional[float] = None):
+        limiter = self.limiters[upstream]
+        limiter.acquire_sync(current_session.get(), timeout or self.timeout)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+
+scheduler = RequestScheduler(
+    {
+        "llm": SCHEDULER_LLM_MAX_IN_FLIGHT,
+        "judge": SCHEDULER_JUDGE_MAX_IN_FLIGHT,
+        "embedding": SCHEDULER_EMBEDDING_MAX_IN_FLIGHT,
+    }
+)
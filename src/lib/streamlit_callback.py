@@ -1,4 +1,5 @@
 import inspect
+import time
 from typing import Any, Callable, Dict, Optional, TypeVar
 
 import streamlit
@@ -6,13 +7,28 @@ from langchain_core.callbacks.base import BaseCallbackHandler
 from streamlit.delta_generator import DeltaGenerator
 from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
+# Minimum seconds between redraws of the paragraph being streamed
+RENDER_INTERVAL = 0.05
+
+# Status shown while each graph node runs
+NODE_STATUS_MESSAGES = {
+    "retrieve_passages": "Buscando información relevante",
+    "generate_response": "Generando respuesta",
+    "hallucination_detector": "Validando respuesta",
+}
+
 
 class StreamlitCallbackHandler(BaseCallbackHandler):
     """Callback handler for Streamlit."""
 
-    def __init__(self, container: DeltaGenerator):
+    # Run on the graph's event loop instead of hopping to an executor thread
+    # for every token. The methods add the script context themselves
+    run_inline = True
+
+    def __init__(self, container: DeltaGenerator, stream_tag: str = "final_answer"):
         """Initialize callback handler."""
         self.container = container
+        self.stream_tag = stream_tag
 
         # Auxiliar variable
         self.states_messages = []
@@ -23,6 +39,14 @@ class StreamlitCallbackHandler(BaseCallbackHandler):
         self.text_placeholder = container.empty()
         self.node_name = None
 
+        # Completed paragraphs are appended as their own elements, so only the
+        # paragraph being generated is redrawn on new tokens
+        self.paragraphs_container = self.text_placeholder.container()
+        self.paragraph_placeholder = self.paragraphs_container.empty()
+        self.streamed_text = ""
+        self.paragraph_text = ""
+        self.last_render = 0.0
+
     def on_chain_start(
         self,
         serialized,
@@ -35,36 +59,64 @@ class StreamlitCallbackHandler(BaseCallbackHandler):
         **kwargs,
     ):
         if "context" not in inputs and len(self.states_messages) == 0:
-            status_message = "Buscando información relevante"
-            self.states_messages.append(status_message)
-            self.status_container = self.current_status.status(
-                status_message, state="running"
-            )
+            self.show_status(NODE_STATUS_MESSAGES["retrieve_passages"])
         elif (
             "context" in inputs
             and "response" not in inputs
             and len(self.states_messages) == 1
         ):
-            status_message = "Generando respuesta"
-            self.states_messages.append(status_message)
-            self.status_container.update(state="complete")
-            self.status_container = self.current_status.status(
-                status_message, state="running"
-            )
+            self.show_status(NODE_STATUS_MESSAGES["generate_response"])
         elif (
             "context" in inputs
             and "response" in inputs
             and len(self.states_messages) == 2
         ):
-            status_message = "Validando respuesta"
-            self.states_messages.append(status_message)
+            self.show_status(NODE_STATUS_MESSAGES["hallucination_detector"])
+
+    def show_status(self, status_message: str) -> None:
+        """Marks the previous step as complete and shows the running one"""
+        self.states_messages.append(status_message)
+        if self.status_container is not None:
             self.status_container.update(state="complete")
-            self.current_status.status(status_message, state="running")
+        self.status_container = self.current_status.status(
+            status_message, state="running"
+        )
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         """Run on new LLM token. Only available when streaming is enabled."""
-        if self.text_placeholder is not None:
-            self.text_placeholder.markdown(token, unsafe_allow_html=True)
+        if self.stream_tag not in (kwargs.get("tags") or []):
+            return
+
+        self.streamed_text += token
+        self.paragraph_text += token
+
+        # Freeze every finished paragraph and start a new element for the next
+        while "\n\n" in self.paragraph_text:
+            paragraph, self.paragraph_text = self.paragraph_text.split("\n\n", 1)
+            self.paragraph_placeholder.markdown(paragraph, unsafe_allow_html=True)
+            self.paragraph_placeholder = self.paragraphs_container.empty()
+
+        now = time.monotonic()
+        if now - self.last_render >= RENDER_INTERVAL:
+            self.paragraph_placeholder.markdown(
+                self.paragraph_text, unsafe_allow_html=True
+            )
+            self.last_render = now
+
+    def finish(self, final_text: str) -> None:
+        """
+        Shows the final answer once validation is done. The streamed text is
+        replaced when it was retracted by the hallucination detector
+        """
+        if self.status_container is not None:
+            self.status_container.update(state="complete")
+
+        if final_text == self.streamed_text:
+            self.paragraph_placeholder.markdown(
+                self.paragraph_text, unsafe_allow_html=True
+            )
+        else:
+            self.text_placeholder.markdown(final_text, unsafe_allow_html=True)
 
     def on_custom_event(
         self, name, data, *, run_id, tags=None, metadata=None, **kwargs
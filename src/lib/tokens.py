@@ -0,0 +1,35 @@
+"""Token counting for prompt budgets"""
+
+import math
+import os
+from functools import cache
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+
+# Used when the encoding can't be loaded (it is downloaded on first use).
+# Spanish and English text average a bit under four characters per token
+CHARS_PER_TOKEN = 3.5
+
+
+@cache
+def get_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        print(f"Token encoding unavailable, estimating from text length: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Token count of `text`. The served models use their own tokenizers, so this
+    is an estimate good enough for budgeting
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,374 @@
+"""
+Adaptive retrieval: pay for query expansion only when the question needs it.
+
+Every question first probes the index with the question as the student
+wrote it. When the top dense hits clear ADAPTIVE_CONFIDENCE the probe is the
+context, and the query planner and the planned queries are skipped
+(`direct`). Otherwise the question is planned, and its queries are embedded
+in one call and searched a few at a time; once the fused top documents stop
+changing between waves the remaining queries are dropped (`early_exit`), else
+every query runs (`expanded`).
+
+The question is embedded with its accents, and the raw (usually Spanish)
+question scores lower against the English passages than its translation
+would, so the threshold must be calibrated on those probes. The direct path
+is off until ADAPTIVE_CONFIDENCE is set. To calibrate it, set
+ADAPTIVE_LOG_PATH for a while: every expanded turn then logs the probe
+confidence and how much of the final top documents the probe alone found,
+and the threshold is printed by:
+
+    python -m rag.adaptive_retrieval calibrate adaptive.jsonl [agreement]
+
+Each turn returns a trace with its path and an estimate of the latency it
+saved, from the running averages of the planner and of a search wave.
+"""
+
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from embeddings.lexical_index import is_keyword_query, lexical_search_many
+from embeddings.main import (
+    aembed_queries,
+    aget_scored_passages_many,
+    asearch_by_vectors,
+)
+from lib.scheduler import SchedulerError
+from rag.context import (
+    aplan_queries,
+    aretrieve_scored_context,
+    clean_queries,
+    normalize_user_message,
+    query_plan_cache,
+)
+from rag.context_builder import CONTEXT_CANDIDATES
+from rag.fusion import document_key, fuse
+from rag.reranker import RERANK_ENABLED, rerank
+
+ADAPTIVE_RETRIEVAL = os.getenv("ADAPTIVE_RETRIEVAL", "true").lower() == "true"
+ADAPTIVE_CONFIDENCE_K = int(os.getenv("ADAPTIVE_CONFIDENCE_K", "3"))
+# Expanded queries searched between two stability checks
+ADAPTIVE_WAVE_SIZE = int(os.getenv("ADAPTIVE_WAVE_SIZE", "2"))
+# Fused documents that must stay the same for the fan-out to stop
+ADAPTIVE_STABLE_TOP = int(os.getenv("ADAPTIVE_STABLE_TOP", "5"))
+# JSONL of probe confidences and agreements, for the calibration. Off when empty
+ADAPTIVE_LOG_PATH = os.getenv("ADAPTIVE_LOG_PATH", "")
+# Mean agreement the probe must reach above the calibrated confidence
+ADAPTIVE_TARGET_AGREEMENT = float(os.getenv("ADAPTIVE_TARGET_AGREEMENT", "0.8"))
+# Mean cosine similarity of the top ADAPTIVE_CONFIDENCE_K probe hits needed to
+# skip the planner and the expanded queries. Unset disables `direct`
+ADAPTIVE_CONFIDENCE = (
+    float(os.getenv("ADAPTIVE_CONFIDENCE"))
+    if os.getenv("ADAPTIVE_CONFIDENCE")
+    else None
+)
+# Tags the logged probes, so the ones embedded without accents are left out
+PROBE = "accented_question"
+
+PATHS = ("direct", "early_exit", "expanded", "full")
+
+
+@dataclass
+class RetrievalTrace:
+    path: str
+    confidence: float = 0.0
+    queries_planned: int = 0
+    queries_run: int = 0
+    latency_ms: float = 0.0
+    # Estimated from the running averages of the skipped work
+    saved_ms: float = 0.0
+
+
+class RetrievalStats:
+    """Per-path counts and latencies of the adaptive retrieval"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns: Dict[str, int] = {path: 0 for path in PATHS}
+        self.seconds: Dict[str, float] = {path: 0.0 for path in PATHS}
+        self.saved_seconds = 0.0
+        self.planner_seconds = 0.0
+        self.planner_calls = 0
+        self.planned_queries = 0
+        self.wave_seconds = 0.0
+        self.waves = 0
+
+    def record_planner(self, seconds: float, queries: int):
+        with self._lock:
+            self.planner_seconds += seconds
+            self.planner_calls += 1
+            self.planned_queries += queries
+
+    def average_planned_queries(self) -> float:
+        with self._lock:
+            return (
+                self.planned_queries / self.planner_calls if self.planner_calls else 0.0
+            )
+
+    def record_wave(self, seconds: float):
+        with self._lock:
+            self.wave_seconds += seconds
+            self.waves += 1
+
+    def estimated_saving(self, planner_skipped: bool, waves_skipped: int) -> float:
+        """Seconds the skipped planner call and search waves usually take"""
+        with self._lock:
+            planner = (
+                self.planner_seconds / self.planner_calls if self.planner_calls else 0.0
+            )
+            wave = self.wave_seconds / self.waves if self.waves else 0.0
+        return planner * planner_skipped + wave * waves_skipped
+
+    def record(self, trace: RetrievalTrace):
+        with self._lock:
+            self.turns[trace.path] += 1
+            self.seconds[trace.path] += trace.latency_ms / 1e3
+            self.saved_seconds += trace.saved_ms / 1e3
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = sum(self.turns.values())
+            return {
+                **{f"{path}_turns": count for path, count in self.turns.items()},
+                **{
+                    f"{path}_avg_ms": self.seconds[path] / self.turns[path] * 1e3
+                    if self.turns[path]
+                    else 0.0
+                    for path in PATHS
+                },
+                "direct_rate": self.turns["direct"] / total if total else 0.0,
+                "saved_ms": self.saved_seconds * 1e3,
+            }
+
+
+retrieval_stats = RetrievalStats()
+
+
+def confidence(scored_documents: List[Tuple[Document, float]]) -> float:
+    """Mean similarity of the top hits, 0 when there are fewer than needed"""
+    scores = sorted((score for _, score in scored_documents), reverse=True)
+    if len(scores) < ADAPTIVE_CONFIDENCE_K:
+        return 0.0
+    return sum(scores[:ADAPTIVE_CONFIDENCE_K]) / ADAPTIVE_CONFIDENCE_K
+
+
+def top_keys(fused: List[Tuple[Document, float]]) -> List[str]:
+    return [document_key(doc) for doc, _ in fused[:ADAPTIVE_STABLE_TOP]]
+
+
+def agreement(
+    probe: List[Tuple[Document, float]], expanded: List[Tuple[Document, float]]
+) -> float:
+    """Share of the expanded top documents that the probe alone ranked on top"""
+    expanded_keys = top_keys(expanded)
+    if not expanded_keys:
+        return 1.0
+    return len(set(top_keys(probe)) & set(expanded_keys)) / len(expanded_keys)
+
+
+class ConfidenceLog:
+    """Appends probe confidences and agreements to a JSONL file"""
+
+    def __init__(self, path: str = ADAPTIVE_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, confidence: float, agreement: float):
+        if not self.path:
+            return
+        line = json.dumps(
+            {"confidence": confidence, "agreement": agreement, "probe": PROBE}
+        )
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Error logging the probe confidence: {e}")
+
+
+confidence_log = ConfidenceLog()
+
+
+def calibrate_confidence(
+    samples: Sequence[Tuple[float, float]],
+    target: float = ADAPTIVE_TARGET_AGREEMENT,
+    min_samples: int = 30,
+) -> Optional[float]:
+    """
+    Lowest confidence above which the mean agreement of the (confidence,
+    agreement) samples reaches `target`, None when no threshold keeps
+    `min_samples` samples above it
+    """
+    for threshold in sorted({confidence for confidence, _ in samples}):
+        above = [value for confidence, value in samples if confidence >= threshold]
+        if len(above) < min_samples:
+            return None
+        if sum(above) / len(above) >= target:
+            return threshold
+    return None
+
+
+def load_confidence_samples(path: str) -> List[Tuple[float, float]]:
+    """(confidence, agreement) of the question probes logged in `path`"""
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                if entry.get("probe") == PROBE:
+                    samples.append((entry["confidence"], entry["agreement"]))
+    return samples
+
+
+async def afan_out(
+    queries: List[str], ranked_lists: List[list], trace: RetrievalTrace
+) -> List[Tuple[Document, float]]:
+    """
+    Searches the expanded queries in waves on top of `ranked_lists` (the
+    probe results) until the fused top documents stabilize
+    """
+    lexical_results = lexical_search_many(queries)
+    ranked_lists = [*ranked_lists, *lexical_results]
+
+    # Keyword-style queries with lexical hits don't need the dense search
+    dense_queries = [
+        query
+        for query, lexical_result in zip(queries, lexical_results)
+        if not (lexical_result and is_keyword_query(query))
+    ]
+
+    fused = fuse(ranked_lists, method="rrf")
+    trace.queries_run = len(queries) - len(dense_queries)
+
+    try:
+        embeddings = [
+            vector for vector in await aembed_queries(dense_queries) if vector
+        ]
+        waves = [
+            embeddings[start : start + ADAPTIVE_WAVE_SIZE]
+            for start in range(0, len(embeddings), ADAPTIVE_WAVE_SIZE)
+        ]
+
+        for i, wave in enumerate(waves):
+            started_at = time.perf_counter()
+            ranked_lists.extend(await asearch_by_vectors(wave))
+            retrieval_stats.record_wave(time.perf_counter() - started_at)
+            trace.queries_run += len(wave)
+
+            previous_keys = top_keys(fused)
+            fused = fuse(ranked_lists, method="rrf")
+            if top_keys(fused) == previous_keys and i + 1 < len(waves):
+                trace.path = "early_exit"
+                trace.saved_ms = (
+                    retrieval_stats.estimated_saving(False, len(waves) - i - 1) * 1e3
+                )
+                break
+
+    except SchedulerError:
+        raise
+    except Exception as e:
+        print(f"Error in the expanded retrieval: {e}")
+
+    return fused
+
+
+async def aretrieve_adaptive_context(
+    user_message: str, k: int = CONTEXT_CANDIDATES
+) -> Tuple[List[Tuple[Document, float]], Dict[str, Any]]:
+    """
+    Top `k` documents with their scores, like `aretrieve_scored_context`, and
+    the trace of the path the turn took
+    """
+    started_at = time.perf_counter()
+
+    if not ADAPTIVE_RETRIEVAL:
+        scored_documents = await aretrieve_scored_context(user_message, k)
+        trace = RetrievalTrace(
+            path="full", latency_ms=(time.perf_counter() - started_at) * 1e3
+        )
+        retrieval_stats.record(trace)
+        return scored_documents, asdict(trace)
+
+    # The planner is only needed when the question itself doesn't retrieve
+    # confidently enough
+    (probe_dense,) = await aget_scored_passages_many([user_message], keep_accents=True)
+    probe_lists = [probe_dense, *lexical_search_many([user_message])]
+    trace = RetrievalTrace(path="expanded", confidence=confidence(probe_dense))
+    plan = query_plan_cache.get(normalize_user_message(user_message))
+
+    if ADAPTIVE_CONFIDENCE is not None and trace.confidence >= ADAPTIVE_CONFIDENCE:
+        trace.path = "direct"
+        trace.queries_run = 1
+        planner_skipped = plan is None and not is_keyword_query(user_message)
+        planned = (
+            len(clean_queries(plan.queries))
+            if plan is not None
+            else retrieval_stats.average_planned_queries()
+        )
+        trace.saved_ms = (
+            retrieval_stats.estimated_saving(
+                planner_skipped, math.ceil(planned / ADAPTIVE_WAVE_SIZE)
+            )
+            * 1e3
+        )
+        scored_documents = fuse(probe_lists, method="rrf")
+    else:
+        if plan is None:
+            planner_started_at = time.perf_counter()
+            plan = await aplan_queries(user_message)
+            retrieval_stats.record_planner(
+                time.perf_counter() - planner_started_at,
+                len(clean_queries(plan.queries)),
+            )
+
+        queries = clean_queries(plan.queries)
+        trace.queries_planned = len(queries)
+        scored_documents = await afan_out(queries, probe_lists, trace)
+        trace.queries_run += 1
+        if trace.path == "expanded":
+            # What the direct path would have missed, for the calibration
+            confidence_log.record(
+                trace.confidence,
+                agreement(fuse(probe_lists, method="rrf"), scored_documents),
+            )
+
+    if RERANK_ENABLED:
+        # CPU bound, kept off the event loop. The passages are English, but
+        # direct turns may have no translation
+        scored_documents = await asyncio.to_thread(
+            rerank,
+            plan.translation if plan is not None else user_message,
+            scored_documents,
+        )
+
+    trace.latency_ms = (time.perf_counter() - started_at) * 1e3
+    retrieval_stats.record(trace)
+    return scored_documents[:k], asdict(trace)
+
+
+def calibrate(path: str, target: float = ADAPTIVE_TARGET_AGREEMENT):
+    """Prints the ADAPTIVE_CONFIDENCE calibrated on a confidence log"""
+    samples = load_confidence_samples(path)
+    threshold = calibrate_confidence(samples, target=target)
+    print(f"{len(samples)} expanded turns, target agreement {target:g}")
+    print(f"ADAPTIVE_CONFIDENCE={threshold if threshold is not None else ''}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "calibrate":
+        print(
+            "Usage: python -m rag.adaptive_retrieval calibrate <log.jsonl> [agreement]"
+        )
+    else:
+        calibrate(sys.argv[2], *(float(target) for target in sys.argv[3:4]))
@@ -0,0 +1,274 @@
+"""
+Semantic cache of validated answers.
+
+Students often ask the same question in slightly different words. The user
+question is embedded and compared with the cached questions, and when one is
+similar enough and was asked in the same conversation context, its answer and
+sources are returned without running the graph.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langgraph.graph.message import AnyMessage
+
+from embeddings.local_index import (
+    DOCUMENTS_FILE,
+    INDEX_FILE,
+    LOCAL_INDEX_PATH,
+    normalize_rows,
+)
+from embeddings.manifest import (
+    INGEST_MANIFEST_PATH,
+    IngestManifest,
+    fetch_published_version,
+)
+from lib.llm import AkashModels, get_akash_embedding_model
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 60 * 60)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+# Seconds between two reads of the corpus version published by ingestion
+CORPUS_VERSION_CHECK_INTERVAL = float(os.getenv("CORPUS_VERSION_CHECK_INTERVAL", "60"))
+
+# Number of previous messages that must match for a cached answer to be reused
+CONTEXT_MESSAGES = 4
+
+
+class CorpusVersion:
+    """
+    Changes whenever the ingested documents change. Combines `CORPUS_VERSION`,
+    the local index files, the ingest manifest when ingestion runs on this
+    host and the version the last ingestion published to Supabase. The last
+    two are read in background at most every `interval` seconds
+    """
+
+    def __init__(self, interval: float = CORPUS_VERSION_CHECK_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._ingested = ""
+        self._checked_at = float("-inf")
+        self._refreshing = False
+
+    def _refresh(self):
+        try:
+            versions = []
+            if os.path.exists(INGEST_MANIFEST_PATH):
+                manifest = IngestManifest(INGEST_MANIFEST_PATH)
+                versions.append(manifest.version())
+                manifest.close()
+
+            from embeddings.main import vector_store_registry
+
+            client = vector_store_registry.get_client()
+            versions.append(fetch_published_version(client) or "")
+            with self._lock:
+                self._ingested = ":".join(versions)
+        except Exception as e:
+            # Keeps the last known version, the next check tries again
+            print(f"Error reading the corpus version: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def ingested(self) -> str:
+        with self._lock:
+            stale = time.monotonic() - self._checked_at >= self.interval
+            if stale and not self._refreshing:
+                self._checked_at = time.monotonic()
+                self._refreshing = True
+                # Off the request path, lookups use the last known version
+                threading.Thread(
+                    target=self._refresh, name="corpus-version", daemon=True
+                ).start()
+            return self._ingested
+
+    def get(self) -> str:
+        version = os.getenv("CORPUS_VERSION", "")
+        # The pointer is replaced on every write, the documents file only
+        # changes for indexes written before it existed
+        for file_name in (INDEX_FILE, DOCUMENTS_FILE, "bm25_documents.json"):
+            file_path = os.path.join(LOCAL_INDEX_PATH, file_name)
+            if os.path.exists(file_path):
+                version += f":{os.path.getmtime(file_path)}"
+        return f"{version}:{self.ingested()}"
+
+
+corpus_version = CorpusVersion()
+
+
+def get_corpus_version() -> str:
+    """Changes whenever the ingested documents change"""
+    return corpus_version.get()
+
+
+def message_content(message: Any) -> str:
+    return message.content if hasattr(message, "content") else str(message)
+
+
+def context_fingerprint(messages: List[AnyMessage]) -> str:
+    """Hash of the messages that precede the question"""
+    digest = hashlib.sha256()
+    for message in messages[-CONTEXT_MESSAGES - 1 : -1]:
+        digest.update(" ".join(message_content(message).split()).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    context: List[str]
+    embedding: np.ndarray
+    context_key: str
+    created_at: float = field(default_factory=time.time)
+
+
+class SemanticAnswerCache:
+    """Thread-safe semantic cache with TTL and LRU eviction"""
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl: float = ANSWER_CACHE_TTL,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.corpus_version = get_corpus_version()
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_id = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.saved_seconds = 0.0
+        self._graph_seconds = 0.0
+        self._graph_runs = 0
+
+    def embed(self, question: str) -> np.ndarray:
+        embedding_model = get_akash_embedding_model(AkashModels.BAAI_BGE_LARGE)
+        return normalize_rows(np.asarray(embedding_model.embed_query(question)))
+
+    async def aembed(self, question: str) -> np.ndarray:
+        embedding_model = get_akash_embedding_model(AkashModels.BAAI_BGE_LARGE)
+        return normalize_rows(np.asarray(await embedding_model.aembed_query(question)))
+
+    def _check_corpus_version(self):
+        corpus_version = get_corpus_version()
+        if corpus_version != self.corpus_version:
+            self._entries.clear()
+            self.corpus_version = corpus_version
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            key
+            for key, entry in self._entries.items()
+            if now - entry.created_at > self.ttl
+        ]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(
+        self, messages: List[AnyMessage], embedding: Optional[np.ndarray] = None
+    ) -> Optional[CachedAnswer]:
+        started_at = time.perf_counter()
+        question = message_content(messages[-1])
+        context_key = context_fingerprint(messages)
+
+        if embedding is None:
+            embedding = self.embed(question)
+
+        with self._lock:
+            self._check_corpus_version()
+            self._evict_expired()
+
+            candidates = [
+                (key, entry)
+                for key, entry in self._entries.items()
+                if entry.context_key == context_key
+            ]
+
+            best = None
+            if candidates:
+                matrix = np.stack([entry.embedding for _, entry in candidates])
+                scores = matrix @ embedding
+                best_index = int(np.argmax(scores))
+                if scores[best_index] >= self.threshold:
+                    best_key, best = candidates[best_index]
+                    self._entries.move_to_end(best_key)
+
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self._graph_runs:
+                    self.saved_seconds += self._graph_seconds / self._graph_runs
+            self.lookup_seconds += time.perf_counter() - started_at
+
+        return best
+
+    def store(
+        self,
+        messages: List[AnyMessage],
+        answer: str,
+        context: List[str],
+        embedding: Optional[np.ndarray] = None,
+    ):
+        """Only call it with answers that passed the hallucination detector"""
+        question = message_content(messages[-1])
+        if embedding is None:
+            embedding = self.embed(question)
+
+        with self._lock:
+            self._check_corpus_version()
+            self._entries[self._next_id] = CachedAnswer(
+                question=question,
+                answer=answer,
+                context=context,
+                embedding=embedding,
+                context_key=context_fingerprint(messages),
+            )
+            self._next_id += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_graph_run(self, seconds: float):
+        """Latency of an uncached turn, used to estimate the time saved by hits"""
+        with self._lock:
+            self._graph_seconds += seconds
+            self._graph_runs += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "avg_lookup_ms": self.lookup_seconds / lookups * 1e3
+                if lookups
+                else 0.0,
+                "avg_graph_s": (
+                    self._graph_seconds / self._graph_runs if self._graph_runs else 0.0
+                ),
+                "saved_s": self.saved_seconds,
+            }
+
+
+answer_cache = SemanticAnswerCache()
@@ -1,90 +1,101 @@
-import concurrent.futures
-
-from langgraph.graph.message import AnyMessage
-
-from embeddings.main import get_passages
-from lib.llm import AkashModels, get_akash_chat_model, remove_think_tokens
-from rag.models import QueryGenerator
-from rag.prompt import TRANSLATE_USER_MESSAGE_PROMPT
-
-
-def translate_user_message(user_message: AnyMessage):
-    reasoner_model = get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0.6)
-
-    translated_message = remove_think_tokens(
-        reasoner_model.invoke(
-            TRANSLATE_USER_MESSAGE_PROMPT.format(user_message=user_message)
-        ).content
-    )
-
-    return translated_message
-
-
-def generate_queries(user_message: str):
-    translated_message = translate_user_message(user_message)
-
-    # Divide the message in n queries
-    reasoner_model = get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0.6)
-    structured_output_model = reasoner_model.with_structured_output(QueryGenerator)
-
-    result = structured_output_model.invoke(translated_message)
-    queries = result.queries
-
+import asyncio
+import os
+
+from langchain_core.documents import Document
+
+from embeddings.lexical_index import is_keyword_query, lexical_search_many
+from embeddings.main import aget_passages_many
+from lib.embedding_cache import normalize_text
+from lib.llm import AkashModels, get_akash_chat_model
+from lib.scheduler import SchedulerError, scheduler
+from lib.ttl_cache import TTLCache
+from rag.context_builder import CONTEXT_CANDIDATES
+from rag.fusion import fuse
+from rag.models import QueryPlan
+from rag.prompt import QUERY_PLANNER_PROMPT
+from rag.reranker import RERANK_ENABLED, rerank
+
+QUERY_PLAN_CACHE_TTL = float(os.getenv("QUERY_PLAN_CACHE_TTL", str(24 * 60 * 60)))
+QUERY_PLAN_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_PLAN_CACHE_MAX_ENTRIES", "5000"))
+
+query_plan_cache = TTLCache(
+    max_entries=QUERY_PLAN_CACHE_MAX_ENTRIES, ttl=QUERY_PLAN_CACHE_TTL
+)
+
+
+def normalize_user_message(user_message: str) -> str:
+    return normalize_text(user_message).lower().strip(" ?!.¿¡")
+
+
+async def aplan_queries(user_message: str) -> QueryPlan:
+    """
+    Translates the user message and generates its search queries in a single
+    structured call. Plans are cached, and short keyword questions skip the LLM
+    """
+    cache_key = normalize_user_message(user_message)
+    plan = query_plan_cache.get(cache_key)
+    if plan is not None:
+        return plan
+
+    if is_keyword_query(user_message):
+        # Acronyms and identifiers read the same in Spanish and English
+        plan = QueryPlan(translation=user_message, queries=[user_message])
+    else:
+        try:
+            planner_model = get_akash_chat_model(
+                AkashModels.DEEPSEEK_R1_14B, 0, QueryPlan
+            )
+            async with scheduler.slot("llm"):
+                plan = await planner_model.ainvoke(
+                    QUERY_PLANNER_PROMPT.format(user_message=user_message)
+                )
+        except SchedulerError:
+            raise
+        except Exception as e:
+            print(f"Error planning queries: {e}")
+            # Not cached, so the next turn tries the planner again
+            return QueryPlan(translation=user_message, queries=[user_message])
+
+    query_plan_cache.set(cache_key, plan)
+    return plan
+
+
+def clean_queries(queries: list) -> list[str]:
     # Ensure all queries are strings
-    string_queries = []
-    for i, query in enumerate(queries):
-        if isinstance(query, str):
-            string_queries.append(query)
-        else:
-            # Convert to string if it's not already
-            string_queries.append(str(query))
-
-    return string_queries[:10]
-
+    return [query if isinstance(query, str) else str(query) for query in queries][:10]
 
-def reciprocal_rank_fusion(results):
-    fused_documents = {}
-    k = 60
 
-    for rank, doc in enumerate(results):
-        doc_str = str(doc)
+async def aretrieve_and_fuse(queries: list[str]) -> list[tuple[Document, float]]:
+    """Fused documents of every query with their fusion scores, best first"""
+    # The local BM25 lookup is cheap, so it runs for every query
+    lexical_results = lexical_search_many(queries)
 
-        # If the document is not yet in the fused_documents dictionary,
-        # add it with an initial score of 0
-        if doc_str not in fused_documents:
-            fused_documents[doc_str] = 0
-
-        # Update the score of the document using the RRF formula: 1 / (rank + k)
-        fused_documents[doc_str] += 1 / (rank + k)
-
-    # final reranked result
-    reranked_results = [
-        doc
-        for doc, _ in sorted(fused_documents.items(), key=lambda x: x[1], reverse=True)
+    # Keyword-style queries with lexical hits don't need the remote dense search
+    dense_queries = [
+        query
+        for query, lexical_result in zip(queries, lexical_results)
+        if not (lexical_result and is_keyword_query(query))
     ]
 
-    return reranked_results
-
-
-def retrieve_and_rerank(queries: list[str]):
-    # Use ThreadPoolExecutor to run queries in parallel
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Get passages for each query in parallel
-        query_results = list(executor.map(get_passages, queries))
+    # Embed every query in one call and fan out the searches on the same loop
+    dense_results = await aget_passages_many(dense_queries) if dense_queries else []
 
-        # Flatten the list of lists into a single list
-        results = []
-        for query_result in query_results:
-            results.extend(query_result)
+    return fuse([*dense_results, *lexical_results], method="rrf")
 
-    return reciprocal_rank_fusion(results)
 
+async def aretrieve_scored_context(
+    user_message: str, k: int = CONTEXT_CANDIDATES
+) -> list[tuple[Document, float]]:
+    """Top `k` fused (and reranked, if enabled) documents with their scores"""
+    plan = await aplan_queries(user_message)
+    queries = clean_queries(plan.queries)
 
-def retrieve_context(user_message: str):
-    # Divide the message in n queries
-    queries = generate_queries(user_message)
+    scored_documents = await aretrieve_and_fuse(queries)
 
-    # Retrieve passages for all the queries
-    passages = retrieve_and_rerank(queries)
+    if RERANK_ENABLED:
+        # CPU bound, kept off the event loop
+        scored_documents = await asyncio.to_thread(
+            rerank, plan.translation, scored_documents
+        )
 
-    return passages[:5]
+    return scored_documents[:k]
@@ -0,0 +1,243 @@
+"""
+Token-budgeted packing of the retrieved passages.
+
+The fused documents of a turn often overlap: consecutive chunks share the
+splitter's 100 characters, and different queries return near-duplicates of
+the same text. The builder drops near-duplicates (MinHash estimate of the
+Jaccard similarity of word shingles), merges chunks that continue each other
+inside the same section and then fills the token budget greedily by score.
+Passages are rendered with their section only, not the `Document` repr.
+
+Compare the token counts before and after packing with:
+
+    python -m rag.context_builder
+"""
+
+import os
+import zlib
+from dataclasses import dataclass, field
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.tokens import count_tokens
+from rag.fusion import document_key
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
+# Estimated Jaccard similarity over which a passage is a near-duplicate
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+# Number of fused documents considered for the context
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "10"))
+
+SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 64
+MERSENNE_PRIME = (1 << 31) - 1
+# Shortest suffix/prefix match taken as a splitter overlap, and the longest
+# one searched (the splitter overlaps at most 100 characters)
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 300
+
+_rng = np.random.default_rng(0)
+_hash_a = _rng.integers(1, MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_hash_b = _rng.integers(0, MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+@dataclass
+class ContextPassage:
+    document: Document
+    score: float
+    signature: np.ndarray = field(repr=False)
+
+    @property
+    def section(self) -> str:
+        return section_of(self.document)
+
+
+def section_of(document: Document) -> str:
+    headers = [document.metadata.get(key) for key in ("Header 1", "Header 2")]
+    return " > ".join(header for header in headers if header)
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    words = text.lower().split()
+    shingles = {
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+    }
+    hashes = np.array(
+        [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64
+    )
+    # Every (a * x + b) mod p is one permutation, all computed at once
+    permuted = (np.outer(hashes, _hash_a) + _hash_b) % MERSENNE_PRIME
+    return permuted.min(axis=0)
+
+
+def estimated_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+def overlap_length(previous: str, following: str) -> int:
+    """Length of the longest suffix of `previous` that starts `following`"""
+    longest = min(len(previous), len(following), MAX_OVERLAP_CHARS)
+    for length in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(following[:length]):
+            return length
+    return 0
+
+
+def deduplicate(passages: List[ContextPassage]) -> List[ContextPassage]:
+    """Keeps the best scored passage of every group of near-duplicates"""
+    kept: List[ContextPassage] = []
+    for passage in passages:
+        text = passage.document.page_content
+        if any(
+            text in other.document.page_content
+            or estimated_similarity(passage.signature, other.signature)
+            >= CONTEXT_DEDUP_THRESHOLD
+            for other in kept
+        ):
+            continue
+        kept.append(passage)
+    return kept
+
+
+def chunk_ids(document: Document) -> List[str]:
+    if "chunk_ids" in document.metadata:
+        return list(document.metadata["chunk_ids"])
+    chunk_id = document.metadata.get("chunk_id")
+    return [chunk_id] if chunk_id else []
+
+
+def merge_adjacent(passages: List[ContextPassage]) -> List[ContextPassage]:
+    """Joins passages of the same section that continue each other"""
+    passages = list(passages)
+    merged = True
+    while merged:
+        merged = False
+        for first in passages:
+            for second in passages:
+                if first is second or first.section != second.section:
+                    continue
+                overlap = overlap_length(
+                    first.document.page_content, second.document.page_content
+                )
+                if not overlap:
+                    continue
+
+                text = (
+                    first.document.page_content
+                    + (second.document.page_content[overlap:])
+                )
+                metadata = {
+                    key: value
+                    for key, value in first.document.metadata.items()
+                    if key not in ("chunk_id", "chunk_ids")
+                }
+                # The stored chunks behind the passage, see `afetch_vectors`
+                first_ids = chunk_ids(first.document)
+                second_ids = chunk_ids(second.document)
+                if first_ids and second_ids:
+                    metadata["chunk_ids"] = first_ids + second_ids
+                combined = ContextPassage(
+                    document=Document(page_content=text, metadata=metadata),
+                    score=max(first.score, second.score),
+                    signature=np.minimum(first.signature, second.signature),
+                )
+                passages = [
+                    passage
+                    for passage in passages
+                    if passage is not first and passage is not second
+                ]
+                passages.append(combined)
+                merged = True
+                break
+            if merged:
+                break
+
+    return sorted(passages, key=lambda passage: passage.score, reverse=True)
+
+
+def render_passage(passage: ContextPassage) -> str:
+    section = passage.section
+    text = passage.document.page_content.strip()
+    return f"[{section}]\n{text}" if section else text
+
+
+def build_context(
+    scored_documents: Sequence[Tuple[Document, float]],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> List[Tuple[str, Document]]:
+    """
+    Returns the rendered passages that fit in `token_budget`, best first,
+    together with their (possibly merged) documents
+    """
+    seen = set()
+    passages = []
+    for document, score in scored_documents[:CONTEXT_CANDIDATES]:
+        key = document_key(document)
+        if key in seen or not document.page_content.strip():
+            continue
+        seen.add(key)
+        passages.append(
+            ContextPassage(
+                document=document,
+                score=score,
+                signature=minhash_signature(document.page_content),
+            )
+        )
+
+    packed = []
+    for passage in merge_adjacent(deduplicate(passages)):
+        rendered = render_passage(passage)
+        tokens = count_tokens(rendered)
+        # Greedy: a passage that doesn't fit leaves room for smaller ones
+        if tokens > token_budget:
+            continue
+        token_budget -= tokens
+        packed.append((rendered, passage.document))
+
+    return packed
+
+
+if __name__ == "__main__":
+    import random
+
+    rng = random.Random(0)
+    vocabulary = [f"term{i}" for i in range(400)]
+    sections = [
+        {"Header 1": "Inmunoglobulinas", "Header 2": f"Clase {i}"} for i in range(4)
+    ]
+
+    # Consecutive chunks sharing 100 characters, like the ingestion splitter
+    corpus = []
+    for metadata in sections:
+        text = " ".join(rng.choice(vocabulary) for _ in range(600))
+        start = 0
+        while start < len(text) - 200:
+            corpus.append(
+                Document(page_content=text[start : start + 1000], metadata=metadata)
+            )
+            start += 900
+
+    # Fused results of several queries: a near-duplicate of the best chunk
+    # (same text, different trimming) and two consecutive chunks
+    results = [
+        corpus[0],
+        Document(page_content=corpus[0].page_content[30:], metadata=sections[0]),
+        corpus[5],
+        corpus[6],
+        corpus[12],
+        *rng.sample(corpus[13:], 4),
+    ]
+    scored = [(doc, 1 / (rank + 61)) for rank, doc in enumerate(results)]
+
+    # Same five documents the graph used to send as str(doc)
+    before = sum(count_tokens(str(doc)) for doc, _ in scored[:5])
+    after = sum(count_tokens(text) for text, _ in build_context(scored[:5]))
+    print(f"top 5 as str(doc): {before} tokens")
+    print(f"top 5 packed:      {after} tokens")
+
+    packed = build_context(scored)
+    after = sum(count_tokens(text) for text, _ in packed)
+    print(f"{len(scored)} candidates packed: {after} tokens in {len(packed)} passages")
@@ -1,84 +1,365 @@
+import asyncio
+import os
+import time
+import uuid
+from dataclasses import asdict
+from functools import cache
 from typing import Dict
 
+from langchain_core.messages import AIMessage, message_chunk_to_message
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import BaseMessage
 
+from embeddings.main import afetch_vectors, get_knowledge_db
+from lib.event_loop import run_sync
 from lib.llm import (
     AkashModels,
     get_akash_chat_model,
     get_structured_output_with_retry,
     remove_think_tokens,
 )
-from rag.context import retrieve_context
-from rag.models import DEFAULT_ANSWER, HallucinationDetector
+from lib.scheduler import SchedulerError, current_session, scheduler
+from lib.tokens import count_tokens
+from rag.adaptive_retrieval import aretrieve_adaptive_context
+from rag.answer_cache import ANSWER_CACHE_ENABLED, answer_cache
+from rag.context_builder import build_context
+from rag.memory import (
+    PROMPT_TOKEN_BUDGET,
+    asummarize,
+    fit_to_budget,
+    render_messages,
+    window_start,
+)
+from rag.models import (
+    BUSY_ANSWER,
+    DEFAULT_ANSWER,
+    HallucinationDetector,
+    QueryPlan,
+)
 from rag.prompt import HALLUCINATION_DETECTOR_PROMPT, RESPONSE_GENERATION_PROMPT
+from rag.reranker import get_reranker
 from rag.state import InputState, OutputState, OverallState
+from rag.validation import build_scorer, tiered_verdict
+from rag.verifier import IncrementalVerifier
+
+# Tag of the LLM run whose tokens are streamed to the user
+FINAL_ANSWER_TAG = "final_answer"
+
+# Verify answer chunks while they are generated instead of after the answer
+INCREMENTAL_VERIFICATION = (
+    os.getenv("INCREMENTAL_VERIFICATION", "true").lower() == "true"
+)
 
 
-def retrieve_passages(state: OverallState):
+async def retrieve_passages(state: OverallState):
     user_message = state.get("messages", "")[-1].content
 
-    passages = retrieve_context(user_message)
+    scored_documents, retrieval = await aretrieve_adaptive_context(user_message)
+
+    # Deduplicated, merged and trimmed to the context token budget
+    packed = build_context(scored_documents)
+    documents = [document for _, document in packed]
 
-    return {"context": passages}
+    return {
+        "context": [text for text, _ in packed],
+        "documents": documents,
+        # Read once here, so validation never embeds the passages again
+        "passage_vectors": await afetch_vectors(documents),
+        "retrieval": retrieval,
+    }
 
 
-def generate_response(state: OverallState) -> Dict[str, str]:
+async def generate_response(
+    state: OverallState, config: RunnableConfig
+) -> Dict[str, str]:
     chat_model = get_akash_chat_model(AkashModels.LLAMA_4, 0.5)
 
     messages = state.get("messages", [""])
     user_message = messages[-1]
-    previous_messages = messages[-5:-1] if len(messages) >= 5 else messages[:-1]
+    question = (
+        user_message.content if hasattr(user_message, "content") else user_message
+    )
+
+    # Every message the summary doesn't cover is sent. That is the window
+    # that fits the history budget, or more when the summary couldn't be
+    # updated this turn
+    history = messages[:-1]
+    start = state.get("summarized_messages", 0)
+    prompt_without_context = RESPONSE_GENERATION_PROMPT.format(
+        context="",
+        summary=state.get("summary") or "-",
+        previous_messages=render_messages(history[start:]) or "-",
+        question=question,
+    )
+
+    # Passages fill whatever is left of the prompt budget, best first
+    context = fit_to_budget(
+        state.get("context", []),
+        PROMPT_TOKEN_BUDGET - count_tokens(prompt_without_context),
+    )
     prompt = RESPONSE_GENERATION_PROMPT.format(
-        context=state.get("context", ""),
-        previous_messages=previous_messages,
-        question=user_message.content
-        if hasattr(user_message, "content")
-        else user_message,
+        context="\n\n".join(context),
+        summary=state.get("summary") or "-",
+        previous_messages=render_messages(history[start:]) or "-",
+        question=question,
     )
 
-    response = chat_model.invoke(prompt)
+    verifier = None
+    if INCREMENTAL_VERIFICATION:
+        scorer = await asyncio.to_thread(
+            build_scorer,
+            [doc.page_content for doc in state.get("documents", [])],
+            state.get("passage_vectors"),
+        )
+        verifier = IncrementalVerifier(state.get("context", []), scorer=scorer)
 
-    return {"response": response}
+    # Stream the answer so callbacks receive every token as it is generated.
+    # The "llm" slot is held for the whole stream, the verifier's judge calls
+    # take "judge" slots instead so they are never queued behind it
+    response = None
+    async with scheduler.slot("llm"):
+        async for chunk in chat_model.astream(
+            prompt, config=merge_configs(config, {"tags": [FINAL_ANSWER_TAG]})
+        ):
+            response = chunk if response is None else response + chunk
+            if verifier is not None and isinstance(chunk.content, str):
+                verifier.feed(chunk.content)
 
+    if verifier is not None:
+        verifier.close()
 
-def hallucination_detector(state: OverallState):
-    hallucination_detector = get_structured_output_with_retry(
-        HallucinationDetector,
-        HALLUCINATION_DETECTOR_PROMPT.format(
-            response=state.get("response", "").content,
-            documents=state.get("context", ""),
-        ),
-    )
+    if response is None:
+        return {"response": AIMessage(content=""), "verifier": verifier}
 
-    if hallucination_detector.is_hallucination:
+    return {"response": message_chunk_to_message(response), "verifier": verifier}
+
+
+async def hallucination_detector(state: OverallState):
+    verifier = state.get("verifier")
+    response = state.get("response", "")
+
+    if verifier is not None:
+        # Most checks already ran while the answer was being generated
+        claim_results = await verifier.aresults()
+    else:
+        documents = "\n\n".join(state.get("context", []))
+
+        def judge() -> bool | None:
+            result = get_structured_output_with_retry(
+                HallucinationDetector,
+                HALLUCINATION_DETECTOR_PROMPT.format(
+                    response=response.content, documents=documents
+                ),
+            )
+            return None if result is None else not result.is_hallucination
+
+        def validate():
+            scorer = build_scorer(
+                [doc.page_content for doc in state.get("documents", [])],
+                state.get("passage_vectors"),
+            )
+            return tiered_verdict(response.content, scorer, judge)
+
+        # The judge is a blocking call that takes a "judge" scheduler slot
+        claim_results = [await asyncio.to_thread(validate)]
+
+    claim_verdicts = [asdict(result) for result in claim_results]
+
+    hallucinated = IncrementalVerifier.aggregate(claim_results)
+    if hallucinated:
         response_message = BaseMessage(content=str(DEFAULT_ANSWER), type="ai")
-        return {"messages": [response_message]}
+        return {
+            "messages": [response_message],
+            "is_validated": False,
+            "claim_verdicts": claim_verdicts,
+        }
+
+    # Undecided answers (no claims, or checks that failed or timed out) are
+    # shown but not validated, so the answer cache never stores them
+    return {
+        "messages": response,
+        "is_validated": hallucinated is False,
+        "claim_verdicts": claim_verdicts,
+    }
 
-    return {"messages": state.get("response", "")}
+
+async def summarize_history(state: OverallState):
+    """
+    Folds the messages that left the history window into the running summary.
+    Runs in parallel with the retrieval
+    """
+    history = state.get("messages", [])[:-1]
+    summarized_messages = state.get("summarized_messages", 0)
+    start = window_start(history)
+    if start <= summarized_messages:
+        return {}
+
+    summary = await asummarize(
+        state.get("summary", ""), history[summarized_messages:start]
+    )
+    if summary is None:
+        # The next turn tries again with the same messages
+        return {}
+
+    return {"summary": summary, "summarized_messages": start}
 
 
 def get_workflow():
     graph_builder = StateGraph(OverallState, input=InputState, output=OutputState)
 
     graph_builder.add_node("retrieve_passages", retrieve_passages)
+    graph_builder.add_node("summarize_history", summarize_history)
     graph_builder.add_node("generate_response", generate_response)
     graph_builder.add_node("hallucination_detector", hallucination_detector)
 
     graph_builder.add_edge(START, "retrieve_passages")
-    graph_builder.add_edge("retrieve_passages", "generate_response")
+    graph_builder.add_edge(START, "summarize_history")
+    graph_builder.add_edge(
+        ["retrieve_passages", "summarize_history"], "generate_response"
+    )
     graph_builder.add_edge("generate_response", "hallucination_detector")
     graph_builder.add_edge("hallucination_detector", END)
 
     return graph_builder.compile()
 
 
-def invoke_graph(messages, callables):
-    runnable = get_workflow()
+@cache
+def get_compiled_workflow():
+    """The graph is compiled once per process and reused by every turn"""
+    return get_workflow()
+
+
+def warm_up():
+    """
+    Builds everything a turn needs ahead of the first user message: the
+    compiled graph, the chat and embedding clients and the vector store
+    """
+    get_compiled_workflow()
+    get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0, QueryPlan)
+    get_akash_chat_model(AkashModels.LLAMA_4, 0.5)
+    get_akash_chat_model(AkashModels.LLAMA_4, 0)
+    get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0, HallucinationDetector)
+    get_knowledge_db()
+    # Loads the cross-encoder when reranking is enabled
+    get_reranker()
+
+
+async def ainvoke_graph(
+    messages,
+    callables,
+    session_id: str | None = None,
+    memory: dict | None = None,
+):
+    """
+    Runs a turn on the event loop. Every remote call of the turn goes through
+    the process scheduler, queued fairly with the other sessions' calls.
+    `memory` is the conversation summary returned by the previous turn and
+    `messages` the ones it doesn't cover (see `rag.memory.advance_memory`)
+    """
+    runnable = get_compiled_workflow()
 
     # Ensure the callables parameter is a list as you can have multiple callbacks
     if not isinstance(callables, list):
         raise TypeError("callables must be a list")
 
-    # Invoke the graph with the current messages and callback configuration
-    return runnable.invoke({"messages": messages}, config={"callbacks": callables})
+    current_session.set(session_id or uuid.uuid4().hex)
+    config = {"callbacks": callables}
+    memory = memory or {}
+    graph_input = {"messages": messages, **memory}
+
+    try:
+        if not ANSWER_CACHE_ENABLED:
+            # Invoke the graph with the current messages and callback configuration
+            return await runnable.ainvoke(graph_input, config=config)
+
+        try:
+            question_embedding = await answer_cache.aembed(messages[-1].content)
+        except SchedulerError:
+            raise
+        except Exception as e:
+            print(f"Error embedding question for the answer cache: {e}")
+            return await runnable.ainvoke(graph_input, config=config)
+
+        cached_answer = answer_cache.lookup(messages, embedding=question_embedding)
+        if cached_answer is not None:
+            return {
+                "messages": [*messages, AIMessage(content=cached_answer.answer)],
+                "context": cached_answer.context,
+                "is_validated": True,
+                **memory,
+            }
+
+        started_at = time.perf_counter()
+        # Invoke the graph with the current messages and callback configuration
+        result = await runnable.ainvoke(graph_input, config=config)
+        answer_cache.record_graph_run(time.perf_counter() - started_at)
+
+    except SchedulerError as e:
+        # Backpressure: tell the student to come back instead of waiting forever
+        print(f"Turn of session {current_session.get()} not admitted: {e}")
+        return {
+            "messages": [*messages, AIMessage(content=BUSY_ANSWER)],
+            "context": [],
+            "is_validated": False,
+            **memory,
+        }
+
+    # Only answers that passed the hallucination detector are reused
+    if result.get("is_validated"):
+        answer_cache.store(
+            messages,
+            result["messages"][-1].content,
+            result.get("context", []),
+            embedding=question_embedding,
+        )
+
+    return result
+
+
+def invoke_graph(
+    messages,
+    callables,
+    session_id: str | None = None,
+    memory: dict | None = None,
+):
+    """Blocking entry point for callers without an event loop, like Streamlit"""
+    return run_sync(ainvoke_graph(messages, callables, session_id, memory))
+
+
+if __name__ == "__main__":
+    # Per-turn setup overhead: rebuilding everything vs the long-lived runtime
+    from langchain_openai import ChatOpenAI
+
+    def legacy_turn_setup():
+        get_workflow()
+        for model, temperature, schema in [
+            (AkashModels.DEEPSEEK_R1_14B, 0.6, None),
+            (AkashModels.DEEPSEEK_R1_14B, 0.6, QueryPlan),
+            (AkashModels.LLAMA_4, 0.5, None),
+            (AkashModels.DEEPSEEK_R1_14B, 0, HallucinationDetector),
+        ]:
+            chat_model = ChatOpenAI(
+                model=model.value, temperature=temperature, api_key="benchmark"
+            )
+            if schema is not None:
+                chat_model.with_structured_output(schema)
+
+    def cached_turn_setup():
+        get_compiled_workflow()
+        get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0, QueryPlan)
+        get_akash_chat_model(AkashModels.LLAMA_4, 0.5)
+        get_akash_chat_model(AkashModels.DEEPSEEK_R1_14B, 0, HallucinationDetector)
+
+    started_at = time.perf_counter()
+    warm_up()
+    print(f"warm_up: {(time.perf_counter() - started_at) * 1e3:.1f} ms")
+
+    for name, fn in [("before", legacy_turn_setup), ("after", cached_turn_setup)]:
+        repeats = 20
+        started_at = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        elapsed = (time.perf_counter() - started_at) / repeats
+        print(f"{name:<7} per-turn overhead: {elapsed * 1e3:.2f} ms")
@@ -0,0 +1,95 @@
+"""
+Bounded conversation memory.
+
+The prompt only carries the newest messages that fit in a token window.
+Messages that leave the window are folded into a running summary a few at a
+time, so the summary is never rebuilt from the whole history. The summary
+travels in the graph state (`summary` and `summarized_messages`, the number
+of leading messages it covers). After a turn, callers drop the messages the
+summary covers (see `advance_memory`) and keep the summary instead, so
+neither the graph input nor the stored conversation grows without bound.
+"""
+
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from langgraph.graph.message import AnyMessage
+
+from lib.llm import AkashModels, get_akash_chat_model, remove_think_tokens
+from lib.scheduler import scheduler
+from lib.tokens import count_tokens
+from rag.answer_cache import message_content
+from rag.prompt import CONVERSATION_SUMMARY_PROMPT
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "150"))
+
+MEMORY_KEYS = ("summary", "summarized_messages")
+
+ROLE_NAMES = {"human": "Estudiante", "ai": "InmunoBot"}
+
+
+def memory_from_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """The part of a graph state callers keep between turns"""
+    return {key: state[key] for key in MEMORY_KEYS if key in state}
+
+
+def advance_memory(state: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    """
+    How many leading messages of the turn the summary covers, which callers
+    drop, and the memory to pass with the remaining messages next turn
+    """
+    memory = memory_from_state(state)
+    covered = memory.get("summarized_messages", 0)
+    return covered, {**memory, "summarized_messages": 0}
+
+
+def render_message(message: AnyMessage) -> str:
+    role = ROLE_NAMES.get(getattr(message, "type", ""), "InmunoBot")
+    return f"{role}: {' '.join(message_content(message).split())}"
+
+
+def render_messages(messages: List[AnyMessage]) -> str:
+    return "\n".join(render_message(message) for message in messages)
+
+
+def window_start(messages: List[AnyMessage], budget: int = HISTORY_TOKEN_BUDGET) -> int:
+    """Index of the oldest message of the newest run that fits in `budget`"""
+    used = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        used += count_tokens(render_message(messages[i])) + 1
+        if used > budget:
+            break
+        start = i
+    return start
+
+
+def fit_to_budget(texts: List[str], budget: int) -> List[str]:
+    """Leading texts whose tokens add up to at most `budget`"""
+    fitted = []
+    for text in texts:
+        budget -= count_tokens(text)
+        if budget < 0:
+            break
+        fitted.append(text)
+    return fitted
+
+
+async def asummarize(summary: str, messages: List[AnyMessage]) -> Optional[str]:
+    """Folds `messages` into `summary`. None if the summary couldn't be updated"""
+    try:
+        chat_model = get_akash_chat_model(AkashModels.LLAMA_4, 0)
+        async with scheduler.slot("llm"):
+            result = await chat_model.ainvoke(
+                CONVERSATION_SUMMARY_PROMPT.format(
+                    summary=summary or "-",
+                    messages=render_messages(messages),
+                    max_words=SUMMARY_MAX_WORDS,
+                )
+            )
+        return remove_think_tokens(result.content).strip()
+    except Exception as e:
+        print(f"Error summarizing the conversation: {e}")
+        return None
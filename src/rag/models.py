@@ -7,6 +7,12 @@ class HallucinationDetector(BaseModel):
     )
 
 
+class ClaimVerdict(BaseModel):
+    is_supported: bool = Field(
+        description="Whether the claim is supported by the retrieved documents"
+    )
+
+
 class QueryGenerator(BaseModel):
     """Generate search queries for document retrieval"""
 
@@ -17,7 +23,27 @@ class QueryGenerator(BaseModel):
     )
 
 
+class QueryPlan(BaseModel):
+    """English translation of the user message and the search queries for it"""
+
+    translation: str = Field(
+        description="The user message translated to clear, concise English"
+    )
+    queries: list[str] = Field(
+        default_factory=list,
+        min_length=1,
+        description="1 to 10 English search queries to retrieve documents",
+    )
+
+
+WELCOME_MESSAGE = "En que te puedo ayudar hoy?"
+
 DEFAULT_ANSWER = (
     "No tengo la respuesta para eso! \n\n"
     "Puedo responderte solamente sobre la bibliografía de Inmunología"
 )
+
+BUSY_ANSWER = (
+    "Hay muchas consultas en este momento! \n\n"
+    "Por favor, volvé a intentarlo en unos minutos"
+)
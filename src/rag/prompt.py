@@ -6,10 +6,13 @@ Keep your answer ground in the facts of the CONTEXT.
 CONSIDERATIONS:
 - The answer should be in Spanish.
 - The answer should be formal.
-- Maintain conversation continuity based on PREVIOUS_MESSAGES.
+- Maintain conversation continuity based on CONVERSATION_SUMMARY and PREVIOUS_MESSAGES.
 - Directly give the answer.
 - Do not mention "the context" directly. For example: the phrase "Según el contexto proporcionado" shouldnt be used. 
 
+CONVERSATION_SUMMARY:
+{summary}
+
 PREVIOUS_MESSAGES:
 {previous_messages}
 
@@ -21,17 +24,33 @@ CONTEXT:
 """
 
 
-TRANSLATE_USER_MESSAGE_PROMPT = """
-Translate the following user message to English:
+QUERY_PLANNER_PROMPT = """/no_think
+Translate the following user message to English and plan the searches needed
+to answer it from an immunology bibliography:
 {user_message}
 
-Focus on improving the user message to make it more understandable and clear in English.
-The translation should be concise and accurate.
+INSTRUCTIONS:
+- translation: the user message in clear and concise English.
+- queries: 1 to 10 short English search queries. Use one query for simple
+  questions and one query per sub-question for multi-part questions.
+- Keep technical terms such as CD4, IL-2 or MHC exactly as written.
+"""
+
+CONVERSATION_SUMMARY_PROMPT = """/no_think
+Update the summary of a conversation between a student and InmunoBot, an
+immunology assistant, with the new messages.
 
-RETURN FORMAT:
-- Only answer with the translated message.
-- Do not include any additional information.
-- The translation should be in English.
+CURRENT_SUMMARY:
+{summary}
+
+NEW_MESSAGES:
+{messages}
+
+INSTRUCTIONS:
+- Write the updated summary in Spanish, in at most {max_words} words.
+- Keep the topics asked about, the facts the student relies on and any open question.
+- Drop greetings and repeated information.
+- Only answer with the summary.
 """
 
 HALLUCINATION_DETECTOR_PROMPT = """
@@ -49,6 +68,23 @@ DOCUMENTS:
 RESULT:
 Is the response hallucinated? Yes/No
 """
+CLAIM_VERIFICATION_PROMPT = """/no_think
+INSTRUCTIONS:
+Assess whether the CLAIM, a fragment of a longer answer, is supported by the
+retrieved documents.
+Formatting, greetings or connecting sentences without factual content are supported.
+If the claim contains information not present in the documents, it is not supported.
+
+CLAIM:
+{claim}
+
+DOCUMENTS:
+{documents}
+
+RESULT:
+Is the claim supported by the documents? Yes/No
+"""
+
 QUERIES_GENERATOR_PROMPT = """
 **Objective**: Generate 5 diverse search queries tailored to retrieve information specifically from a document about biotechnology applications in veterinary vaccine development. The user's message is:
 
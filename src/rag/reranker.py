@@ -0,0 +1,272 @@
+"""
+Optional cross-encoder reranking of the fused candidates.
+
+A small cross-encoder scores every (query, passage) pair on CPU, in batches,
+with int8 dynamic quantization (torch) or an exported ONNX model. Scores are
+cached per (query hash, chunk key), and a latency budget truncates the
+candidate list: batches are scored in fusion order until the budget runs out,
+and only the scored candidates are kept.
+
+Enable it with RERANK_ENABLED=true. The default model is English, like the
+planned search queries; set RERANKER_MODEL to a multilingual cross-encoder
+(e.g. cross-encoder/mmarco-mMiniLMv2-L12-H384-v1) for Spanish passages.
+
+    python -m rag.reranker benchmark
+    python -m rag.reranker export-onnx .cache/reranker.onnx
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from functools import cache
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.embedding_cache import normalize_text
+from lib.ttl_cache import TTLCache
+from rag.fusion import document_key
+
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# "torch" (int8 dynamic quantization) or "onnx" (RERANKER_ONNX_PATH)
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "torch")
+RERANKER_ONNX_PATH = os.getenv("RERANKER_ONNX_PATH", ".cache/reranker.onnx")
+RERANK_QUANTIZE = os.getenv("RERANK_QUANTIZE", "true").lower() == "true"
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "384"))
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", str(min(os.cpu_count() or 1, 4))))
+# Fused candidates sent to the reranker
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+RERANK_LATENCY_BUDGET_MS = float(os.getenv("RERANK_LATENCY_BUDGET_MS", "300"))
+RERANK_CACHE_MAX_ENTRIES = int(os.getenv("RERANK_CACHE_MAX_ENTRIES", "50000"))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", str(24 * 60 * 60)))
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha1(normalize_text(query).lower().encode("utf-8")).hexdigest()
+
+
+class CrossEncoderReranker:
+    """CPU cross-encoder with a score cache and a per-call latency budget"""
+
+    def __init__(
+        self,
+        model_name: str = RERANKER_MODEL,
+        backend: str = RERANK_BACKEND,
+        batch_size: int = RERANK_BATCH_SIZE,
+        max_length: int = RERANK_MAX_LENGTH,
+        quantize: bool = RERANK_QUANTIZE,
+    ):
+        # Heavy optional dependencies, only imported when reranking is used
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache = TTLCache(
+            max_entries=RERANK_CACHE_MAX_ENTRIES, ttl=RERANK_CACHE_TTL
+        )
+        # One inference at a time: parallel calls would only fight for the
+        # same cores
+        self._lock = threading.Lock()
+
+        torch.set_num_threads(RERANK_THREADS)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        if backend == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = RERANK_THREADS
+            self.session = onnxruntime.InferenceSession(
+                RERANKER_ONNX_PATH, options, providers=["CPUExecutionProvider"]
+            )
+            self.model = None
+        else:
+            model = AutoModelForSequenceClassification.from_pretrained(model_name)
+            model.eval()
+            if quantize:
+                model = torch.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            self.model = model
+            self.session = None
+
+    def _score_batch(self, query: str, texts: List[str]) -> List[float]:
+        features = self.tokenizer(
+            [query] * len(texts),
+            texts,
+            padding=True,
+            truncation="only_second",
+            max_length=self.max_length,
+            return_tensors="np" if self.session is not None else "pt",
+        )
+
+        with self._lock:
+            if self.session is not None:
+                input_names = {node.name for node in self.session.get_inputs()}
+                logits = self.session.run(
+                    None,
+                    {
+                        name: value.astype(np.int64)
+                        for name, value in features.items()
+                        if name in input_names
+                    },
+                )[0]
+            else:
+                import torch
+
+                with torch.inference_mode():
+                    logits = self.model(**features).logits.float().numpy()
+
+        # Single-logit relevance models, or the "relevant" class otherwise
+        return logits[:, -1].tolist()
+
+    def score(
+        self, query: str, texts: Sequence[Tuple[str, str]], deadline: float
+    ) -> List[Optional[float]]:
+        """
+        Scores (key, text) pairs in order until `deadline` (perf_counter
+        time). Pairs left when the budget runs out get None
+        """
+        key_prefix = query_hash(query)
+        scores: List[Optional[float]] = [
+            self.cache.get((key_prefix, key)) for key, _ in texts
+        ]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        for start in range(0, len(missing), self.batch_size):
+            # The first batch always runs, so something is reranked
+            if start and time.perf_counter() >= deadline:
+                break
+            batch = missing[start : start + self.batch_size]
+            batch_scores = self._score_batch(query, [texts[i][1] for i in batch])
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+                self.cache.set((key_prefix, texts[i][0]), score)
+
+        return scores
+
+    def rerank(
+        self,
+        query: str,
+        scored_documents: Sequence[Tuple[Document, float]],
+        latency_budget_ms: float = RERANK_LATENCY_BUDGET_MS,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Candidates sorted by cross-encoder score. Candidates that couldn't be
+        scored within the latency budget are dropped
+        """
+        deadline = time.perf_counter() + latency_budget_ms / 1e3
+        scores = self.score(
+            query,
+            [(document_key(doc), doc.page_content) for doc, _ in scored_documents],
+            deadline,
+        )
+        reranked = [
+            (doc, score)
+            for (doc, _), score in zip(scored_documents, scores)
+            if score is not None
+        ]
+        return sorted(reranked, key=lambda x: x[1], reverse=True)
+
+
+@cache
+def get_reranker() -> Optional[CrossEncoderReranker]:
+    """The shared reranker, or None when disabled or it can't be loaded"""
+    if not RERANK_ENABLED:
+        return None
+    try:
+        return CrossEncoderReranker()
+    except Exception as e:
+        print(f"Error loading the reranker, using the fusion order: {e}")
+        return None
+
+
+def rerank(
+    query: str, scored_documents: Sequence[Tuple[Document, float]]
+) -> List[Tuple[Document, float]]:
+    """Reranks the candidates if reranking is enabled, else returns them as is"""
+    reranker = get_reranker()
+    if reranker is None or not scored_documents:
+        return list(scored_documents)
+    try:
+        return reranker.rerank(query, scored_documents[:RERANK_CANDIDATES])
+    except Exception as e:
+        print(f"Error reranking: {e}")
+        return list(scored_documents)
+
+
+def benchmark(candidate_counts: Sequence[int] = (5, 10, 20, 50), repeats: int = 3):
+    """Rerank time per candidate count on CPU, without the score cache"""
+    rng = np.random.default_rng(0)
+    vocabulary = [f"antigen{i}" for i in range(2000)]
+    passages = [
+        " ".join(rng.choice(vocabulary, 160)) for _ in range(max(candidate_counts))
+    ]
+    query = "How do B cells recognize antigens?"
+
+    configurations = [
+        ("fp32", {"backend": "torch", "quantize": False}),
+        ("int8", {"backend": "torch", "quantize": True}),
+    ]
+    if os.path.exists(RERANKER_ONNX_PATH):
+        configurations.append(("onnx", {"backend": "onnx"}))
+
+    for name, options in configurations:
+        reranker = CrossEncoderReranker(**options)
+        reranker._score_batch(query, passages[:2])  # warm up
+        for count in candidate_counts:
+            started_at = time.perf_counter()
+            for _ in range(repeats):
+                for start in range(0, count, reranker.batch_size):
+                    end = min(start + reranker.batch_size, count)
+                    reranker._score_batch(query, passages[start:end])
+            elapsed = (time.perf_counter() - started_at) / repeats
+            print(
+                f"{name} {count:>3} candidates: "
+                f"{elapsed * 1e3:8.1f} ms ({elapsed * 1e3 / count:.1f} ms each)"
+            )
+
+
+def export_onnx(path: str = RERANKER_ONNX_PATH, model_name: str = RERANKER_MODEL):
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+    features = tokenizer(["query"], ["passage"], return_tensors="pt")
+    input_names = list(features.keys())
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    torch.onnx.export(
+        model,
+        tuple(features[name] for name in input_names),
+        path,
+        input_names=input_names,
+        output_names=["logits"],
+        dynamic_axes={
+            **{name: {0: "batch", 1: "sequence"} for name in input_names},
+            "logits": {0: "batch"},
+        },
+        opset_version=17,
+    )
+    print(f"Exported {model_name} to {path}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "benchmark"
+    if command == "benchmark":
+        benchmark()
+    elif command == "export-onnx":
+        export_onnx(*sys.argv[2:3])
+    else:
+        print("Usage: python -m rag.reranker [benchmark | export-onnx [path]]")
@@ -0,0 +1,134 @@
+"""
+Server-side conversation storage.
+
+Histories live in a SQLite file (WAL mode), so every server worker of a host
+sees the same sessions. Each session keeps the messages its summary does not
+cover yet, which are the graph input, next to the full transcript shown to
+the student. Behind a load balancer spanning several hosts, route
+by session id or point `SESSION_STORE_PATH` at shared storage.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", ".cache/sessions.sqlite3")
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 60 * 60)))
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+class SessionStore:
+    """Message histories by session id, expired `ttl` seconds after last use"""
+
+    def __init__(self, path: str = SESSION_STORE_PATH, ttl: float = SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                messages TEXT NOT NULL,
+                memory TEXT NOT NULL DEFAULT '{}',
+                transcript TEXT NOT NULL DEFAULT '[]',
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._migrate()
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_updated_at "
+            "ON sessions (updated_at)"
+        )
+        self._connection.commit()
+
+    def _migrate(self):
+        """Adds the columns that stores created by older versions lack"""
+        columns = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(sessions)")
+        }
+        if "memory" not in columns:
+            self._connection.execute(
+                "ALTER TABLE sessions ADD COLUMN memory TEXT NOT NULL DEFAULT '{}'"
+            )
+        if "transcript" not in columns:
+            self._connection.execute(
+                "ALTER TABLE sessions ADD COLUMN transcript TEXT NOT NULL DEFAULT '[]'"
+            )
+
+    def load(
+        self, session_id: str
+    ) -> Tuple[List[BaseMessage], Dict[str, Any], List[BaseMessage]]:
+        """
+        Unsummarized messages, conversation memory (see `rag.memory`) and full
+        transcript of a session
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT messages, memory, transcript, updated_at "
+                "FROM sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+
+        if row is None or time.time() - row[3] > self.ttl:
+            return [], {}, []
+        messages = messages_from_dict(json.loads(row[0]))
+        # Sessions stored before the transcript column only have the window
+        transcript = messages_from_dict(json.loads(row[2])) or messages
+        return messages, json.loads(row[1]), transcript
+
+    def get(self, session_id: str) -> List[BaseMessage]:
+        """Full transcript of a session, for display"""
+        return self.load(session_id)[2]
+
+    def save(
+        self,
+        session_id: str,
+        messages: List[BaseMessage],
+        memory: Dict[str, Any] | None = None,
+        transcript: List[BaseMessage] | None = None,
+    ):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sessions "
+                "(id, messages, memory, transcript, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    session_id,
+                    json.dumps(messages_to_dict(messages)),
+                    json.dumps(memory or {}),
+                    json.dumps(messages_to_dict(transcript or messages)),
+                    now,
+                ),
+            )
+            self._connection.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)
+            )
+            self._connection.commit()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,5 +1,6 @@
-from typing import Annotated, TypedDict
+from typing import Annotated, Any, TypedDict
 
+from langchain_core.documents import Document
 from langgraph.graph.message import AnyMessage, add_messages
 
 
@@ -7,16 +8,27 @@ class InputState(TypedDict):
     """Input state for the RAG model."""
 
     messages: Annotated[list[AnyMessage], add_messages]
+    # Running summary of the first `summarized_messages` messages
+    summary: str
+    summarized_messages: int
 
 
 class OutputState(InputState):
     """Output state for the RAG model."""
 
-    pass
+    context: list[str]
+    is_validated: bool
+    claim_verdicts: list[dict]
+    # Path and latency of the adaptive retrieval, see `rag.adaptive_retrieval`
+    retrieval: dict
 
 
 class OverallState(InputState, OutputState):
     """Overall state for the RAG model."""
 
-    context: str
+    documents: list[Document]
+    # Stored embeddings of `documents`, None where a passage has no stored row
+    passage_vectors: list
     response: AnyMessage
+    # IncrementalVerifier checking the answer while it is generated
+    verifier: Any
@@ -0,0 +1,349 @@
+"""
+Tiered validation of generated answers.
+
+The first tier is local: every sentence is scored by its embedding similarity
+to the closest retrieved passage, blended with the share of its terms found in
+the passages. Clearly grounded text is accepted without calling the LLM judge,
+everything else escalates to it, and when the judge is unavailable the
+`JUDGE_FALLBACK` policy decides.
+
+The local tier is off (no passage or sentence is embedded, every text goes
+straight to the judge) until GROUNDEDNESS_ACCEPT or GROUNDEDNESS_REJECT is set,
+and both should come from labelled turns: the Spanish answers are scored
+against English passages, so no fixed default is meaningful. Setting
+GROUNDEDNESS_LOG_PATH turns the scoring on to collect them: every judged text
+is logged with its local score, and after labelling (a "label" field overrides
+the judge verdict) the thresholds are calibrated with:
+
+    python -m rag.validation calibrate groundedness.jsonl [precision]
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from embeddings.lexical_index import tokenize
+from embeddings.local_index import normalize_rows
+from lib.llm import AkashModels, get_akash_embedding_model
+
+# Both unset until calibrated: between them everything goes to the judge
+GROUNDEDNESS_ACCEPT = (
+    float(os.getenv("GROUNDEDNESS_ACCEPT"))
+    if os.getenv("GROUNDEDNESS_ACCEPT")
+    else None
+)
+GROUNDEDNESS_REJECT = (
+    float(os.getenv("GROUNDEDNESS_REJECT"))
+    if os.getenv("GROUNDEDNESS_REJECT")
+    else None
+)
+GROUNDEDNESS_EMBEDDING_WEIGHT = float(os.getenv("GROUNDEDNESS_EMBEDDING_WEIGHT", "0.7"))
+# JSONL of local scores and judge verdicts, for the calibration. Off when empty
+GROUNDEDNESS_LOG_PATH = os.getenv("GROUNDEDNESS_LOG_PATH", "")
+# Scoring only pays off with a threshold to decide on, or a log to calibrate them
+GROUNDEDNESS_LOCAL_TIER = (
+    GROUNDEDNESS_ACCEPT is not None
+    or GROUNDEDNESS_REJECT is not None
+    or bool(GROUNDEDNESS_LOG_PATH)
+)
+# "local": decide with the calibrated thresholds and leave the rest undecided,
+# "reject" or "accept": fixed verdict
+JUDGE_FALLBACK = os.getenv("JUDGE_FALLBACK", "local")
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?:])\s+|\n+")
+
+
+@dataclass
+class ClaimResult:
+    text: str
+    is_supported: Optional[bool]
+    # "local", "llm", "fallback" or "timeout"
+    tier: str = "llm"
+    score: Optional[float] = None
+
+
+class ValidationMetrics:
+    """Per-tier latency and escalation rate of the validation engine"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decisions: Dict[str, int] = {"local": 0, "llm": 0, "fallback": 0}
+        self.seconds: Dict[str, float] = {"local": 0.0, "llm": 0.0}
+        self.calls: Dict[str, int] = {"local": 0, "llm": 0}
+
+    def record_latency(self, tier: str, seconds: float):
+        with self._lock:
+            self.seconds[tier] += seconds
+            self.calls[tier] += 1
+
+    def record_decision(self, tier: str):
+        with self._lock:
+            self.decisions[tier] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = sum(self.decisions.values())
+            escalated = self.decisions["llm"] + self.decisions["fallback"]
+            return {
+                **{
+                    f"{tier}_decisions": count for tier, count in self.decisions.items()
+                },
+                **{
+                    f"{tier}_avg_ms": self.seconds[tier] / self.calls[tier] * 1e3
+                    if self.calls[tier]
+                    else 0.0
+                    for tier in self.seconds
+                },
+                "escalation_rate": escalated / total if total else 0.0,
+            }
+
+
+validation_metrics = ValidationMetrics()
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in SENTENCE_SPLIT.split(text) if sentence]
+
+
+def content_tokens(text: str) -> set:
+    return {token for token in tokenize(text) if len(token) > 2}
+
+
+class GroundednessScorer:
+    """Scores text against the passages retrieved for the turn"""
+
+    def __init__(
+        self,
+        passages: List[str],
+        vectors: Optional[Sequence[Optional[List[float]]]] = None,
+    ):
+        self.embedding_model = get_akash_embedding_model(AkashModels.BAAI_BGE_LARGE)
+        # Stored vectors come with the retrieval, only the passages without
+        # one are embedded
+        vectors = list(vectors) if vectors else [None] * len(passages)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.embedding_model.embed_documents(
+                [passages[i] for i in missing]
+            )
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        self.passage_vectors = normalize_rows(np.asarray(vectors))
+        self.passage_tokens = content_tokens(" ".join(passages))
+        self.passage_token_sets = [content_tokens(passage) for passage in passages]
+        # Similarity of every passage to the texts scored last, by text
+        self._relevance: Dict[str, np.ndarray] = {}
+        self._relevance_lock = threading.Lock()
+
+    def score(self, text: str) -> float:
+        """Score of the least grounded sentence, between 0 and 1"""
+        sentences = []
+        sentence_tokens = []
+        for sentence in split_sentences(text):
+            tokens = content_tokens(sentence)
+            # Headings and connectors carry no claim
+            if tokens:
+                sentences.append(sentence)
+                sentence_tokens.append(tokens)
+
+        if not sentences or len(self.passage_vectors) == 0:
+            return 1.0
+
+        vectors = normalize_rows(
+            np.asarray(self.embedding_model.embed_documents(sentences))
+        )
+        matrix = vectors @ self.passage_vectors.T
+        similarities = matrix.max(axis=1)
+        with self._relevance_lock:
+            self._relevance[text] = matrix.max(axis=0)
+        overlaps = np.array(
+            [
+                len(tokens & self.passage_tokens) / len(tokens)
+                for tokens in sentence_tokens
+            ]
+        )
+
+        weight = GROUNDEDNESS_EMBEDDING_WEIGHT
+        scores = weight * similarities + (1 - weight) * overlaps
+        return float(scores.min())
+
+    def relevant_passages(self, text: str, limit: int) -> List[int]:
+        """
+        Indexes of the `limit` passages closest to `text`, in passage order.
+        Reuses the similarities computed when `text` was scored, and falls
+        back to shared terms when it wasn't
+        """
+        with self._relevance_lock:
+            relevance = self._relevance.pop(text, None)
+        if relevance is None:
+            tokens = content_tokens(text)
+            relevance = np.array(
+                [len(tokens & passage) for passage in self.passage_token_sets]
+            )
+        return sorted(np.argsort(-relevance, kind="stable")[:limit].tolist())
+
+
+def build_scorer(
+    passages: List[str], vectors: Optional[Sequence[Optional[List[float]]]] = None
+) -> Optional[GroundednessScorer]:
+    """The turn's scorer, None when there are no passages or the tier is off"""
+    if not passages or not GROUNDEDNESS_LOCAL_TIER:
+        return None
+    try:
+        return GroundednessScorer(passages, vectors)
+    except Exception as e:
+        print(f"Error building the groundedness scorer: {e}")
+        return None
+
+
+def local_verdict(score: Optional[float]) -> Optional[bool]:
+    """
+    True only above a calibrated GROUNDEDNESS_ACCEPT, False only below a
+    calibrated GROUNDEDNESS_REJECT, None if it must be escalated
+    """
+    if score is None:
+        return None
+    if GROUNDEDNESS_ACCEPT is not None and score >= GROUNDEDNESS_ACCEPT:
+        return True
+    if GROUNDEDNESS_REJECT is not None and score < GROUNDEDNESS_REJECT:
+        return False
+    return None
+
+
+def fallback_verdict(score: Optional[float]) -> Optional[bool]:
+    """Verdict when the judge failed, None leaves the text undecided"""
+    if JUDGE_FALLBACK == "accept":
+        return True
+    if JUDGE_FALLBACK == "reject":
+        return False
+    return local_verdict(score)
+
+
+class ScoreLog:
+    """Appends local scores and judge verdicts to a JSONL file"""
+
+    def __init__(self, path: str = GROUNDEDNESS_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, text: str, score: float, is_supported: bool):
+        if not self.path:
+            return
+        line = json.dumps(
+            {"text": text, "score": score, "judge": is_supported},
+            ensure_ascii=False,
+        )
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Error logging the groundedness score: {e}")
+
+
+score_log = ScoreLog()
+
+
+def calibrate_thresholds(
+    samples: Sequence[Tuple[float, bool]],
+    precision: float = 0.95,
+    min_samples: int = 30,
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (accept, reject) thresholds from (score, is_supported) samples: the lowest
+    score above which at least `precision` of the samples are supported, and
+    the highest score below which at least `precision` are not. None when no
+    threshold keeps `min_samples` samples on its side
+    """
+    scores = np.array([score for score, _ in samples], dtype=np.float64)
+    supported = np.array([label for _, label in samples], dtype=bool)
+
+    accept = None
+    for threshold in np.unique(scores):
+        above = supported[scores >= threshold]
+        if len(above) >= min_samples and above.mean() >= precision:
+            accept = float(threshold)
+            break
+
+    reject = None
+    for threshold in np.unique(scores)[::-1]:
+        below = ~supported[scores < threshold]
+        if len(below) >= min_samples and below.mean() >= precision:
+            reject = float(threshold)
+            break
+
+    return accept, reject
+
+
+def tiered_verdict(
+    text: str,
+    scorer: Optional[GroundednessScorer],
+    judge: Callable[[], Optional[bool]],
+) -> ClaimResult:
+    """
+    Runs the local tier and escalates to `judge` (which returns whether the text
+    is supported, or None if the judge failed) only when it is ambiguous
+    """
+    score = None
+    if scorer is not None:
+        started_at = time.perf_counter()
+        try:
+            score = scorer.score(text)
+        except Exception as e:
+            print(f"Error scoring groundedness: {e}")
+        validation_metrics.record_latency("local", time.perf_counter() - started_at)
+
+        verdict = local_verdict(score)
+        if verdict is not None:
+            validation_metrics.record_decision("local")
+            return ClaimResult(
+                text=text, is_supported=verdict, tier="local", score=score
+            )
+
+    started_at = time.perf_counter()
+    is_supported = judge()
+    validation_metrics.record_latency("llm", time.perf_counter() - started_at)
+
+    if is_supported is None:
+        validation_metrics.record_decision("fallback")
+        return ClaimResult(
+            text=text,
+            is_supported=fallback_verdict(score),
+            tier="fallback",
+            score=score,
+        )
+
+    validation_metrics.record_decision("llm")
+    if score is not None:
+        score_log.record(text, score, is_supported)
+    return ClaimResult(text=text, is_supported=is_supported, tier="llm", score=score)
+
+
+def calibrate(path: str, precision: float = 0.95):
+    """Prints the thresholds calibrated on a labelled score log"""
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            samples.append((entry["score"], bool(entry.get("label", entry["judge"]))))
+
+    accept, reject = calibrate_thresholds(samples, precision=precision)
+    print(f"{len(samples)} labelled texts, precision {precision:g}")
+    # Left unset (no local verdict) when no threshold is precise enough
+    print(f"GROUNDEDNESS_ACCEPT={accept if accept is not None else ''}")
+    print(f"GROUNDEDNESS_REJECT={reject if reject is not None else ''}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "calibrate":
+        print("Usage: python -m rag.validation calibrate <log.jsonl> [precision]")
+    else:
+        calibrate(sys.argv[2], *(float(precision) for precision in sys.argv[3:4]))
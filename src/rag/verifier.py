@@ -0,0 +1,186 @@
+"""
+Incremental hallucination checking of a streamed answer.
+
+While the answer is being generated, every finished paragraph (or sentence
+group for long paragraphs) is verified against the retrieved passages in a
+bounded thread pool, so most of the validation overlaps with generation. Each
+claim goes through the tiered validation of `rag.validation`, and the judge
+only gets the passages closest to the claim.
+"""
+
+import asyncio
+import contextvars
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Optional, Sequence
+
+from lib.llm import get_structured_output_with_retry
+from rag.models import ClaimVerdict
+from rag.prompt import CLAIM_VERIFICATION_PROMPT
+from rag.validation import (
+    ClaimResult,
+    GroundednessScorer,
+    content_tokens,
+    tiered_verdict,
+)
+
+VERIFIER_MAX_WORKERS = int(os.getenv("VERIFIER_MAX_WORKERS", "8"))
+# Seconds the turn waits for the pending checks once the answer is generated
+VERIFIER_TIMEOUT = float(os.getenv("VERIFIER_TIMEOUT", "30"))
+# Passages sent to the judge with every claim
+VERIFIER_CLAIM_PASSAGES = int(os.getenv("VERIFIER_CLAIM_PASSAGES", "3"))
+
+# Chunks shorter than this (headings, list intros) are merged with the next one
+MIN_CLAIM_CHARS = 120
+# Paragraphs longer than this are split into sentence groups
+MAX_CLAIM_CHARS = 800
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+# Shared by every session so the number of in-flight checks stays bounded
+_executor = ThreadPoolExecutor(
+    max_workers=VERIFIER_MAX_WORKERS, thread_name_prefix="claim-verifier"
+)
+
+
+def split_long_paragraph(paragraph: str) -> List[str]:
+    if len(paragraph) <= MAX_CLAIM_CHARS:
+        return [paragraph]
+
+    groups, current = [], ""
+    for sentence in SENTENCE_SPLIT.split(paragraph):
+        if current and len(current) + len(sentence) > MAX_CLAIM_CHARS:
+            groups.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        groups.append(current)
+    return groups
+
+
+def relevant_passages(
+    claim: str,
+    passages: Sequence[str],
+    scorer: Optional[GroundednessScorer] = None,
+    limit: int = VERIFIER_CLAIM_PASSAGES,
+) -> List[str]:
+    """The passages closest to the claim, instead of every retrieved passage"""
+    if len(passages) <= limit:
+        return list(passages)
+    if scorer is not None:
+        indexes = scorer.relevant_passages(claim, limit)
+    else:
+        tokens = content_tokens(claim)
+        overlaps = [len(tokens & content_tokens(passage)) for passage in passages]
+        ranked = sorted(range(len(passages)), key=lambda i: -overlaps[i])
+        indexes = sorted(ranked[:limit])
+    return [passages[i] for i in indexes]
+
+
+def verify_claim(
+    claim: str,
+    passages: Sequence[str],
+    scorer: Optional[GroundednessScorer] = None,
+) -> ClaimResult:
+    """Local groundedness check first, the LLM judge only for ambiguous claims"""
+
+    def judge() -> Optional[bool]:
+        documents = "\n\n".join(relevant_passages(claim, passages, scorer))
+        verdict = get_structured_output_with_retry(
+            ClaimVerdict,
+            CLAIM_VERIFICATION_PROMPT.format(claim=claim, documents=documents),
+        )
+        return None if verdict is None else verdict.is_supported
+
+    return tiered_verdict(claim, scorer, judge)
+
+
+class IncrementalVerifier:
+    """Collects streamed tokens and verifies each finished chunk in background"""
+
+    def __init__(
+        self, passages: Sequence[str], scorer: Optional[GroundednessScorer] = None
+    ):
+        # The scorer, when given, must be built from the same passages
+        self.passages = list(passages)
+        self.scorer = scorer
+        self._buffer = ""
+        self._pending_claim = ""
+        self._futures: List[Future] = []
+        self._claims: List[str] = []
+        self._lock = threading.Lock()
+
+    def _submit(self, text: str, final: bool = False):
+        claim = f"{self._pending_claim}\n\n{text}".strip()
+        if not claim:
+            return
+        if len(claim) < MIN_CLAIM_CHARS and not final:
+            self._pending_claim = claim
+            return
+
+        self._pending_claim = ""
+        for part in split_long_paragraph(claim):
+            # Run in the caller's context so the checks count for its session
+            context = contextvars.copy_context()
+            self._claims.append(part)
+            self._futures.append(
+                _executor.submit(
+                    context.run, verify_claim, part, self.passages, self.scorer
+                )
+            )
+
+    def feed(self, token: str):
+        with self._lock:
+            self._buffer += token
+            while "\n\n" in self._buffer:
+                paragraph, self._buffer = self._buffer.split("\n\n", 1)
+                self._submit(paragraph)
+
+    def close(self):
+        """Submits whatever is left once generation finished"""
+        with self._lock:
+            self._submit(self._buffer, final=True)
+            self._buffer = ""
+
+    def _collect(self, done: set) -> List[ClaimResult]:
+        results = []
+        for future, claim in zip(self._futures, self._claims):
+            if future in done:
+                results.append(future.result())
+            else:
+                # Not started checks are dropped, running ones finish unused
+                future.cancel()
+                results.append(
+                    ClaimResult(text=claim, is_supported=None, tier="timeout")
+                )
+        return results
+
+    def results(self, timeout: float = VERIFIER_TIMEOUT) -> List[ClaimResult]:
+        """
+        Waits at most `timeout` seconds for every submitted check. Checks that
+        didn't finish are undecided
+        """
+        done, _ = wait(self._futures, timeout=timeout)
+        return self._collect(done)
+
+    async def aresults(self, timeout: float = VERIFIER_TIMEOUT) -> List[ClaimResult]:
+        """`results` without blocking the event loop"""
+        if not self._futures:
+            return []
+        wrapped = {asyncio.wrap_future(future): future for future in self._futures}
+        done, _ = await asyncio.wait(wrapped, timeout=timeout)
+        return self._collect({wrapped[future] for future in done})
+
+    @staticmethod
+    def aggregate(results: List[ClaimResult]) -> Optional[bool]:
+        """
+        True if some claim is unsupported, False if every claim is supported and
+        None if it can't be decided, which includes answers without claims
+        """
+        if any(result.is_supported is False for result in results):
+            return True
+        if not results or any(result.is_supported is None for result in results):
+            return None
+        return False
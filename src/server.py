@@ -0,0 +1,272 @@
+"""
+Headless HTTP service for InmunoBot.
+
+The compiled graph, the model clients and the request scheduler are shared by
+every request of the worker, and conversations are stored server side, so a
+client only sends the new message and its session id. Run it from `src` with:
+
+    python server.py
+
+Endpoints:
+
+    POST   /chat            {"message", "session_id"?}, answer streamed as SSE
+    POST   /batch           {"questions": [...]}, answered concurrently
+    GET    /sessions/{id}   summary and the full transcript
+    DELETE /sessions/{id}
+    GET    /health          scheduler, cache, validation and retrieval stats
+
+SSE events of /chat: `session`, `status` (graph node being run), `token`,
+`final` (the answer, which replaces the streamed text if it was retracted)
+and `error`.
+"""
+
+import asyncio
+import json
+import os
+import weakref
+from typing import Any, Dict, List
+
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from lib.llm import aclose_chat_http_clients
+from lib.scheduler import scheduler
+from rag.adaptive_retrieval import retrieval_stats
+from rag.answer_cache import answer_cache
+from rag.graph import FINAL_ANSWER_TAG, ainvoke_graph, warm_up
+from rag.memory import advance_memory
+from rag.models import WELCOME_MESSAGE
+from rag.sessions import SessionStore, new_session_id
+from rag.validation import validation_metrics
+
+load_dotenv()
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "100"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+GRAPH_NODES = ("retrieve_passages", "generate_response", "hallucination_detector")
+
+
+class SSEQueueHandler(AsyncCallbackHandler):
+    """Puts the graph progress and the answer tokens on a queue"""
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.started_nodes = set()
+
+    async def on_chain_start(
+        self, serialized, inputs, *, run_id, tags=None, metadata=None, **kwargs
+    ):
+        node = (metadata or {}).get("langgraph_node")
+        if node in GRAPH_NODES and node not in self.started_nodes:
+            self.started_nodes.add(node)
+            self.queue.put_nowait(("status", {"node": node}))
+
+    async def on_llm_new_token(self, token: str, *, tags=None, **kwargs):
+        if token and FINAL_ANSWER_TAG in (tags or []):
+            self.queue.put_nowait(("token", {"text": token}))
+
+
+def message_to_json(message: BaseMessage) -> Dict[str, str]:
+    role = "user" if isinstance(message, HumanMessage) else "assistant"
+    return {"role": role, "content": message.content}
+
+
+async def send_event(response: web.StreamResponse, event: str, data: Any):
+    payload = json.dumps(data, ensure_ascii=False)
+    await response.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+
+
+async def read_json(request: web.Request) -> Dict[str, Any]:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="The body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="The body must be a JSON object")
+    return body
+
+
+def session_lock(app: web.Application, session_id: str) -> asyncio.Lock:
+    """Turns of the same session run one at a time"""
+    locks = app["session_locks"]
+    lock = locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[session_id] = lock
+    return lock
+
+
+async def chat(request: web.Request) -> web.StreamResponse:
+    body = await read_json(request)
+    message = str(body.get("message", "")).strip()
+    if not message:
+        raise web.HTTPBadRequest(text="message is required")
+    session_id = str(body.get("session_id") or new_session_id())
+    store: SessionStore = request.app["session_store"]
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
+    await send_event(response, "session", {"session_id": session_id})
+
+    async with session_lock(request.app, session_id):
+        history, memory, transcript = await asyncio.to_thread(store.load, session_id)
+        if not history:
+            history = [AIMessage(content=WELCOME_MESSAGE)]
+            transcript = transcript or history
+        messages = [*history, HumanMessage(content=message)]
+
+        queue: asyncio.Queue = asyncio.Queue()
+        turn = asyncio.create_task(
+            ainvoke_graph(messages, [SSEQueueHandler(queue)], session_id, memory)
+        )
+        turn.add_done_callback(lambda _: queue.put_nowait(None))
+
+        try:
+            while (event := await queue.get()) is not None:
+                await send_event(response, *event)
+            result = await turn
+        except (ConnectionResetError, asyncio.CancelledError):
+            # The client went away, stop spending upstream capacity on it
+            turn.cancel()
+            raise
+        except Exception as e:
+            print(f"Error answering session {session_id}: {e}")
+            await send_event(response, "error", {"message": str(e)})
+            return response
+
+        answer = result["messages"][-1].content
+        turn_messages = [HumanMessage(content=message), AIMessage(content=answer)]
+        # Messages folded into the summary are not sent to the graph again,
+        # but stay in the transcript the student sees
+        covered, memory = advance_memory(result)
+        await asyncio.to_thread(
+            store.save,
+            session_id,
+            [*history, *turn_messages][covered:],
+            memory,
+            [*transcript, *turn_messages],
+        )
+
+    await send_event(
+        response,
+        "final",
+        {
+            "answer": answer,
+            "is_validated": result.get("is_validated", False),
+            "context": result.get("context", []),
+        },
+    )
+    await response.write_eof()
+    return response
+
+
+async def batch(request: web.Request) -> web.Response:
+    body = await read_json(request)
+    questions = body.get("questions")
+    if not isinstance(questions, list) or not questions:
+        raise web.HTTPBadRequest(text="questions must be a non-empty list")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise web.HTTPBadRequest(text=f"At most {BATCH_MAX_QUESTIONS} questions")
+
+    # All questions of the batch share one scheduler session, so a large batch
+    # gets a fair share of the upstreams and chat users keep theirs
+    batch_session_id = f"batch-{new_session_id()}"
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def answer(question: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                result = await ainvoke_graph(
+                    [HumanMessage(content=str(question))], [], batch_session_id
+                )
+            except Exception as e:
+                print(f"Error answering batch question: {e}")
+                return {"question": question, "error": str(e)}
+
+        return {
+            "question": question,
+            "answer": result["messages"][-1].content,
+            "is_validated": result.get("is_validated", False),
+            "context": result.get("context", []),
+        }
+
+    answers: List[Dict[str, Any]] = await asyncio.gather(
+        *(answer(question) for question in questions)
+    )
+    return web.json_response({"answers": answers})
+
+
+async def get_session(request: web.Request) -> web.Response:
+    store: SessionStore = request.app["session_store"]
+    _, memory, transcript = await asyncio.to_thread(
+        store.load, request.match_info["session_id"]
+    )
+    return web.json_response(
+        {
+            "messages": [message_to_json(message) for message in transcript],
+            "summary": memory.get("summary", ""),
+        }
+    )
+
+
+async def delete_session(request: web.Request) -> web.Response:
+    store: SessionStore = request.app["session_store"]
+    await asyncio.to_thread(store.delete, request.match_info["session_id"])
+    return web.json_response({"deleted": True})
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response(
+        {
+            "status": "ok",
+            "scheduler": scheduler.stats(),
+            "answer_cache": answer_cache.stats(),
+            "validation": validation_metrics.stats(),
+            "retrieval": retrieval_stats.stats(),
+        }
+    )
+
+
+async def on_startup(app: web.Application):
+    # Compile the graph and build the clients before the first request
+    await asyncio.to_thread(warm_up)
+
+
+async def on_cleanup(app: web.Application):
+    app["session_store"].close()
+    await aclose_chat_http_clients()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app["session_store"] = SessionStore()
+    app["session_locks"] = weakref.WeakValueDictionary()
+
+    app.add_routes(
+        [
+            web.post("/chat", chat),
+            web.post("/batch", batch),
+            web.get("/sessions/{session_id}", get_session),
+            web.delete("/sessions/{session_id}", delete_session),
+            web.get("/health", health),
+        ]
+    )
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    # reuse_port lets several worker processes listen on the same port
+    web.run_app(create_app(), host=SERVER_HOST, port=SERVER_PORT, reuse_port=True)
@@ -0,0 +1,95 @@
+import numpy as np
+
+from embeddings.ann_index import (
+    IVFIndex,
+    build_from_local_index,
+    exact_search,
+    synthetic_vectors,
+)
+from embeddings.local_index import LocalVectorIndex, update_local_index
+
+DIMENSION = 16
+
+
+def build_local_index(path, vectors):
+    ids = [f"row-{i}" for i in range(len(vectors))]
+    return LocalVectorIndex.build(
+        path, ids, [f"content {id_}" for id_ in ids], [{}] * len(ids), vectors
+    )
+
+
+def test_probing_every_list_matches_the_exact_search():
+    vectors = synthetic_vectors(300, DIMENSION)
+    index = IVFIndex.build(vectors, nlist=8)
+    queries = vectors[:10]
+
+    ids, scores = index.search(queries, k=5, nprobe=index.nlist)
+    exact_ids, exact_scores = exact_search(vectors, queries, 5)
+
+    assert ids.tolist() == exact_ids.tolist()
+    np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+
+def test_lists_hold_row_positions_not_vectors(tmp_path):
+    vectors = synthetic_vectors(100, DIMENSION)
+    index = IVFIndex.build(vectors, nlist=4)
+    file_path = str(tmp_path / "ann.npz")
+    index.save(file_path)
+
+    loaded = IVFIndex.load(file_path)
+
+    assert "vectors" not in np.load(file_path).files
+    assert sorted(np.concatenate(loaded._list_ids).tolist()) == list(range(100))
+
+
+def test_remap_shifts_the_kept_rows_and_drops_the_removed_ones():
+    vectors = synthetic_vectors(50, DIMENSION)
+    index = IVFIndex.build(vectors, nlist=4)
+    keep = np.ones(50, dtype=bool)
+    keep[[0, 10, 49]] = False
+    positions = np.full(50, -1, dtype=np.int64)
+    positions[keep] = np.arange(int(keep.sum()))
+
+    index.remap(positions)
+    index.attach(vectors[keep])
+
+    assert len(index) == 47
+    ids, _ = index.search(vectors[[1, 11]], k=1, nprobe=index.nlist)
+    assert ids[:, 0].tolist() == [0, 9]
+
+
+def test_incremental_updates_keep_the_ann_index_aligned(tmp_path):
+    path = str(tmp_path)
+    vectors = synthetic_vectors(200, DIMENSION)
+    build_local_index(path, vectors[:150])
+    build_from_local_index(path, nlist=8)
+
+    index = update_local_index(
+        path,
+        ids=[f"row-{i}" for i in range(150, 200)],
+        contents=[f"content row-{i}" for i in range(150, 200)],
+        metadatas=[{}] * 50,
+        embeddings=vectors[150:].tolist(),
+        removed_ids=["row-0", "row-75"],
+    )
+
+    assert index.ann is not None
+    assert len(index.ann) == len(index) == 198
+    queries = vectors[[1, 76, 160, 199]]
+    ids, _ = index.ann.search(queries, k=1, nprobe=index.ann.nlist)
+    assert [index.records[i]["id"] for i in ids[:, 0]] == [
+        "row-1",
+        "row-76",
+        "row-160",
+        "row-199",
+    ]
+    # The rebuilt generation still loads with its ANN index
+    reloaded = LocalVectorIndex.load(path)
+    assert reloaded.ann is not None
+    results = reloaded.search_many(queries.tolist(), k=1)
+    assert [result[0][0].id for result in results] == [
+        "row-1",
+        "row-76",
+        "row-160",
+        "row-199",
+    ]
@@ -0,0 +1,129 @@
+import pytest
+from langchain_core.documents import Document
+
+from rag.fusion import RRF_K, document_key, fuse
+
+
+def doc(name: str) -> Document:
+    return Document(page_content=f"content of {name}", metadata={"chunk_id": name})
+
+
+def keys(fused):
+    return [document_key(document) for document, _ in fused]
+
+
+def scores(fused):
+    return {document_key(document): score for document, score in fused}
+
+
+A, B, C, D = doc("a"), doc("b"), doc("c"), doc("d")
+
+
+def test_rrf_sums_reciprocal_ranks_across_lists():
+    fused = fuse([[A, B, C], [B, D]], method="rrf")
+
+    assert keys(fused) == ["b", "a", "d", "c"]
+    assert scores(fused)["b"] == pytest.approx(1 / (2 + RRF_K) + 1 / (1 + RRF_K))
+    assert scores(fused)["c"] == pytest.approx(1 / (3 + RRF_K))
+
+
+def test_rrf_matches_documents_by_chunk_id_not_object():
+    same_chunk = Document(page_content="other rendering", metadata={"chunk_id": "a"})
+
+    fused = fuse([[A], [same_chunk]], method="rrf")
+
+    assert keys(fused) == ["a"]
+    assert scores(fused)["a"] == pytest.approx(2 / (1 + RRF_K))
+
+
+def test_rrf_counts_only_the_best_rank_of_a_repeated_chunk():
+    fused = fuse([[A, B, A]], method="rrf")
+
+    assert scores(fused)["a"] == pytest.approx(1 / (1 + RRF_K))
+
+
+def test_rrf_ties_keep_first_seen_order():
+    fused = fuse([[A, B], [B, A]], method="rrf")
+
+    assert scores(fused)["a"] == pytest.approx(scores(fused)["b"])
+    assert keys(fused) == ["a", "b"]
+
+
+def test_weighted_rrf_scales_each_list():
+    fused = fuse([[A, B], [B, A]], method="rrf", weights=[1.0, 3.0])
+
+    assert keys(fused) == ["b", "a"]
+    assert scores(fused)["b"] == pytest.approx(1 / (2 + RRF_K) + 3 / (1 + RRF_K))
+
+
+def test_zero_weight_list_adds_nothing():
+    fused = fuse([[A], [B]], method="rrf", weights=[1.0, 0.0])
+
+    assert scores(fused)["b"] == 0.0
+
+
+@pytest.mark.parametrize("method", ["rrf", "combsum", "combmnz"])
+@pytest.mark.parametrize("weights", [[1.0], [1.0, 1.0, 1.0], []])
+def test_weights_must_match_the_lists(method, weights):
+    with pytest.raises(ValueError):
+        fuse([[A], [B]], method=method, weights=weights)
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        fuse([[A]], method="borda")
+
+
+def test_combsum_normalizes_scores_per_list():
+    # Scores on very different scales, like cosine similarities and BM25
+    fused = fuse(
+        [[(A, 0.9), (B, 0.8), (C, 0.7)], [(B, 30.0), (C, 10.0)]], method="combsum"
+    )
+
+    assert keys(fused) == ["b", "a", "c"]
+    assert scores(fused)["a"] == pytest.approx(1.0)
+    assert scores(fused)["b"] == pytest.approx(2 / 3 + 1.0)
+
+
+def test_combsum_last_item_still_contributes():
+    fused = fuse([[(A, 0.9), (B, 0.5)], [(B, 0.4)]], method="combsum")
+
+    # The last item of a list gets the 1 / n floor, not 0
+    assert scores(fused)["b"] == pytest.approx(0.5 + 1.0)
+    assert all(score > 0 for _, score in fused)
+
+
+def test_combsum_ties_within_a_list_score_the_same():
+    fused = fuse([[(A, 0.5), (B, 0.5)]], method="combsum")
+
+    assert scores(fused) == {"a": 1.0, "b": 1.0}
+
+
+def test_combsum_uses_ranks_when_a_list_has_no_scores():
+    fused = fuse([[A, B, C, D]], method="combsum")
+
+    assert [score for _, score in fused] == pytest.approx([1.0, 0.75, 0.5, 0.25])
+
+
+def test_combsum_counts_only_the_best_rank_of_a_repeated_chunk():
+    fused = fuse([[(A, 1.0), (B, 0.5), (A, 0.0)]], method="combsum")
+
+    assert scores(fused)["a"] == pytest.approx(1.0)
+
+
+def test_weighted_combsum():
+    fused = fuse([[(A, 1.0)], [(B, 1.0)]], method="combsum", weights=[0.5, 2.0])
+
+    assert scores(fused) == {"b": pytest.approx(2.0), "a": pytest.approx(0.5)}
+
+
+def test_combmnz_rewards_documents_found_by_several_lists():
+    fused = fuse([[(A, 1.0), (B, 0.9)], [(B, 1.0)]], method="combmnz")
+
+    assert keys(fused) == ["b", "a"]
+    assert scores(fused)["b"] == pytest.approx((0.5 + 1.0) * 2)
+
+
+def test_empty_lists():
+    assert fuse([], method="rrf") == []
+    assert fuse([[], []], method="combsum") == []
@@ -0,0 +1,96 @@
+import pytest
+from langchain_core.documents import Document
+
+from embeddings.lexical_index import BM25Index, tokenize
+
+TEXTS = {
+    "cd4": "Los linfocitos CD4 reconocen antigenos presentados por MHC class II.",
+    "il2": "La IL-2 estimula la proliferacion de linfocitos T activados.",
+    "mhc": "Las moleculas MHC class I presentan peptidos a los linfocitos CD8.",
+    "nk": "Las celulas NK destruyen celulas sin MHC class I.",
+}
+
+
+def build(ids):
+    index = BM25Index()
+    index.add_documents(
+        [Document(page_content=TEXTS[id_], metadata={"id": id_}) for id_ in ids],
+        ids=list(ids),
+    )
+    return index
+
+
+def ranking(index, query):
+    return [(doc.id, score) for doc, score in index.search(query, k=10)]
+
+
+def assert_same_ranking(index, expected, query):
+    actual = ranking(index, query)
+    assert [id_ for id_, _ in actual] == [id_ for id_, _ in expected]
+    assert [score for _, score in actual] == pytest.approx(
+        [score for _, score in expected]
+    )
+
+
+def test_hyphenated_terms_match_whole_and_split():
+    assert tokenize("IL-2") == ["il-2", "il", "2"]
+
+
+def test_adding_an_indexed_chunk_again_is_a_no_op():
+    index = build(["cd4", "il2"])
+
+    assert index.add_documents([Document(page_content=TEXTS["cd4"])], ids=["cd4"]) == 0
+    assert len(index) == 2
+
+
+@pytest.mark.parametrize("query", ["MHC class", "linfocitos", "IL-2", "CD4 CD8"])
+def test_removing_chunks_ranks_like_an_index_built_without_them(query):
+    index = build(["cd4", "il2", "mhc", "nk"])
+
+    assert index.remove_documents(["il2", "nk", "unknown"]) == 2
+
+    assert len(index) == 2
+    assert "il2" not in index
+    assert_same_ranking(index, ranking(build(["cd4", "mhc"]), query), query)
+
+
+def test_removed_chunks_can_be_added_back():
+    index = build(["cd4", "il2", "mhc"])
+    index.remove_documents(["cd4"])
+
+    index.add_documents([Document(page_content=TEXTS["cd4"])], ids=["cd4"])
+
+    assert_same_ranking(
+        index, ranking(build(["il2", "mhc", "cd4"]), "linfocitos"), "linfocitos"
+    )
+
+
+def test_removing_unknown_chunks_changes_nothing():
+    index = build(["cd4", "il2"])
+    before = ranking(index, "linfocitos")
+
+    assert index.remove_documents(["unknown"]) == 0
+    assert ranking(index, "linfocitos") == before
+
+
+def test_a_saved_index_loads_with_the_same_ranking(tmp_path):
+    index = build(["cd4", "il2", "mhc", "nk"])
+    index.remove_documents(["mhc"])
+    index.save(str(tmp_path))
+
+    loaded = BM25Index.load(str(tmp_path))
+
+    assert_same_ranking(loaded, ranking(index, "MHC class"), "MHC class")
+
+
+def test_metadata_updates_keep_the_postings():
+    index = build(["cd4", "il2"])
+
+    updated = index.update_metadata(
+        [Document(page_content=TEXTS["cd4"], metadata={"page": 3})], ids=["cd4"]
+    )
+
+    assert updated == 1
+    (document, _), *_ = index.search("CD4")
+    assert document.id == "cd4"
+    assert document.metadata == {"page": 3}
@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+
+from embeddings.local_index import (
+    DOCUMENTS_FILE,
+    INDEX_FILE,
+    VECTORS_FILE,
+    LocalVectorIndex,
+    index_files,
+    update_local_index,
+    write_index_files,
+)
+
+
+def records(*ids):
+    return [{"id": id_, "content": f"content {id_}", "metadata": {}} for id_ in ids]
+
+
+def generation_files(path):
+    return sorted(
+        name for name in os.listdir(path) if name.startswith(("vectors-", "documents-"))
+    )
+
+
+def test_every_write_swaps_the_pointer_to_a_new_pair(tmp_path):
+    path = str(tmp_path)
+    write_index_files(path, np.eye(2), records("a", "b"))
+    first = index_files(path)
+
+    write_index_files(path, np.eye(3), records("a", "b", "c"))
+
+    assert index_files(path) != first
+    with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as f:
+        current = json.load(f)
+    assert index_files(path) == (
+        os.path.join(path, current["vectors"]),
+        os.path.join(path, current["documents"]),
+    )
+    index = LocalVectorIndex.load(path)
+    assert len(index) == 3
+    assert [record["id"] for record in index.records] == ["a", "b", "c"]
+
+
+def test_only_the_current_and_previous_generations_are_kept(tmp_path):
+    path = str(tmp_path)
+    for size in (1, 2, 3, 4):
+        write_index_files(path, np.eye(size), records(*map(str, range(size))))
+
+    # Two generations of two files each
+    assert len(generation_files(path)) == 4
+    assert len(LocalVectorIndex.load(path)) == 4
+
+
+def test_the_load_matches_the_documents_version(tmp_path):
+    path = str(tmp_path)
+    version = write_index_files(path, np.eye(2), records("a", "b"))
+
+    assert LocalVectorIndex.load(path).version == version
+
+
+def test_indexes_without_a_pointer_are_read_and_upgraded(tmp_path):
+    path = str(tmp_path)
+    np.save(os.path.join(path, VECTORS_FILE), np.eye(2, dtype=np.float32))
+    with open(os.path.join(path, DOCUMENTS_FILE), "w", encoding="utf-8") as f:
+        json.dump(records("a", "b"), f)
+
+    assert len(LocalVectorIndex.load(path)) == 2
+
+    update_local_index(
+        path, ids=["c"], contents=["content c"], metadatas=[{}], embeddings=[[1, 1]]
+    )
+    update_local_index(path, removed_ids=["a"])
+
+    assert [record["id"] for record in LocalVectorIndex.load(path).records] == [
+        "b",
+        "c",
+    ]
+    # The legacy pair is gone once it is two generations old
+    assert not os.path.exists(os.path.join(path, DOCUMENTS_FILE))
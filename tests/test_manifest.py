@@ -0,0 +1,61 @@
+import pytest
+
+from embeddings.manifest import IngestManifest, PageRecord
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = IngestManifest(str(tmp_path / "manifest.sqlite3"))
+    yield manifest
+    manifest.close()
+
+
+def ingest(manifest, source, page, chunk_ids):
+    manifest.replace_page(source, page, PageRecord(page_hash=f"{page}"), chunk_ids)
+
+
+def test_chunks_only_the_replaced_page_references_are_stale(manifest):
+    ingest(manifest, "a.pdf", 1, ["x", "y"])
+    ingest(manifest, "a.pdf", 2, ["z"])
+
+    assert manifest.stale_page_chunks("a.pdf", 1, ["y"]) == ["x"]
+
+
+def test_a_chunk_shared_with_another_page_is_not_stale(manifest):
+    ingest(manifest, "a.pdf", 1, ["shared", "x"])
+    ingest(manifest, "a.pdf", 2, ["shared"])
+
+    assert manifest.stale_page_chunks("a.pdf", 1, []) == ["x"]
+
+
+def test_a_chunk_shared_with_another_pdf_is_not_stale(manifest):
+    ingest(manifest, "a.pdf", 1, ["shared"])
+    ingest(manifest, "b.pdf", 1, ["shared"])
+
+    assert manifest.stale_page_chunks("a.pdf", 1, []) == []
+
+
+def test_a_shared_chunk_is_stale_once_its_last_page_drops_it(manifest):
+    ingest(manifest, "a.pdf", 1, ["shared"])
+    ingest(manifest, "a.pdf", 2, ["shared"])
+
+    assert manifest.stale_page_chunks("a.pdf", 1, ["new"]) == []
+    ingest(manifest, "a.pdf", 1, ["new"])
+
+    assert manifest.stale_page_chunks("a.pdf", 2, ["new"]) == ["shared"]
+
+
+def test_chunks_the_page_keeps_are_not_stale(manifest):
+    ingest(manifest, "a.pdf", 1, ["x", "y"])
+
+    assert manifest.stale_page_chunks("a.pdf", 1, ["x", "y"]) == []
+
+
+def test_dropped_pages_keep_chunks_the_remaining_pages_reference(manifest):
+    ingest(manifest, "a.pdf", 1, ["shared"])
+    ingest(manifest, "a.pdf", 2, ["x"])
+    ingest(manifest, "a.pdf", 3, ["shared", "y"])
+    ingest(manifest, "b.pdf", 3, ["x"])
+
+    assert sorted(manifest.stale_document_chunks("a.pdf", page_count=1)) == ["y"]
+    assert sorted(manifest.stale_document_chunks("a.pdf")) == ["shared", "y"]
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+import pytest
+
+from lib.scheduler import (
+    RequestScheduler,
+    SchedulerOverloaded,
+    SchedulerTimeout,
+    UpstreamLimiter,
+    current_session,
+)
+
+
+async def wait_for_length(items, length):
+    while len(items) < length:
+        await asyncio.sleep(0)
+
+
+def test_queued_sessions_are_served_round_robin():
+    async def scenario():
+        limiter = UpstreamLimiter("llm", max_in_flight=1, max_queue=10)
+        await limiter.acquire("holder", timeout=1)
+        order = []
+
+        async def request(session, label):
+            await limiter.acquire(session, timeout=5)
+            order.append(label)
+
+        # Session "a" queues three requests before "b" queues its only one
+        requests = [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]
+        tasks = [asyncio.create_task(request(*args)) for args in requests]
+        await asyncio.sleep(0)
+        assert limiter.stats()["waiting_sessions"] == 2
+
+        for granted in range(1, len(requests) + 1):
+            limiter.release()
+            await asyncio.wait_for(wait_for_length(order, granted), 1)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_a_request_waiting_past_the_timeout_gives_up_its_place():
+    async def scenario():
+        limiter = UpstreamLimiter("llm", max_in_flight=1, max_queue=10)
+        await limiter.acquire("holder", timeout=1)
+
+        with pytest.raises(SchedulerTimeout):
+            await limiter.acquire("late", timeout=0.01)
+
+        stats = limiter.stats()
+        assert stats["timed_out"] == 1
+        assert stats["queue_depth"] == 0
+        # The released slot is free again, not handed to the timed out waiter
+        limiter.release()
+        assert limiter.in_flight == 0
+        await asyncio.wait_for(limiter.acquire("next", timeout=1), 0.1)
+
+    asyncio.run(scenario())
+
+
+def test_sync_requests_time_out_too():
+    limiter = UpstreamLimiter("judge", max_in_flight=1, max_queue=10)
+    limiter.acquire_sync("holder", timeout=1)
+
+    with pytest.raises(SchedulerTimeout):
+        limiter.acquire_sync("late", timeout=0.01)
+    assert limiter.stats()["timed_out"] == 1
+
+
+def test_a_full_queue_rejects_new_requests():
+    async def scenario():
+        limiter = UpstreamLimiter("embedding", max_in_flight=1, max_queue=1)
+        await limiter.acquire("holder", timeout=1)
+        queued = asyncio.create_task(limiter.acquire("a", timeout=5))
+        await asyncio.sleep(0)
+
+        with pytest.raises(SchedulerOverloaded):
+            await limiter.acquire("b", timeout=5)
+
+        assert limiter.stats()["rejected"] == 1
+        limiter.release()
+        await asyncio.wait_for(queued, 1)
+
+    asyncio.run(scenario())
+
+
+def test_a_sync_waiter_gets_the_slot_released_by_another_thread():
+    scheduler = RequestScheduler({"judge": 1}, timeout=5)
+    granted = threading.Event()
+
+    def judge_call():
+        current_session.set("verifier")
+        with scheduler.slot_sync("judge"):
+            granted.set()
+
+    with scheduler.slot_sync("judge"):
+        thread = threading.Thread(target=judge_call)
+        thread.start()
+        assert not granted.wait(0.05)
+    thread.join(1)
+
+    assert granted.is_set()
+    assert scheduler.stats()["judge"]["in_flight"] == 0
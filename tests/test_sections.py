@@ -0,0 +1,181 @@
+from embeddings.sections import CHUNK_SIZE, Carry, split_page_markdown
+
+# Paragraphs long enough to survive the minimum chunk length
+INTRO = "La inmunidad innata es la primera linea de defensa del organismo. " * 2
+CONTINUED = "Sus barreras incluyen la piel, las mucosas y las celulas fagociticas. " * 2
+ANTIBODIES = "Los anticuerpos son glicoproteinas producidas por los plasmocitos. " * 2
+ANTIGENS = (
+    "Los antigenos son moleculas reconocidas por el sistema inmune adaptativo. " * 2
+)
+
+
+def headers(document):
+    return {
+        key: value
+        for key, value in document.metadata.items()
+        if key in ("Header 1", "Header 2")
+    }
+
+
+def test_a_section_spanning_pages_is_chunked_once_with_its_start_page():
+    documents, carry = split_page_markdown(
+        f"# Inmunidad\n\n{INTRO}", Carry(), 1, closes=False
+    )
+    assert documents == []
+
+    documents, carry = split_page_markdown(CONTINUED, carry, 2, closes=False)
+    assert documents == []
+
+    documents, carry = split_page_markdown(
+        f"## Anticuerpos\n\n{ANTIBODIES}", carry, 3, closes=False
+    )
+
+    assert len(documents) == 1
+    # The paragraphs on both sides of the page breaks stay in one chunk
+    assert INTRO.strip() in documents[0].page_content
+    assert CONTINUED.strip() in documents[0].page_content
+    assert documents[0].metadata["page"] == 1
+    assert headers(documents[0]) == {"Header 1": "Inmunidad"}
+    assert carry.page == 3
+    assert carry.text.startswith("## Anticuerpos")
+    assert carry.headers == {"Header 1": "Inmunidad"}
+
+
+def test_a_page_without_headings_extends_the_carry():
+    carry = Carry(
+        text=f"## Anticuerpos\n\n{ANTIBODIES}",
+        page=4,
+        headers={"Header 1": "Inmunidad"},
+    )
+
+    documents, carry = split_page_markdown(CONTINUED, carry, 5, closes=False)
+
+    assert documents == []
+    assert carry.text == f"## Anticuerpos\n\n{ANTIBODIES}\n{CONTINUED}"
+    assert carry.page == 4
+    assert carry.headers == {"Header 1": "Inmunidad"}
+
+
+def test_a_first_page_without_headings_starts_the_carry_on_it():
+    documents, carry = split_page_markdown(INTRO, Carry(), 7, closes=False)
+
+    assert documents == []
+    assert carry == Carry(text=INTRO, page=7, headers={})
+
+
+def test_the_last_page_flushes_its_carry():
+    carry = Carry(
+        text=f"## Anticuerpos\n\n{ANTIBODIES}",
+        page=2,
+        headers={"Header 1": "Inmunidad"},
+    )
+
+    documents, carry = split_page_markdown(CONTINUED, carry, 3, closes=True)
+
+    assert len(documents) == 1
+    assert CONTINUED.strip() in documents[0].page_content
+    assert documents[0].metadata["page"] == 2
+    assert headers(documents[0]) == {
+        "Header 1": "Inmunidad",
+        "Header 2": "Anticuerpos",
+    }
+    assert carry == Carry(page=4)
+
+
+def test_the_last_page_chunks_its_own_last_section():
+    documents, carry = split_page_markdown(
+        f"# Antigenos\n\n{ANTIGENS}", Carry(), 1, closes=True
+    )
+
+    assert len(documents) == 1
+    assert documents[0].metadata["page"] == 1
+    assert headers(documents[0]) == {"Header 1": "Antigenos"}
+    assert carry.text == ""
+
+
+def test_text_before_the_first_heading_inherits_the_carried_headers():
+    carry = Carry(
+        text="", page=1, headers={"Header 1": "Inmunidad", "Header 2": "Barreras"}
+    )
+
+    documents, carry = split_page_markdown(
+        f"{CONTINUED}\n## Anticuerpos\n\n{ANTIBODIES}\n# Antigenos\n\n{ANTIGENS}",
+        carry,
+        2,
+        closes=False,
+    )
+
+    assert [headers(document) for document in documents] == [
+        {"Header 1": "Inmunidad", "Header 2": "Barreras"},
+        # Only the level above the section's own heading is inherited
+        {"Header 1": "Inmunidad", "Header 2": "Anticuerpos"},
+    ]
+    assert [document.metadata["page"] for document in documents] == [2, 2]
+    assert carry.text.startswith("# Antigenos")
+    assert carry.headers == {"Header 1": "Inmunidad", "Header 2": "Anticuerpos"}
+
+
+def test_a_top_level_heading_resets_the_second_level_header():
+    carry = Carry(
+        text=f"# Antigenos\n\n{ANTIGENS}",
+        page=2,
+        headers={"Header 1": "Inmunidad", "Header 2": "Anticuerpos"},
+    )
+
+    documents, carry = split_page_markdown(
+        f"## Epitopos\n\n{ANTIBODIES}", carry, 3, closes=False
+    )
+
+    assert [headers(document) for document in documents] == [{"Header 1": "Antigenos"}]
+    assert carry.headers == {"Header 1": "Antigenos"}
+
+
+def test_the_carry_key_follows_the_carried_section():
+    carry = Carry(text=INTRO, page=1, headers={"Header 1": "Inmunidad"})
+
+    assert carry.key() == Carry(**vars(carry)).key()
+    assert carry.key() != Carry(text=CONTINUED, page=1, headers=carry.headers).key()
+    assert carry.key() != Carry(text=INTRO, page=2, headers=carry.headers).key()
+    assert carry.key() != Carry(text=INTRO, page=1, headers={}).key()
+
+
+def test_a_long_section_without_headings_is_not_carried_whole():
+    paragraphs = [f"Parrafo {i}. {CONTINUED}" for i in range(80)]
+    carry = Carry()
+    documents, carry = split_page_markdown(
+        f"# Inmunidad\n\n{INTRO}", carry, 1, closes=False
+    )
+
+    # Pages longer than a chunk, so the carried tail starts on the last one
+    for page, start in enumerate(range(0, 80, 8), start=2):
+        page_documents, carry = split_page_markdown(
+            "\n\n".join(paragraphs[start : start + 8]), carry, page, closes=False
+        )
+        documents.extend(page_documents)
+        assert len(carry.text) <= CHUNK_SIZE
+
+    last_documents, _ = split_page_markdown("", carry, 12, closes=True)
+    documents.extend(last_documents)
+
+    text = "\n".join(document.page_content for document in documents)
+    assert all(f"Parrafo {i}." in text for i in range(80))
+    assert all(headers(document) == {"Header 1": "Inmunidad"} for document in documents)
+    # The first chunks start on the heading's page, the last on the last page
+    assert documents[0].metadata["page"] == 1
+    assert documents[-1].metadata["page"] == 11
+
+
+def test_a_long_last_section_is_bounded_too():
+    long_section = "\n\n".join(f"Parrafo {i}. {ANTIBODIES}" for i in range(20))
+
+    documents, carry = split_page_markdown(
+        f"# Inmunidad\n\n{INTRO}\n## Anticuerpos\n\n{long_section}",
+        Carry(),
+        1,
+        closes=False,
+    )
+
+    assert len(carry.text) <= CHUNK_SIZE
+    assert carry.page == 1
+    assert carry.headers == {"Header 1": "Inmunidad", "Header 2": "Anticuerpos"}
+    assert any("Parrafo 0." in document.page_content for document in documents)
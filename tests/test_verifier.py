@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+import pytest
+
+from rag import verifier
+from rag.validation import ClaimResult
+from rag.verifier import IncrementalVerifier
+
+CLAIM = (
+    "Los anticuerpos neutralizan toxinas y marcan patogenos para la fagocitosis. " * 2
+)
+
+
+def result(is_supported, tier="llm"):
+    return ClaimResult(text=CLAIM, is_supported=is_supported, tier=tier)
+
+
+@pytest.mark.parametrize(
+    "verdicts, expected",
+    [
+        ([True, True], False),
+        ([True, False], True),
+        # An unsupported claim decides the answer even with undecided ones
+        ([None, False], True),
+        ([True, None], None),
+    ],
+)
+def test_aggregate(verdicts, expected):
+    results = [result(verdict) for verdict in verdicts]
+
+    assert IncrementalVerifier.aggregate(results) is expected
+
+
+@pytest.mark.parametrize("answer", ["", "   ", "\n\n\n\n"])
+def test_answers_without_claims_are_undecided(answer):
+    incremental = IncrementalVerifier(passages=[CLAIM])
+    incremental.feed(answer)
+    incremental.close()
+
+    assert incremental.results() == []
+    assert asyncio.run(incremental.aresults()) == []
+    assert IncrementalVerifier.aggregate([]) is None
+
+
+def test_streamed_claims_are_aggregated(monkeypatch):
+    monkeypatch.setattr(
+        verifier,
+        "verify_claim",
+        lambda claim, passages, scorer: ClaimResult(
+            text=claim, is_supported="toxinas" in claim
+        ),
+    )
+    incremental = IncrementalVerifier(passages=[CLAIM])
+
+    for token in [CLAIM, "\n\n", "Los linfocitos B producen histamina. " * 4]:
+        incremental.feed(token)
+    incremental.close()
+    results = incremental.results()
+
+    assert [result.is_supported for result in results] == [True, False]
+    assert IncrementalVerifier.aggregate(results) is True
+
+
+def test_checks_past_the_timeout_are_undecided(monkeypatch):
+    release = threading.Event()
+
+    def slow_verify_claim(claim, passages, scorer):
+        release.wait(5)
+        return ClaimResult(text=claim, is_supported=True)
+
+    monkeypatch.setattr(verifier, "verify_claim", slow_verify_claim)
+    incremental = IncrementalVerifier(passages=[CLAIM])
+    incremental.feed(CLAIM)
+    incremental.close()
+
+    try:
+        results = incremental.results(timeout=0.05)
+    finally:
+        release.set()
+
+    assert [result.tier for result in results] == ["timeout"]
+    assert IncrementalVerifier.aggregate(results) is None